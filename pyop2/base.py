@@ -39,21 +39,26 @@ from __future__ import absolute_import, print_function, division
 import six
 from six.moves import map, zip
 
+from collections import OrderedDict
 from contextlib import contextmanager
 import itertools
+import os
+import shutil
+import tempfile
 import numpy as np
 import ctypes
 import operator
 import types
+import weakref
 from hashlib import md5
 
 from pyop2.datatypes import IntType, as_cstr
 from pyop2.configuration import configuration
-from pyop2.caching import Cached, ObjectCached
+from pyop2.caching import Cached, ObjectCached, LRUCache
 from pyop2.exceptions import *
 from pyop2.utils import *
 from pyop2.mpi import MPI, collective, dup_comm
-from pyop2.profiling import timed_region, timed_function
+from pyop2.profiling import timed_region, timed_function, timed_counter, profiler
 from pyop2.sparsity import build_sparsity
 from pyop2.version import __version__ as version
 
@@ -64,8 +69,11 @@ from functools import reduce
 
 
 def _make_object(name, *args, **kwargs):
-    from pyop2 import sequential
-    return getattr(sequential, name)(*args, **kwargs)
+    if configuration['backend'] == 'openmp':
+        from pyop2 import openmp as backend
+    else:
+        from pyop2 import sequential as backend
+    return getattr(backend, name)(*args, **kwargs)
 
 
 @contextmanager
@@ -93,6 +101,10 @@ class LazyComputation(object):
         self.incs = set((x._parent if isinstance(x, DatView) else x)
                         for x in flatten(incs))
         self._scheduled = False
+        # Edges of the dependency graph, maintained by the ExecutionTrace
+        self._deps = set()
+        self._dependents = set()
+        self._pending = False
 
     def enqueue(self):
         if not LazyComputation.collecting_loops:
@@ -102,43 +114,226 @@ class LazyComputation(object):
 
     __call__ = enqueue
 
+    def _prefetch(self):
+        """Start any work needed to run this computation (such as
+        compiling code) that may proceed in the background."""
+        pass
+
     def _run(self):
         assert False, "Not implemented"
 
 
 class ExecutionTrace(object):
 
-    """Container maintaining delayed computation until they are executed."""
+    """Container maintaining delayed computation until they are executed.
+
+    The delayed computations form a directed acyclic graph, built
+    incrementally as computations are appended: a computation depends
+    on every earlier pending computation it has a read-after-write,
+    write-after-read or write-after-write hazard with.  Forcing
+    evaluation only visits the part of the graph that is needed."""
 
     def __init__(self):
         self._trace = list()
+        # Last pending computation writing to a DataCarrier
+        self._writers = {}
+        # Pending computations reading a DataCarrier since it was last written
+        self._readers = {}
+        # Dats whose values are given by a deferred expression
+        self._deferred = weakref.WeakSet()
+        # Global reductions of the computations being executed
+        self._reductions = None
+        # Batches of reductions in flight, see _ReductionBatch.start
+        self._inflight = []
+
+    def defer(self, dat):
+        """Record that the values of ``dat`` are given by a deferred
+        expression (see :meth:`Dat._defer`), to be computed once they
+        are used."""
+        self._deferred.add(dat)
+
+    def _materialise(self, reads, writes):
+        """Enqueue the computation of the deferred :class:`Dat`\s that
+        are read or written, or whose expressions read data that is
+        about to be written."""
+        if not self._deferred:
+            return
+        for dat in list(self._deferred):
+            if dat in reads or dat in writes or \
+               not dat._deferred_expression.reads.isdisjoint(writes):
+                dat._materialise()
+
+    def _complete(self, data):
+        """Wait for the reductions in flight into any of ``data``."""
+        if not self._inflight:
+            return
+        for batch in list(self._inflight):
+            if not batch.globals.isdisjoint(data):
+                self._inflight.remove(batch)
+                batch.wait()
+
+    def complete_all(self):
+        """Wait for all reductions in flight."""
+        inflight = self._inflight
+        self._inflight = []
+        for batch in inflight:
+            batch.wait()
 
     def append(self, computation):
+        if self._deferred:
+            self._materialise(computation.reads,
+                              computation.writes | computation.incs)
         if not configuration['lazy_evaluation']:
             assert not self._trace
-            computation._run()
+            self._execute([computation])
         elif configuration['lazy_max_trace_length'] > 0 and \
                 configuration['lazy_max_trace_length'] == len(self._trace):
             # Garbage collect trace (stop the world)
             self.evaluate_all()
-            self._trace.append(computation)
+            self._add(computation)
         else:
-            self._trace.append(computation)
+            if computation._pending:
+                # The same computation may only appear once in the
+                # graph, flush the previous instance first.
+                self._run(self._ancestors([computation]))
+            self._add(computation)
+
+    def _add(self, computation):
+        """Append a computation to the trace and link it into the
+        dependency graph."""
+        deps = set()
+        for d in computation.reads | computation.writes:
+            w = self._writers.get(d)
+            if w is not None:
+                deps.add(w)
+        for d in computation.writes:
+            deps.update(self._readers.get(d, ()))
+        computation._deps = deps
+        computation._dependents = set()
+        for dep in deps:
+            dep._dependents.add(computation)
+        for d in computation.reads - computation.writes:
+            self._readers.setdefault(d, set()).add(computation)
+        for d in computation.writes:
+            self._writers[d] = computation
+            self._readers[d] = set()
+        computation._pending = True
+        self._trace.append(computation)
+
+    def _ancestors(self, computations):
+        """Return the pending computations in ``computations`` and all
+        pending computations they (transitively) depend on."""
+        stack = [c for c in computations if c._pending]
+        seen = set()
+        while stack:
+            comp = stack.pop()
+            if comp in seen:
+                continue
+            seen.add(comp)
+            stack.extend(comp._deps)
+        return seen
+
+    def _remove(self, computations):
+        """Remove computations from the trace and the dependency graph.
+
+        Only computations whose dependencies are all removed too may
+        be passed."""
+        for comp in computations:
+            for dependent in comp._dependents:
+                dependent._deps.discard(comp)
+            comp._deps = set()
+            comp._dependents = set()
+            comp._pending = False
+            for d in comp.reads | comp.writes:
+                if self._writers.get(d) is comp:
+                    del self._writers[d]
+                readers = self._readers.get(d)
+                if readers:
+                    readers.discard(comp)
+        self._trace = [c for c in self._trace if c._pending]
+
+    def _run(self, computations):
+        """Run a dependency-closed set of computations in trace order."""
+        if not computations:
+            return
+        for comp in self._trace:
+            comp._scheduled = comp in computations
+        to_run = [comp for comp in self._trace if comp._scheduled]
+        self._remove(to_run)
+
+        if configuration['loop_fusion']:
+            from pyop2.fusion.interface import fuse, lazy_trace_name
+            to_run = fuse(lazy_trace_name, to_run)
+        self._execute(to_run)
+
+    def _execute(self, computations):
+        """Run computations in order.  If compilation happens in the
+        background, all of it is started before running the first, so
+        that computations whose code is ready run while the rest builds."""
+        if configuration['compile_workers'] > 0:
+            for comp in computations:
+                comp._prefetch()
+        # The global reductions of the computations are combined,
+        # finishing them only once a computation touches one of the
+        # reduced Globals.  The remaining ones are left in flight
+        # until their results are needed.
+        outer = self._reductions
+        if outer is not None:
+            # Running computations from within a computation
+            outer.flush()
+        batch = _ReductionBatch()
+        self._reductions = batch
+        try:
+            for comp in computations:
+                self._complete(comp.reads | comp.writes)
+                batch.flush_for(comp)
+                comp._run()
+            batch.start()
+            if batch.globals:
+                self._inflight.append(batch)
+        finally:
+            self._reductions = outer
+
+    def levels(self, computations=None):
+        """Group pending computations into levels of mutually
+        independent computations.
+
+        :arg computations: the computations to schedule, defaults to
+             the whole trace.
+        :returns: a list of lists, the computations of a level only
+             depend on computations in earlier levels and may be
+             executed in any order (or concurrently).
+        """
+        if computations is None:
+            computations = self._trace
+        level = {}
+        levels = []
+        for comp in computations:
+            lvl = max([level[d] + 1 for d in comp._deps if d in level] or [0])
+            level[comp] = lvl
+            if lvl == len(levels):
+                levels.append([])
+            levels[lvl].append(comp)
+        return levels
 
     def in_queue(self, computation):
-        return computation in self._trace
+        return computation._pending and computation in self._trace
 
     def clear(self):
         """Forcefully drops delayed computation. Only use this if you know what you
         are doing.
         """
+        self._remove(self._trace)
         self._trace = list()
+        self._writers = {}
+        self._readers = {}
 
     def evaluate_all(self):
         """Forces the evaluation of all delayed computations."""
-        for comp in self._trace:
-            comp._run()
-        self._trace = list()
+        trace = self._trace
+        self.clear()
+        self._execute(trace)
+        self.complete_all()
 
     def evaluate(self, reads=None, writes=None):
         """Force the evaluation of delayed computation on which reads and writes
@@ -151,7 +346,6 @@ class ExecutionTrace(object):
                      This forces evaluation of all :func:`par_loop`\s that read from the
                      :class:`DataCarrier` (and any other dependent computation).
         """
-
         if reads is not None:
             try:
                 reads = set(flatten(reads))
@@ -167,30 +361,17 @@ class ExecutionTrace(object):
         else:
             writes = set()
 
-        def _depends_on(reads, writes, cont):
-            return reads & cont.writes or writes & cont.reads or writes & cont.writes
-
-        for comp in reversed(self._trace):
-            if _depends_on(reads, writes, comp):
-                comp._scheduled = True
-                reads = reads | comp.reads - comp.writes
-                writes = writes | comp.writes
-            else:
-                comp._scheduled = False
-
-        to_run, new_trace = list(), list()
-        for comp in self._trace:
-            if comp._scheduled:
-                to_run.append(comp)
-            else:
-                new_trace.append(comp)
-        self._trace = new_trace
-
-        if configuration['loop_fusion']:
-            from pyop2.fusion.interface import fuse, lazy_trace_name
-            to_run = fuse(lazy_trace_name, to_run)
-        for comp in to_run:
-            comp._run()
+        self._materialise(reads, writes)
+        if self._trace:
+            roots = set()
+            for d in reads | writes:
+                w = self._writers.get(d)
+                if w is not None:
+                    roots.add(w)
+            for d in writes:
+                roots.update(self._readers.get(d, ()))
+            self._run(self._ancestors(roots))
+        self._complete(reads | writes)
 
 
 _trace = ExecutionTrace()
@@ -248,6 +429,91 @@ MAX = Access("MAX")
 operation. OP2 is responsible for reducing over the different kernel
 invocations."""
 
+
+class _ReductionBatch(object):
+
+    """Global reductions of several :class:`ParLoop`\s, combined into a
+    single allreduce per communicator, operation and type.
+
+    :meth:`ParLoop.reduction_begin` records the local contributions
+    of the reduction arguments, :meth:`ParLoop.reduction_end` is
+    deferred until the batch is flushed.  Reductions may also be
+    started (with MPI-3 non-blocking allreduces) and only waited for
+    once their results are needed."""
+
+    _ops = {INC: MPI.SUM, MIN: MPI.MIN, MAX: MPI.MAX}
+    _nonblocking = MPI.VERSION >= 3
+
+    def __init__(self):
+        # (comm, access, dtype) -> [comm, [(arg, contribution)]]
+        self._pending = OrderedDict()
+        # Started reductions: [(request, send, recv, entries)]
+        self._started = []
+        self._loops = []
+        # Globals whose values are not final until the batch is flushed
+        self.globals = set()
+
+    def begin(self, arg, comm):
+        """Record the local contribution of the reduction ``arg``."""
+        assert not arg._in_flight, \
+            "Reduction already in flight for Arg %s" % arg
+        arg._in_flight = True
+        key = (id(comm), arg.access, arg.data.dtype.str)
+        entry = self._pending.setdefault(key, [comm, []])
+        # Copy, since executing over the halo region may modify the data
+        entry[1].append((arg, arg.data._data.copy()))
+        self.globals.add(arg.data)
+
+    def end(self, loop):
+        """Defer finishing the reductions of ``loop``."""
+        self._loops.append(loop)
+        self.globals.update(six.itervalues(loop._reduced_globals))
+
+    def flush_for(self, computation):
+        """Finish the reductions if ``computation`` touches a reduced
+        :class:`Global`."""
+        if self.globals and \
+           not self.globals.isdisjoint(computation.reads | computation.writes | computation.incs):
+            self.flush()
+
+    @collective
+    def start(self):
+        """Start all pending reductions, without waiting for them."""
+        for (_, access, _), (comm, entries) in six.iteritems(self._pending):
+            send = np.concatenate([c.reshape(-1) for _, c in entries])
+            recv = np.empty_like(send)
+            if self._nonblocking:
+                request = comm.Iallreduce(send, recv, op=self._ops[access])
+            else:
+                comm.Allreduce(send, recv, op=self._ops[access])
+                request = None
+            self._started.append((request, send, recv, entries))
+        self._pending = OrderedDict()
+
+    @collective
+    def wait(self):
+        """Wait for the started reductions and finish the reductions
+        of the loops."""
+        MPI.Request.Waitall([r for r, _, _, _ in self._started if r is not None])
+        for _, _, recv, entries in self._started:
+            offset = 0
+            for arg, c in entries:
+                arg.data._buf[...] = recv[offset:offset + c.size].reshape(c.shape)
+                offset += c.size
+        loops = self._loops
+        self._started = []
+        self._loops = []
+        self.globals = set()
+        for loop in loops:
+            loop._reduction_end()
+
+    @collective
+    def flush(self):
+        """Finish all pending reductions."""
+        self.start()
+        self.wait()
+
+
 # Data API
 
 
@@ -470,6 +736,15 @@ class Arg(object):
         """Begin halo exchange for the argument if a halo update is required.
         Doing halo exchanges only makes sense for :class:`Dat` objects.
 
+        :kwarg update_inc: if True also force halo exchange for :class:`Dat`\s accessed via INC."""
+        if self._claim_halo_exchange(update_inc=update_inc):
+            self.data.halo_exchange_begin()
+
+    def _claim_halo_exchange(self, update_inc=False):
+        """Mark a halo exchange of the argument as in flight if one is
+        required, returning whether it is.  The caller starts the
+        exchange.
+
         :kwarg update_inc: if True also force halo exchange for :class:`Dat`\s accessed via INC."""
         assert self._is_dat, "Doing halo exchanges only makes sense for Dats"
         assert not self._in_flight, \
@@ -480,7 +755,8 @@ class Arg(object):
         if self.access in access and self.data.needs_halo_update:
             self.data.needs_halo_update = False
             self._in_flight = True
-            self.data.halo_exchange_begin()
+            return True
+        return False
 
     @collective
     def halo_exchange_end(self, update_inc=False):
@@ -531,6 +807,40 @@ class Arg(object):
             self.data._data[:] = self.data._buf[:]
 
 
+def _hdf5_read(slot, indices=None, mmap=False):
+    """Read the rows of the HDF5 dataset ``slot``.
+
+    :arg indices: The rows to read, in the order they are returned,
+        for instance the global numbers of the owned and halo entries
+        of this process.  Contiguous runs of rows are read with one
+        selection each, in chunks of bounded size.  Defaults to all
+        rows.
+    :arg mmap: Map all rows of the file into memory (copy on write)
+        rather than reading them, if the dataset is stored contiguous
+        and uncompressed, such that pages are only read when touched.
+    """
+    if indices is None:
+        if mmap and slot.chunks is None and slot.compression is None:
+            offset = slot.id.get_offset()
+            if offset is not None:
+                return np.memmap(slot.file.filename, dtype=slot.dtype, mode="c",
+                                 offset=offset, shape=slot.shape)
+        return slot[()]
+    indices = np.asarray(indices, dtype=np.int64)
+    values = np.empty((len(indices), ) + slot.shape[1:], dtype=slot.dtype)
+    order = np.argsort(indices, kind="mergesort")
+    rows = indices[order]
+    rowbytes = max(1, values[:1].nbytes)
+    chunk = max(1, (64 << 20) // rowbytes)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(rows) != 1) + 1))
+    ends = np.concatenate((starts[1:], [len(rows)]))
+    for start, end in zip(starts, ends):
+        for lo in range(start, end, chunk):
+            hi = min(end, lo + chunk)
+            values[order[lo:hi]] = slot[rows[lo]:rows[hi - 1] + 1]
+    return values
+
+
 class Set(object):
 
     """OP2 set.
@@ -592,7 +902,7 @@ class Set(object):
         if self.halo:
             self.halo.verify(self)
         # A cache of objects built on top of this set
-        self._cache = {}
+        self._cache = LRUCache()
         Set._globalcount += 1
 
     @cached_property
@@ -716,8 +1026,7 @@ class Set(object):
         slot = f[name]
         if slot.shape != (1,):
             raise SizeTypeError("Shape of %s is incorrect" % name)
-        size = slot.value.astype(np.int)
-        return cls(size[0], name)
+        return cls(int(slot[0]), name)
 
 
 class GlobalSet(Set):
@@ -1408,6 +1717,7 @@ class Halo(object):
             self._receives[i] = np.asarray(a)
         self._global_to_petsc_numbering = gnn2unn
         self.comm = dup_comm(comm)
+        self._patterns = {}
         rank = self.comm.rank
 
         assert rank not in self._sends, \
@@ -1419,51 +1729,51 @@ class Halo(object):
     def begin(self, dat, reverse=False):
         """Begin halo exchange.
 
-        :arg dat: The :class:`Dat` to perform the exchange on.
+        :arg dat: The :class:`Dat` to perform the exchange on, or a
+             tuple of :class:`Dat`\s on this halo to exchange together,
+             in a single message per neighbour.
         :kwarg reverse: if True, switch round the meaning of sends and receives.
                This can be used when computing non-redundantly and
                INCing into a :class:`Dat` to obtain correct local
                values."""
-        sends = self.sends
-        receives = self.receives
-        if reverse:
-            sends, receives = receives, sends
-        for dest, ele in six.iteritems(sends):
-            dat._send_buf[dest] = dat._data[ele]
-            dat._send_reqs[dest] = self.comm.Isend(dat._send_buf[dest],
-                                                   dest=dest, tag=dat._id)
-        for source, ele in six.iteritems(receives):
-            dat._recv_buf[source] = dat._data[ele]
-            dat._recv_reqs[source] = self.comm.Irecv(dat._recv_buf[source],
-                                                     source=source, tag=dat._id)
+        dats = dat if isinstance(dat, tuple) else (dat, )
+        key = _HaloExchange._key(dats, reverse)
+        try:
+            exchange = dats[0]._halo_exchanges[key]
+        except KeyError:
+            exchange = _HaloExchange(self._pattern(reverse), dats)
+            dats[0]._halo_exchanges[key] = exchange
+        exchange.begin([d._data for d in dats])
 
     @collective
     def end(self, dat, reverse=False):
         """End halo exchange.
 
-        :arg dat: The :class:`Dat` to perform the exchange on.
+        :arg dat: The :class:`Dat`, or tuple of :class:`Dat`\s, passed
+             to :meth:`begin`.
         :kwarg reverse: if True, switch round the meaning of sends and receives.
                This can be used when computing non-redundantly and
                INCing into a :class:`Dat` to obtain correct local
                values."""
-        with timed_region("Halo exchange receives wait"):
-            MPI.Request.Waitall(dat._recv_reqs.values())
-        with timed_region("Halo exchange sends wait"):
-            MPI.Request.Waitall(dat._send_reqs.values())
-        dat._recv_reqs.clear()
-        dat._send_reqs.clear()
-        dat._send_buf.clear()
-        receives = self.receives
-        if reverse:
-            receives = self.sends
-        maybe_setflags(dat._data, write=True)
-        for source, buf in six.iteritems(dat._recv_buf):
+        dats = dat if isinstance(dat, tuple) else (dat, )
+        key = _HaloExchange._key(dats, reverse)
+        dats[0]._halo_exchanges[key].end([d._data for d in dats], reverse=reverse)
+
+    def _pattern(self, reverse=False):
+        """The packed communication pattern of an exchange.
+
+        :kwarg reverse: if True, the pattern of a reverse exchange.
+        :returns: a :class:`_HaloPattern`, computed once per direction."""
+        try:
+            return self._patterns[reverse]
+        except KeyError:
+            sends = self.sends
+            receives = self.receives
             if reverse:
-                dat._data[receives[source]] += buf
-            else:
-                dat._data[receives[source]] = buf
-        maybe_setflags(dat._data, write=False)
-        dat._recv_buf.clear()
+                sends, receives = receives, sends
+            pattern = _HaloPattern(self.comm, sends, receives)
+            self._patterns[reverse] = pattern
+            return pattern
 
     @property
     def sends(self):
@@ -1511,6 +1821,195 @@ class Halo(object):
                 source
 
 
+class _HaloPattern(object):
+
+    """The communication pattern of a halo exchange in one direction.
+
+    The elements sent to (received from) all neighbours are packed
+    into a single index array, ordered by neighbour rank, such that
+    one contiguous buffer holds the messages to (from) every
+    neighbour.  The messages of neighbour ``i`` occupy the range
+    ``offsets[i]:offsets[i+1]``.
+
+    :arg comm: The communicator of the :class:`Halo`.
+    :arg sends: dict of elements to send, keyed by destination rank.
+    :arg receives: dict of elements to receive, keyed by source rank.
+    """
+
+    def __init__(self, comm, sends, receives):
+        self.comm = comm
+        self.destinations = sorted(sends)
+        self.sources = sorted(receives)
+        self.send_indices, self.send_offsets = self._pack(sends, self.destinations)
+        self.recv_indices, self.recv_offsets = self._pack(receives, self.sources)
+        # Reverse exchanges receive contributions to an owned element
+        # from every process it is sent to, these must be accumulated
+        # one at a time.
+        self.unique_receives = len(np.unique(self.recv_indices)) == len(self.recv_indices)
+
+    @staticmethod
+    def _pack(elements, ranks):
+        offsets = np.zeros(len(ranks) + 1, dtype=IntType)
+        offsets[1:] = np.cumsum([len(elements[r]) for r in ranks])
+        if ranks:
+            indices = np.concatenate([elements[r] for r in ranks]).astype(IntType)
+        else:
+            indices = np.empty(0, dtype=IntType)
+        return indices, offsets
+
+    @cached_property
+    def graph_comm(self):
+        """A distributed graph communicator connecting this process to
+        its neighbours, for neighbourhood collectives."""
+        return self.comm.Create_dist_graph_adjacent(self.sources, self.destinations,
+                                                    reorder=False)
+
+
+class _HaloExchange(object):
+
+    """Preallocated buffers and persistent requests for the halo
+    exchange of a tuple of :class:`Dat`\s in one direction.
+
+    The values of all Dats for one element are interleaved in a
+    record, such that the Dats are exchanged in a single message per
+    neighbour.  Exchanges pack the owned values into the send buffer,
+    start the persistent requests (or a single neighbourhood
+    ``alltoallv`` if ``configuration["halo_neighbourhood"]`` is set)
+    and scatter the receive buffer into the halo when complete.  No
+    buffers or requests are created after the first exchange.
+
+    Exchanges are kept on the first Dat, keyed by the layout of the
+    record rather than by the other Dats, such that exchanging a
+    long-lived Dat with fresh temporaries reuses a single exchange.
+    The persistent requests are freed with the exchange.
+
+    :arg pattern: The :class:`_HaloPattern` of the exchange.
+    :arg dats: The :class:`Dat`\s to exchange.
+    """
+
+    @staticmethod
+    def _key(dats, reverse):
+        return (reverse, ) + tuple((d._data.dtype, d._data.shape[1:]) for d in dats)
+
+    def __init__(self, pattern, dats):
+        self.pattern = pattern
+        self.requests = []
+        record = np.dtype([("f%d" % i, d._data.dtype, d._data.shape[1:])
+                           for i, d in enumerate(dats)])
+        self.fields = record.names
+        size = record.itemsize
+        send_raw = np.empty(len(pattern.send_indices) * size, dtype=np.uint8)
+        recv_raw = np.empty(len(pattern.recv_indices) * size, dtype=np.uint8)
+        self.send_buf = send_raw.view(record)
+        self.recv_buf = recv_raw.view(record)
+        if configuration["halo_neighbourhood"]:
+            self.neighbourhood = True
+            self.send_spec = [send_raw, (np.diff(pattern.send_offsets) * size,
+                                         pattern.send_offsets[:-1] * size), MPI.BYTE]
+            self.recv_spec = [recv_raw, (np.diff(pattern.recv_offsets) * size,
+                                         pattern.recv_offsets[:-1] * size), MPI.BYTE]
+        else:
+            self.neighbourhood = False
+            comm = pattern.comm
+            # Tags need only tell apart exchanges in flight at the same
+            # time, which never share their first Dat.
+            tag = dats[0]._id
+            offsets = pattern.recv_offsets * size
+            for i, source in enumerate(pattern.sources):
+                self.requests.append(comm.Recv_init(recv_raw[offsets[i]:offsets[i+1]],
+                                                    source=source, tag=tag))
+            offsets = pattern.send_offsets * size
+            for i, dest in enumerate(pattern.destinations):
+                self.requests.append(comm.Send_init(send_raw[offsets[i]:offsets[i+1]],
+                                                    dest=dest, tag=tag))
+
+    def free(self):
+        """Free the requests of the exchange."""
+        if not MPI.Is_finalized():
+            for request in self.requests:
+                if request != MPI.REQUEST_NULL:
+                    request.Free()
+        self.requests = []
+
+    def __del__(self):
+        self.free()
+
+    def begin(self, data):
+        """Pack ``data`` and start the exchange.
+
+        :arg data: The data arrays of the exchanged Dats."""
+        indices = self.pattern.send_indices
+        for field, d in zip(self.fields, data):
+            np.take(d, indices, axis=0, out=self.send_buf[field], mode='clip')
+        if self.neighbourhood:
+            self.requests = [self.pattern.graph_comm.Ineighbor_alltoallv(self.send_spec,
+                                                                         self.recv_spec)]
+        else:
+            MPI.Prequest.Startall(self.requests)
+
+    def end(self, data, reverse=False):
+        """Complete the exchange and unpack into ``data``.
+
+        :arg data: The data arrays of the exchanged Dats.
+        :kwarg reverse: if True, add the received values to ``data``
+            rather than overwriting it."""
+        with timed_region("Halo exchange wait"):
+            MPI.Request.Waitall(self.requests)
+        indices = self.pattern.recv_indices
+        for field, d in zip(self.fields, data):
+            values = self.recv_buf[field]
+            maybe_setflags(d, write=True)
+            if not reverse:
+                d[indices] = values
+            elif self.pattern.unique_receives:
+                d[indices] += values
+            else:
+                np.add.at(d, indices, values)
+            maybe_setflags(d, write=False)
+
+
+def _halo_groups(dats):
+    """Group :class:`Dat`\s, and the components of :class:`MixedDat`\s,
+    by :class:`Halo`, for exchanging together.
+
+    :arg dats: An iterable of :class:`Dat`\s.
+    :returns: a list of ``(halo, dat)`` pairs, where ``dat`` is a
+        tuple of :class:`Dat`\s for :class:`Halo`\s, or a single
+        :class:`Dat` for other halo implementations."""
+    groups = []
+    batches = {}
+    seen = set()
+    for dat in dats:
+        for d in dat:
+            halo = d.dataset.halo
+            if halo is None or id(d) in seen:
+                continue
+            seen.add(id(d))
+            if not isinstance(halo, Halo):
+                groups.append((halo, d))
+            elif halo in batches:
+                batches[halo].append(d)
+            else:
+                batches[halo] = [d]
+                groups.append((halo, batches[halo]))
+    return [(halo, tuple(d) if isinstance(d, list) else d) for halo, d in groups]
+
+
+@collective
+def _halo_exchange_begin(dats, reverse=False):
+    """Begin halo exchanges of :class:`Dat`\s, sending a single
+    message per neighbour for all Dats sharing a :class:`Halo`."""
+    for halo, dat in _halo_groups(dats):
+        halo.begin(dat, reverse=reverse)
+
+
+@collective
+def _halo_exchange_end(dats, reverse=False):
+    """End halo exchanges started by :func:`_halo_exchange_begin`."""
+    for halo, dat in _halo_groups(dats):
+        halo.end(dat, reverse=reverse)
+
+
 class IterationSpace(object):
 
     """OP2 iteration space type.
@@ -1710,6 +2209,132 @@ class _EmptyDataMixin(object):
         return hasattr(self, '_numpy_data')
 
 
+class _DatExpression(object):
+
+    """A pointwise expression over :class:`Dat`\s and :class:`Global`\s
+    (scalars), see :meth:`Dat._defer`.
+
+    :arg op: The C operator (``"+"``, ``"-"``, ``"*"``, ``"/"``, or
+        ``"neg"`` for unary minus).
+    :arg operands: The operands, :class:`_DatExpression`\s,
+        :class:`Dat`\s or :class:`Global`\s.
+    :arg dtype: The type of the result, intermediate results are cast
+        to it as if they had been stored in a :class:`Dat`.
+    """
+
+    def __init__(self, op, operands, dtype):
+        self.op = op
+        self.operands = operands
+        self.dtype = np.dtype(dtype)
+        # Leaves, in order of appearance, without duplicates
+        leaves = []
+        for o in operands:
+            for leaf in (o.leaves if isinstance(o, _DatExpression) else (o, )):
+                if not any(leaf is x for x in leaves):
+                    leaves.append(leaf)
+        self.leaves = tuple(leaves)
+        self.reads = set((x._parent if isinstance(x, DatView) else x) for x in leaves)
+
+    def code(self, leaves):
+        """C code evaluating component ``n`` of this expression.
+
+        :arg leaves: The list of leaves already passed to the kernel,
+            as ``a0``, ``a1``, ...  New leaves are appended."""
+        ops = [_expression_code(o, leaves) for o in self.operands]
+        if self.op == "neg":
+            code = "-%s" % ops[0]
+        else:
+            code = "%s %s %s" % (ops[0], self.op, ops[1])
+        return "((%s)(%s))" % (as_cstr(self.dtype), code)
+
+
+def _as_expression(x):
+    """The deferred expression of ``x`` if it has one, otherwise ``x``."""
+    return getattr(x, "_deferred_expression", None) or x
+
+
+def _expression_code(x, leaves):
+    """C code evaluating component ``n`` of the expression or leaf ``x``."""
+    if isinstance(x, _DatExpression):
+        return x.code(leaves)
+    for i, l in enumerate(leaves):
+        if l is x:
+            break
+    else:
+        leaves.append(x)
+        i = len(leaves) - 1
+    return "a%d[%s]" % (i, "0" if isinstance(x, Global) else "n")
+
+
+def _expression_par_loop(name, iterset, cdim, ret, access, statement, expressions):
+    """Execute a direct :func:`par_loop` evaluating expressions.
+
+    :arg iterset: The :class:`Set` to iterate over.
+    :arg cdim: The number of components of each element.
+    :arg ret: The :class:`Dat` or :class:`Global` written, ``a0`` in
+        ``statement``.
+    :arg access: The access descriptor of ``ret``.
+    :arg statement: A C statement for component ``n``, in which the
+        ``%s`` are replaced by the code of the ``expressions``.
+    :arg expressions: :class:`_DatExpression`\s or leaves.
+
+    All other leaves are read."""
+    leaves = [ret]
+    statement = statement % tuple(_expression_code(e, leaves) for e in expressions)
+    decls = ", ".join("%s%s *a%d" % ("const " if i else "", x.ctype, i)
+                      for i, x in enumerate(leaves))
+    code = """void %(name)s(%(decls)s) {
+  for ( int n = 0; n < %(cdim)d; ++n ) {
+    %(statement)s;
+  }
+}""" % {"name": name, "decls": decls, "cdim": cdim, "statement": statement}
+    k = _make_object('Kernel', code, name)
+    par_loop(k, iterset, ret(access), *[x(READ) for x in leaves[1:]])
+
+
+@collective
+def inner_products(pairs):
+    """Compute the l2 inner products of several pairs of :class:`Dat`\s
+    (or :class:`MixedDat`\s) at once.
+
+    The products of all pairs on the same :class:`DataSet` are computed
+    in a single pass over the data, and the reductions of all products
+    in a single allreduce.  For example, the reductions of a CG
+    iteration, including a norm, are ::
+
+        rz, pAp, rr = inner_products([(r, z), (p, Ap), (r, r)])
+        rnorm = sqrt(rr)
+
+    :arg pairs: An iterable of pairs of :class:`Dat`\s.
+    :returns: A list of the inner products, in the order of ``pairs``.
+    """
+    pairs = list(pairs)
+    # Products of components of MixedDats are summed
+    products = OrderedDict()
+    for k, (a, b) in enumerate(pairs):
+        a._check_shape(b)
+        for x, y in zip(a, b):
+            products.setdefault(x.dataset, []).append((k, x, y))
+    results = [0] * len(pairs)
+    rets = []
+    for dataset, prods in six.iteritems(products):
+        dtype = np.result_type(*[x.dtype for _, x, _ in prods])
+        ret = _make_object('Global', len(prods), data=np.zeros(len(prods)), dtype=dtype)
+        statement = "; ".join("a0[%d] += %%s * %%s" % j for j in range(len(prods)))
+        expressions = []
+        for _, x, y in prods:
+            expressions.extend([_as_expression(x), _as_expression(y)])
+        _expression_par_loop("inner_products", dataset.set, dataset.cdim, ret, INC,
+                             statement, expressions)
+        rets.append(ret)
+    # Evaluate all loops together, combining their reductions
+    _trace.evaluate(rets, None)
+    for ret, prods in zip(rets, six.itervalues(products)):
+        for j, (k, _, _) in enumerate(prods):
+            results[k] += ret._data[j]
+    return results
+
+
 class Dat(DataCarrier, _EmptyDataMixin):
     """OP2 vector data. A :class:`Dat` holds values on every element of a
     :class:`DataSet`.
@@ -1749,6 +2374,7 @@ class Dat(DataCarrier, _EmptyDataMixin):
 
     _globalcount = 0
     _modes = [READ, WRITE, RW, INC]
+    _deferred_expression = None
 
     @validate_type(('dataset', (DataCarrier, DataSet, Set), DataSetTypeError),
                    ('name', str, NameTypeError))
@@ -1783,10 +2409,7 @@ class Dat(DataCarrier, _EmptyDataMixin):
         self._name = name or "dat_%d" % self._id
         halo = dataset.halo
         if halo is not None:
-            self._send_reqs = {}
-            self._send_buf = {}
-            self._recv_reqs = {}
-            self._recv_buf = {}
+            self._halo_exchanges = {}
 
     @validate_in(('access', _modes, ModeValueError))
     def __call__(self, access, path=None):
@@ -1914,13 +2537,36 @@ class Dat(DataCarrier, _EmptyDataMixin):
         v.setflags(write=False)
         return v
 
+    @collective
     def save(self, filename):
-        """Write the data array to file ``filename`` in NumPy format."""
-        np.save(filename, self.data_ro)
+        """Write the owned values to file ``filename`` in NumPy format.
+
+        The values are written straight from the data buffer, without
+        intermediate copies.  The components of a :class:`MixedDat`
+        are written one after the other, as a flat array."""
+        # Like np.save, append the extension if not supplied.
+        if filename[-4:] != ".npy":
+            filename = filename + ".npy"
+        arrays = [d.data_ro for d in self]
+        if len(arrays) == 1:
+            shape = arrays[0].shape
+        else:
+            shape = (sum(a.size for a in arrays), )
+        header = {"descr": np.lib.format.dtype_to_descr(self.dtype),
+                  "fortran_order": False,
+                  "shape": shape}
+        with open(filename, "wb") as f:
+            np.lib.format.write_array_header_1_0(f, header)
+            for a in arrays:
+                a.tofile(f)
 
+    @collective
     def load(self, filename):
         """Read the data stored in file ``filename`` into a NumPy array
         and store the values in :meth:`_data`.
+
+        The file is memory mapped, such that values are copied into
+        place without reading the whole file into memory first.
         """
         # The np.save method appends a .npy extension to the file name
         # if the user has not supplied it. However, np.load does not,
@@ -1928,12 +2574,16 @@ class Dat(DataCarrier, _EmptyDataMixin):
         if(filename[-4:] != ".npy"):
             filename = filename + ".npy"
 
+        values = np.load(filename, mmap_mode="r")
         if isinstance(self.data, tuple):
-            # MixedDat case
-            for d, d_from_file in zip(self.data, np.load(filename)):
-                d[:] = d_from_file[:]
+            # MixedDat case, components are stored one after the other
+            values = values.reshape(-1)
+            offset = 0
+            for d in self.data:
+                d.reshape(-1)[:] = values[offset:offset + d.size]
+                offset += d.size
         else:
-            self.data[:] = np.load(filename)
+            self.data[:] = values
 
     @cached_property
     def shape(self):
@@ -2031,90 +2681,65 @@ class Dat(DataCarrier, _EmptyDataMixin):
             raise ValueError('Mismatched shapes in operands %s and %s',
                              self.dataset.dim, other.dataset.dim)
 
+    def _defer(self, expression):
+        """Defer the computation of the values of this :class:`Dat`,
+        given by ``expression``.
+
+        Nothing is executed until the values are used (or the data
+        the expression reads are about to be modified), at which
+        point the whole expression is evaluated by a single direct
+        :func:`par_loop`.  Expressions using deferred :class:`Dat`\s
+        inline their expressions, so that compound expressions such
+        as ``a*x + b*y - z`` need no intermediate :class:`Dat`\s."""
+        self._deferred_expression = expression
+        _trace.defer(self)
+
+    def _materialise(self):
+        """Enqueue the :func:`par_loop` computing the deferred
+        expression of this :class:`Dat`."""
+        expression = self._deferred_expression
+        self._deferred_expression = None
+        _trace._deferred.discard(self)
+        _expression_par_loop("expression", self.dataset.set, self.cdim,
+                             self, WRITE, "a0[n] = %s", [expression])
+
+    def _operand(self, other):
+        """Convert ``other`` to an operand of an expression."""
+        if np.isscalar(other):
+            return _make_object('Global', 1, data=other)
+        self._check_shape(other)
+        return _as_expression(other)
+
     def _op(self, other, op):
-        ops = {operator.add: ast.Sum,
-               operator.sub: ast.Sub,
-               operator.mul: ast.Prod,
-               operator.truediv: ast.Div}
+        ops = {operator.add: "+",
+               operator.sub: "-",
+               operator.mul: "*",
+               operator.truediv: "/"}
+        other = self._operand(other)
         ret = _make_object('Dat', self.dataset, None, self.dtype)
-        name = "binop_%s" % op.__name__
-        if np.isscalar(other):
-            other = _make_object('Global', 1, data=other)
-            k = ast.FunDecl("void", name,
-                            [ast.Decl(self.ctype, ast.Symbol("self"),
-                                      qualifiers=["const"], pointers=[""]),
-                             ast.Decl(other.ctype, ast.Symbol("other"),
-                                      qualifiers=["const"], pointers=[""]),
-                             ast.Decl(self.ctype, ast.Symbol("ret"), pointers=[""])],
-                            ast.c_for("n", self.cdim,
-                                      ast.Assign(ast.Symbol("ret", ("n", )),
-                                                 ops[op](ast.Symbol("self", ("n", )),
-                                                         ast.Symbol("other", ("0", )))),
-                                      pragma=None))
-
-            k = _make_object('Kernel', k, name)
-        else:
-            self._check_shape(other)
-            k = ast.FunDecl("void", name,
-                            [ast.Decl(self.ctype, ast.Symbol("self"),
-                                      qualifiers=["const"], pointers=[""]),
-                             ast.Decl(other.ctype, ast.Symbol("other"),
-                                      qualifiers=["const"], pointers=[""]),
-                             ast.Decl(self.ctype, ast.Symbol("ret"), pointers=[""])],
-                            ast.c_for("n", self.cdim,
-                                      ast.Assign(ast.Symbol("ret", ("n", )),
-                                                 ops[op](ast.Symbol("self", ("n", )),
-                                                         ast.Symbol("other", ("n", )))),
-                                      pragma=None))
-
-            k = _make_object('Kernel', k, name)
-        par_loop(k, self.dataset.set, self(READ), other(READ), ret(WRITE))
+        ret._defer(_DatExpression(ops[op], (_as_expression(self), other), self.dtype))
         return ret
 
     def _iop(self, other, op):
-        ops = {operator.iadd: ast.Incr,
-               operator.isub: ast.Decr,
-               operator.imul: ast.IMul,
-               operator.itruediv: ast.IDiv}
-        name = "iop_%s" % op.__name__
-        if np.isscalar(other):
-            other = _make_object('Global', 1, data=other)
-            k = ast.FunDecl("void", name,
-                            [ast.Decl(self.ctype, ast.Symbol("self"), pointers=[""]),
-                             ast.Decl(other.ctype, ast.Symbol("other"),
-                                      qualifiers=["const"], pointers=[""])],
-                            ast.c_for("n", self.cdim,
-                                      ops[op](ast.Symbol("self", ("n", )),
-                                              ast.Symbol("other", ("0", ))),
-                                      pragma=None))
-            k = _make_object('Kernel', k, name)
+        ops = {operator.iadd: "+",
+               operator.isub: "-",
+               operator.imul: "*",
+               operator.itruediv: "/"}
+        other = self._operand(other)
+        expression = _DatExpression(ops[op], (_as_expression(self), other), self.dtype)
+        if self._deferred_expression is not None:
+            # Nobody has seen the values yet, just update the expression
+            self._deferred_expression = expression
         else:
-            self._check_shape(other)
-            quals = ["const"] if self is not other else []
-            k = ast.FunDecl("void", name,
-                            [ast.Decl(self.ctype, ast.Symbol("self"), pointers=[""]),
-                             ast.Decl(other.ctype, ast.Symbol("other"),
-                                      qualifiers=quals, pointers=[""])],
-                            ast.c_for("n", self.cdim,
-                                      ops[op](ast.Symbol("self", ("n", )),
-                                              ast.Symbol("other", ("n", ))),
-                                      pragma=None))
-            k = _make_object('Kernel', k, name)
-        par_loop(k, self.dataset.set, self(INC), other(READ))
+            _expression_par_loop("iexpression", self.dataset.set, self.cdim,
+                                 self, RW, "a0[n] = %s", [expression])
         return self
 
     def _uop(self, op):
-        ops = {operator.sub: ast.Neg}
-        name = "uop_%s" % op.__name__
-        k = ast.FunDecl("void", name,
-                        [ast.Decl(self.ctype, ast.Symbol("self"), pointers=[""])],
-                        ast.c_for("n", self.cdim,
-                                  ast.Assign(ast.Symbol("self", ("n", )),
-                                             ops[op](ast.Symbol("self", ("n", )))),
-                                  pragma=None))
-        k = _make_object('Kernel', k, name)
-        par_loop(k, self.dataset.set, self(RW))
-        return self
+        ops = {operator.neg: "neg"}
+        ret = _make_object('Dat', self.dataset, None, self.dtype)
+        ret._defer(_DatExpression(ops[op], (_as_expression(self), ), self.dtype))
+        return ret
 
     def inner(self, other):
         """Compute the l2 inner product of the flattened :class:`Dat`
@@ -2125,20 +2750,9 @@ class Dat(DataCarrier, _EmptyDataMixin):
         """
         self._check_shape(other)
         ret = _make_object('Global', 1, data=0, dtype=self.dtype)
-
-        k = ast.FunDecl("void", "inner",
-                        [ast.Decl(self.ctype, ast.Symbol("self"),
-                                  qualifiers=["const"], pointers=[""]),
-                         ast.Decl(other.ctype, ast.Symbol("other"),
-                                  qualifiers=["const"], pointers=[""]),
-                         ast.Decl(self.ctype, ast.Symbol("ret"), pointers=[""])],
-                        ast.c_for("n", self.cdim,
-                                  ast.Incr(ast.Symbol("ret", (0, )),
-                                           ast.Prod(ast.Symbol("self", ("n", )),
-                                                    ast.Symbol("other", ("n", )))),
-                                  pragma=None))
-        k = _make_object('Kernel', k, "inner")
-        par_loop(k, self.dataset.set, self(READ), other(READ), ret(INC))
+        _expression_par_loop("inner", self.dataset.set, self.cdim, ret, INC,
+                             "a0[0] += %s * %s",
+                             [_as_expression(self), _as_expression(other)])
         return ret.data_ro[0]
 
     @property
@@ -2166,8 +2780,7 @@ class Dat(DataCarrier, _EmptyDataMixin):
         return self + other
 
     def __neg__(self):
-        neg = _make_object('Dat', self)
-        return neg._uop(operator.sub)
+        return self._uop(operator.neg)
 
     def __sub__(self, other):
         """Pointwise subtraction of fields."""
@@ -2242,10 +2855,18 @@ class Dat(DataCarrier, _EmptyDataMixin):
         halo.end(self, reverse=reverse)
 
     @classmethod
-    def fromhdf5(cls, dataset, f, name):
-        """Construct a :class:`Dat` from a Dat named ``name`` in HDF5 data ``f``"""
+    def fromhdf5(cls, dataset, f, name, indices=None, mmap=False):
+        """Construct a :class:`Dat` from a Dat named ``name`` in HDF5 data ``f``
+
+        :arg indices: The rows of the HDF5 dataset holding the owned
+            and halo entries of ``dataset`` on this process, in local
+            order.  Defaults to all rows.
+        :arg mmap: Back the :class:`Dat` by a (copy on write) memory
+            map of the file, rather than reading it, when possible.
+
+        See :func:`_hdf5_read`."""
         slot = f[name]
-        data = slot.value
+        data = _hdf5_read(slot, indices=indices, mmap=mmap)
         soa = slot.attrs['type'].find(':soa') > 0
         ret = cls(dataset, data, name=name, soa=soa)
         return ret
@@ -2411,13 +3032,11 @@ class MixedDat(Dat):
 
     @collective
     def halo_exchange_begin(self, reverse=False):
-        for s in self._dats:
-            s.halo_exchange_begin(reverse)
+        _halo_exchange_begin([self], reverse=reverse)
 
     @collective
     def halo_exchange_end(self, reverse=False):
-        for s in self._dats:
-            s.halo_exchange_end(reverse)
+        _halo_exchange_end([self], reverse=reverse)
 
     @collective
     def zero(self, subset=None):
@@ -2486,10 +3105,7 @@ class MixedDat(Dat):
         """Compute the l2 inner product.
 
         :arg other: the other :class:`MixedDat` to compute the inner product against"""
-        ret = 0
-        for s, o in zip(self, other):
-            ret += s.inner(o)
-        return ret
+        return inner_products([(self, other)])[0]
 
     def _op(self, other, op):
         ret = []
@@ -2838,7 +3454,7 @@ class Map(object):
         # entries negative.
         self._parent = parent
         # A cache for objects built on top of this map
-        self._cache = {}
+        self._cache = LRUCache()
         # Which indices in the extruded map should be masked out for
         # the application of strong boundary conditions
         self._bottom_mask = {}
@@ -2982,13 +3598,18 @@ class Map(object):
         return self == o or (isinstance(self._parent, Map) and self._parent <= o)
 
     @classmethod
-    def fromhdf5(cls, iterset, toset, f, name):
-        """Construct a :class:`Map` from set named ``name`` in HDF5 data ``f``"""
+    def fromhdf5(cls, iterset, toset, f, name, indices=None):
+        """Construct a :class:`Map` from set named ``name`` in HDF5 data ``f``
+
+        :arg indices: The rows of the HDF5 dataset holding the entries
+            of ``iterset`` on this process, in local order.  Defaults
+            to all rows.  The values are used as stored, they must be
+            local numbers of ``toset``."""
         slot = f[name]
-        values = slot.value
         arity = slot.shape[1:]
         if len(arity) != 1:
             raise ArityTypeError("Unrecognised arity value %s" % arity)
+        values = _hdf5_read(slot, indices=indices)
         return cls(iterset, toset, arity[0], values, name)
 
 
@@ -3198,6 +3819,85 @@ class MixedMap(Map, ObjectCached):
         return "MixedMap(%r)" % (self._maps,)
 
 
+_sparsity_arrays = ("rowptr", "colidx", "d_nnz", "o_nnz")
+
+
+def _sparsity_digest(sparsity):
+    """A digest of everything :func:`build_sparsity` reads to build
+    the pattern of ``sparsity`` on this process: the values, arities
+    and offsets of its maps, the sizes of the sets involved and the
+    block flag."""
+    hsh = md5()
+    hsh.update(six.b(str((version, np.dtype(IntType).str, sparsity.comm.size,
+                          sparsity.comm.rank, sparsity._block_sparse,
+                          sparsity._has_diagonal))))
+    for dset in sparsity.dsets:
+        hsh.update(six.b(str([(d.cdim, d.size, d.total_size) for d in dset])))
+    for rmap, cmap in zip(sparsity.rmaps, sparsity.cmaps):
+        for m in itertools.chain(rmap, cmap):
+            if m is None:
+                hsh.update(six.b("None"))
+                continue
+            it = m.iterset
+            hsh.update(six.b(str((m.arity, it.exec_size, it._extruded,
+                                  it.layers if it._extruded else None,
+                                  m.toset.size, m.toset.total_size,
+                                  sorted(r.where for r in m.iteration_region)))))
+            hsh.update(np.ascontiguousarray(m.values_with_halo).data)
+            if m.offset is not None:
+                hsh.update(np.ascontiguousarray(m.offset).data)
+    return hsh.hexdigest()
+
+
+_sparsity_patterns = {}
+"""Sparsity patterns supplied ahead of construction (for instance
+when restarting from a checkpoint), keyed on :func:`_sparsity_digest`.
+Entries are removed when used."""
+
+
+def _build_sparsity_cached(sparsity, parallel, block):
+    """Build the pattern of ``sparsity``, going through the supplied
+    patterns and the on-disk sparsity cache.
+
+    On a hit the stored arrays are memory-mapped (copy on write), on
+    a miss the pattern is built with :func:`build_sparsity` and
+    stored.  Each process stores the pattern of its own rows, so no
+    communication is required."""
+    key = _sparsity_digest(sparsity)
+    dirname = os.path.join(configuration["cache_dir"], "sparsity", key)
+    arrays = _sparsity_patterns.pop(key, None)
+    if arrays is None and configuration["sparsity_cache"]:
+        try:
+            arrays = [np.load(os.path.join(dirname, "%s.npy" % name), mmap_mode="c")
+                      for name in _sparsity_arrays]
+        except (IOError, OSError, ValueError):
+            arrays = None
+    if arrays is not None:
+        sparsity._rowptr, sparsity._colidx, sparsity._d_nnz, sparsity._o_nnz = arrays
+        sparsity._d_nz = int(sparsity._d_nnz.sum())
+        sparsity._o_nz = int(sparsity._o_nnz.sum())
+        return
+    build_sparsity(sparsity, parallel=parallel, block=block)
+    if not configuration["sparsity_cache"]:
+        return
+    parent = os.path.dirname(dirname)
+    tmpname = None
+    try:
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        tmpname = tempfile.mkdtemp(dir=parent)
+        for name in _sparsity_arrays:
+            np.save(os.path.join(tmpname, "%s.npy" % name),
+                    getattr(sparsity, "_%s" % name))
+        # Atomically publish the entry
+        os.rename(tmpname, dirname)
+    except (IOError, OSError):
+        # Someone else got there first, or we can't write: the cache
+        # is only an optimisation
+        if tmpname is not None:
+            shutil.rmtree(tmpname, ignore_errors=True)
+
+
 class Sparsity(ObjectCached):
 
     """OP2 Sparsity, the non-zero structure a matrix derived from the union of
@@ -3308,14 +4008,31 @@ class Sparsity(ObjectCached):
                 if isinstance(dset, MixedDataSet) and any([isinstance(d, GlobalDataSet) for d in dset]):
                     raise SparsityFormatError("Mixed monolithic matrices with Global rows or columns are not supported.")
             with timed_region("CreateSparsity"):
-                build_sparsity(self, parallel=(self.comm.size > 1),
-                               block=self._block_sparse)
+                if configuration["sparsity_cache"] or _sparsity_patterns:
+                    _build_sparsity_cached(self, parallel=(self.comm.size > 1),
+                                           block=self._block_sparse)
+                else:
+                    build_sparsity(self, parallel=(self.comm.size > 1),
+                                   block=self._block_sparse)
             self._blocks = [[self]]
             self._nested = False
         self._initialized = True
 
-    _cache = {}
+    _cache = LRUCache()
     _globalcount = 0
+    # Nothing compares sparsities by identity, rebuilding one is safe
+    _cache_evictable = True
+
+    @property
+    def _cache_nbytes(self):
+        """Memory held by the sparsity pattern, for cache accounting."""
+        nbytes = 0
+        for name in ("_rowptr", "_colidx", "_d_nnz", "_o_nnz"):
+            arrays = getattr(self, name, None)
+            for a in (arrays if isinstance(arrays, tuple) else (arrays, )):
+                if isinstance(a, np.ndarray):
+                    nbytes += a.nbytes
+        return nbytes
 
     @classmethod
     @validate_type(('dsets', (Set, DataSet, tuple, list), DataSetTypeError),
@@ -3644,6 +4361,23 @@ class Mat(DataCarrier):
         raise NotImplementedError(
             "Abstract Mat base class doesn't know how to set values.")
 
+    def addto_values_batched(self, rows, cols, values):
+        """Add the blocks of values of a batch of elements to the :class:`Mat`.
+
+        :arg rows: A ``(nelements, rarity)`` array of (block) rows.
+        :arg cols: A ``(nelements, carity)`` array of (block) columns.
+        :arg values: A ``(nelements, rarity*rdim, carity*cdim)`` array
+            of values.
+        """
+        raise NotImplementedError(
+            "Abstract Mat base class doesn't know how to set values.")
+
+    def set_values_batched(self, rows, cols, values):
+        """Set the blocks of values of a batch of elements in the
+        :class:`Mat`, see :meth:`addto_values_batched`."""
+        raise NotImplementedError(
+            "Abstract Mat base class doesn't know how to set values.")
+
     @cached_property
     def _argtype(self):
         """Ctypes argtype for this :class:`Mat`"""
@@ -3782,6 +4516,9 @@ class Kernel(Cached):
     :param cpp: Is the kernel actually C++ rather than C?  If yes,
         then compile with the C++ compiler (kernel is wrapped in
         extern C for linkage reasons).
+    :param batch: If given, the kernel is called once for each batch of
+        up to ``batch`` elements, rather than once per element (see
+        below).
 
     Consider the case of initialising a :class:`~pyop2.Dat` with seeded random
     values in the interval 0 to 1. The corresponding :class:`~pyop2.Kernel` is
@@ -3794,15 +4531,36 @@ class Kernel(Cached):
     .. note::
         When running in parallel with MPI the generated code must be the same
         on all ranks.
+
+    A batched kernel takes the number of elements ``nb`` in the batch
+    as its first argument.  Each :class:`~pyop2.Dat` argument is then
+    passed as a scratch array of shape ``[n][OP2_BATCH]``, ``n`` being
+    the number of values per element, with the values of element ``b``
+    of the batch in column ``b``.  The macro ``OP2_BATCH`` is defined
+    to the batch size while compiling the kernel, so that loops over
+    the batch can be vectorised across elements: ::
+
+      op2.Kernel('''
+      void axpy(int nb, double x[][OP2_BATCH], double y[][OP2_BATCH])
+      {
+        for (int k = 0; k < 3; k++)
+          for (int b = 0; b < nb; b++)
+            y[k][b] += 2.0 * x[k][b];
+      }''', "axpy", batch=8)
+
+    Batched kernels support direct and indirect access to
+    :class:`~pyop2.Dat`\s, and :class:`~pyop2.Global`\s, on sets that
+    are not extruded.
     """
 
     _globalcount = 0
-    _cache = {}
+    _cache = LRUCache()
+    _batch = None
 
     @classmethod
     @validate_type(('name', str, NameTypeError))
     def _cache_key(cls, code, name, opts={}, include_dirs=[], headers=[],
-                   user_code="", ldargs=None, cpp=False):
+                   user_code="", ldargs=None, cpp=False, batch=None):
         # Both code and name are relevant since there might be multiple kernels
         # extracting different functions from the same code
         # Also include the PyOP2 version, since the Kernel class might change
@@ -3810,9 +4568,11 @@ class Kernel(Cached):
         # HACK: Temporary fix!
         if isinstance(code, Node):
             code = code.gencode()
-        return md5(six.b(str(hash(code)) + name + str(opts) + str(include_dirs) +
-                         str(headers) + version + str(configuration['loop_fusion']) +
-                         str(ldargs) + str(cpp))).hexdigest()
+        # Hash the code itself rather than its (randomised) Python hash,
+        # so that the key is stable across processes.
+        return md5((code + name + str(opts) + str(include_dirs) +
+                    str(headers) + version + str(configuration['loop_fusion']) +
+                    str(ldargs) + str(cpp) + str(batch)).encode("utf-8")).hexdigest()
 
     def _ast_to_c(self, ast, opts={}):
         """Transform an Abstract Syntax Tree representing the kernel into a
@@ -3820,12 +4580,13 @@ class Kernel(Cached):
         return ast.gencode()
 
     def __init__(self, code, name, opts={}, include_dirs=[], headers=[],
-                 user_code="", ldargs=None, cpp=False):
+                 user_code="", ldargs=None, cpp=False, batch=None):
         # Protect against re-initialization when retrieved from cache
         if self._initialized:
             return
         self._name = name or "kernel_%d" % Kernel._globalcount
         self._cpp = cpp
+        self._batch = batch
         Kernel._globalcount += 1
         # Record used optimisations
         self._opts = opts
@@ -3878,6 +4639,31 @@ class Kernel(Cached):
         return self.cache_key == other.cache_key
 
 
+_source_digests = {}
+
+
+def _source_digest(cls):
+    """Digest of the source files defining ``cls`` and its bases, such
+    that generated code is not reused across changes to PyOP2."""
+    try:
+        return _source_digests[cls]
+    except KeyError:
+        pass
+    import sys
+    hsh = md5()
+    for c in cls.__mro__:
+        fname = getattr(sys.modules.get(c.__module__), "__file__", None)
+        if fname is None:
+            continue
+        fname = os.path.splitext(fname)[0] + ".py"
+        try:
+            with open(fname, "rb") as f:
+                hsh.update(f.read())
+        except IOError:
+            hsh.update(fname.encode("utf-8"))
+    return _source_digests.setdefault(cls, hsh.hexdigest())
+
+
 class JITModule(Cached):
 
     """Cached module encapsulating the generated :class:`ParLoop` stub.
@@ -3888,7 +4674,7 @@ class JITModule(Cached):
        should not hold any references to objects you might want to be
        collected (such PyOP2 data objects)."""
 
-    _cache = {}
+    _cache = LRUCache()
 
     @classmethod
     def _cache_key(cls, kernel, itspace, *args, **kwargs):
@@ -3926,8 +4712,30 @@ class JITModule(Cached):
         if iterate is not None:
             key += ((iterate,))
 
+        columns = kwargs.get("columns", None)
+        if columns is not None:
+            key += (columns, )
+
         return key
 
+    def _persistent_key(self, *extra):
+        """A digest of the cache key of this module that is stable across
+        processes, used to look up compiled code in the on-disk index.
+
+        :arg extra: further (repr-able) values the generated code depends on.
+
+        Returns ``None`` if the persistent index is disabled or no
+        stable key can be built."""
+        if not configuration['jit_index'] or configuration['debug'] or \
+           configuration['dump_gencode'] or self._key is None:
+            return None
+        key = repr((type(self).__module__, type(self).__name__, version,
+                    _source_digest(type(self)), self._key) + extra)
+        # Default object reprs contain addresses, these are not stable
+        if " at 0x" in key:
+            return None
+        return md5(key.encode("utf-8")).hexdigest()
+
     def _dump_generated_code(self, src, ext=None):
         """Write the generated code to a file for debugging purposes.
 
@@ -4093,18 +4901,103 @@ class ParLoop(LazyComputation):
         return ()
 
     @cached_property
-    def num_flops(self):
+    def _layers(self):
+        """The number of kernel invocations per element of the
+        iteration set."""
         iterset = self.iterset
-        size = iterset.size
-        if self.needs_exec_halo:
-            size = iterset.exec_size
         if self.is_indirect and iterset._extruded:
             region = self.iteration_region
             if region is ON_INTERIOR_FACETS:
-                size *= iterset.layers - 2
+                return iterset.layers - 2
             elif region not in [ON_TOP, ON_BOTTOM]:
-                size *= iterset.layers - 1
-        return size * self._kernel.num_flops
+                return iterset.layers - 1
+        return 1
+
+    @cached_property
+    def _elements(self):
+        """The number of kernel invocations of one execution."""
+        iterset = self.iterset
+        size = iterset.size
+        if self.needs_exec_halo:
+            size = iterset.exec_size
+        return size * self._layers
+
+    @cached_property
+    def num_flops(self):
+        return self._elements * self._kernel.num_flops
+
+    @cached_property
+    def _data_movement(self):
+        """Bytes read and written by one execution, see
+        :attr:`nbytes_read` and :attr:`nbytes_written`."""
+        read, written = 0, 0
+        index = np.dtype(IntType).itemsize
+        columns = self._elements // self._layers if self._layers else 0
+        for arg in self.args:
+            if arg._is_global:
+                continue
+            if arg._is_mat:
+                rmap, cmap = arg.map
+                for i, rm in enumerate(rmap):
+                    for j, cm in enumerate(cmap):
+                        rdim, cdim = arg.data.dims[i][j]
+                        written += (self._elements * rm.arity * rdim * cm.arity *
+                                    cdim * arg.data.dtype.itemsize)
+                read += columns * (rmap.arity + cmap.arity) * index
+                continue
+            maps = arg.map if arg.map is not None else [None] * len(arg.data)
+            for d, m in zip(arg.data, maps):
+                n = m.arity if m is not None and (arg._is_vec_map or arg._uses_itspace) else 1
+                nbytes = self._elements * n * d.cdim * d.dtype.itemsize
+                # Values are read unless only written, and written back
+                # unless only read.  Map entries are loaded once per
+                # column of an extruded set.
+                if arg.access is not WRITE:
+                    read += nbytes
+                if arg.access is not READ:
+                    written += nbytes
+                if m is not None:
+                    read += columns * n * index
+        return read, written
+
+    @property
+    def nbytes_read(self):
+        """Estimate of the bytes read by one execution of the loop.
+
+        Counts the values of all :class:`Dat` arguments (and map
+        entries) accessed by each kernel invocation, assuming that
+        indirectly accessed data is not reused between invocations.
+        :class:`Global`\s are not counted."""
+        return self._data_movement[0]
+
+    @property
+    def nbytes_written(self):
+        """Estimate of the bytes written by one execution of the loop,
+        see :attr:`nbytes_read`.  :class:`Mat` arguments count the
+        element matrices inserted."""
+        return self._data_movement[1]
+
+    @property
+    def nbytes(self):
+        """Estimate of the bytes moved by one execution of the loop."""
+        return sum(self._data_movement)
+
+    @property
+    def arithmetic_intensity(self):
+        """The ratio of :attr:`num_flops` to :attr:`nbytes`, in flops
+        per byte, for placing the loop on a roofline plot."""
+        nbytes = self.nbytes
+        return self.num_flops / nbytes if nbytes else 0.0
+
+    @property
+    def _profile(self):
+        """The :class:`~.LoopProfile` collecting the counters of this
+        loop, ``None`` unless profiling is enabled."""
+        if not configuration["profiling"]:
+            return None
+        fun = self._jitmodule
+        key = fun.cache_key if isinstance(fun, Cached) else self._kernel.cache_key
+        return profiler.profile(key, "%s on %s" % (self._kernel.name, self.iterset.name))
 
     def log_flops(self):
         pass
@@ -4125,21 +5018,33 @@ class ParLoop(LazyComputation):
             iterset = self.iterset
             arglist = self.arglist
             fun = self._jitmodule
+            profile = self._profile
             # Need to ensure INC globals are zero on entry to the loop
             # in case it's reused.
             for g in six.iterkeys(self._reduced_globals):
                 g._data[...] = 0
-            self._compute(iterset.core_part, fun, *arglist)
-            self.halo_exchange_end()
-            self._compute(iterset.owned_part, fun, *arglist)
+            with timed_counter(profile, "core_time"):
+                self._compute(iterset.core_part, fun, *arglist)
+            with timed_counter(profile, "halo_time"):
+                self.halo_exchange_end()
+            with timed_counter(profile, "owned_time"):
+                self._compute(iterset.owned_part, fun, *arglist)
             self.reduction_begin()
             if self._only_local:
                 self.reverse_halo_exchange_begin()
-                self.reverse_halo_exchange_end()
+                with timed_counter(profile, "halo_time"):
+                    self.reverse_halo_exchange_end()
             if self.needs_exec_halo:
-                self._compute(iterset.exec_part, fun, *arglist)
+                with timed_counter(profile, "exec_time"):
+                    self._compute(iterset.exec_part, fun, *arglist)
             self.reduction_end()
             self.update_arg_data_state()
+            if profile is not None:
+                profile.calls += 1
+                profile.elements += self._elements
+                profile.bytes_read += self.nbytes_read
+                profile.bytes_written += self.nbytes_written
+                profile.flops += self.num_flops
 
     @collective
     def _compute(self, part, fun, *arglist):
@@ -4154,11 +5059,15 @@ class ParLoop(LazyComputation):
 
     @collective
     def halo_exchange_begin(self):
-        """Start halo exchanges."""
+        """Start halo exchanges.
+
+        The exchanges of all :class:`Dat`\s on the same :class:`Set`
+        are batched into a single message per neighbour."""
         if self.is_direct:
             return
-        for arg in self.dat_args:
-            arg.halo_exchange_begin(update_inc=self._only_local)
+        self._halo_dats = [arg.data for arg in self.dat_args
+                           if arg._claim_halo_exchange(update_inc=self._only_local)]
+        _halo_exchange_begin(self._halo_dats)
 
     @collective
     @timed_function("ParLoopHaloEnd")
@@ -4166,8 +5075,14 @@ class ParLoop(LazyComputation):
         """Finish halo exchanges (wait on irecvs)"""
         if self.is_direct:
             return
+        _halo_exchange_end(self._halo_dats)
         for arg in self.dat_args:
-            arg.halo_exchange_end(update_inc=self._only_local)
+            arg._in_flight = False
+        self._halo_dats = []
+
+    @cached_property
+    def _inc_dats(self):
+        return [arg.data for arg in self.dat_args if arg.access is INC]
 
     @collective
     @timed_function("ParLoopRHaloBegin")
@@ -4175,9 +5090,7 @@ class ParLoop(LazyComputation):
         """Start reverse halo exchanges (to gather remote data)"""
         if self.is_direct:
             return
-        for arg in self.dat_args:
-            if arg.access is INC:
-                arg.data.halo_exchange_begin(reverse=True)
+        _halo_exchange_begin(self._inc_dats, reverse=True)
 
     @collective
     @timed_function("ParLoopRHaloEnd")
@@ -4185,21 +5098,36 @@ class ParLoop(LazyComputation):
         """Finish reverse halo exchanges (to gather remote data)"""
         if self.is_direct:
             return
-        for arg in self.dat_args:
-            if arg.access is INC:
-                arg.data.halo_exchange_end(reverse=True)
+        _halo_exchange_end(self._inc_dats, reverse=True)
 
     @collective
     @timed_function("ParLoopRednBegin")
     def reduction_begin(self):
-        """Start reductions"""
+        """Start reductions.
+
+        While the execution trace runs a batch of computations, the
+        reductions are combined with those of the other loops in the
+        batch."""
+        batch = _trace._reductions
         for arg in self.global_reduction_args:
-            arg.reduction_begin(self.comm)
+            if batch is None:
+                arg.reduction_begin(self.comm)
+            else:
+                batch.begin(arg, self.comm)
 
     @collective
-    @timed_function("ParLoopRednEnd")
     def reduction_end(self):
-        """End reductions"""
+        """End reductions, or defer them until the reductions of the
+        current batch are finished."""
+        batch = _trace._reductions
+        if batch is not None and self.global_reduction_args:
+            batch.end(self)
+        else:
+            self._reduction_end()
+
+    @collective
+    @timed_function("ParLoopRednEnd")
+    def _reduction_end(self):
         for arg in self.global_reduction_args:
             arg.reduction_end(self.comm)
         # Finalise global increments
@@ -4391,6 +5319,10 @@ def par_loop(kernel, it_space, *args, **kwargs):
     :kwarg pass_layer_arg: Should the wrapper pass the current layer
         into the kernel (as an ``int``). Only makes sense for
         indirect extruded iteration.
+    :kwarg batch_size: For kernels that are Python functions, call the
+        function once per chunk of this many elements rather than once
+        per element, passing arrays with a leading axis over the chunk
+        (see :mod:`pyop2.pyparloop`).
 
     .. warning ::
         It is the caller's responsibility that the number and type of all
@@ -4430,6 +5362,9 @@ def par_loop(kernel, it_space, *args, **kwargs):
     passed to the kernel as a vector.
     """
     if isinstance(kernel, types.FunctionType):
-        from pyop2 import pyparloop
+        if configuration["numba"]:
+            from pyop2 import numbaparloop as pyparloop
+        else:
+            from pyop2 import pyparloop
         return pyparloop.ParLoop(pyparloop.Kernel(kernel), it_space, *args, **kwargs).enqueue()
     return _make_object('ParLoop', kernel, it_space, *args, **kwargs).enqueue()
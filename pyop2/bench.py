@@ -0,0 +1,347 @@
+# This file is part of PyOP2
+#
+# PyOP2 is Copyright (c) 2012-2014, Imperial College London and
+# others. Please see the AUTHORS file in the main source directory for
+# a full list of copyright holders.  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * The name of Imperial College London or that of other
+#       contributors may not be used to endorse or promote products
+#       derived from this software without specific prior written
+#       permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTERS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Benchmarks of :func:`~pyop2.op2.par_loop` throughput.
+
+Every benchmark times one :func:`~pyop2.op2.par_loop` of a particular
+shape on a synthetic structured mesh of ``size`` x ``size``
+quadrilaterals, and reports the elements iterated over per second
+together with the memory bandwidth achieved.  Bandwidth is estimated
+from the compulsory traffic of the loop: every :class:`~.Dat`,
+:class:`~.Map` and :class:`~.Mat` touched is read once, and those
+modified are also written once.  Caches and repeated indirect
+accesses are not accounted for.
+
+Each process iterates over its own copy of the mesh, so results
+in parallel measure weak scaling without halo exchanges.  Timings are
+the best of ``repeat`` runs, after one untimed run that generates and
+compiles the code.
+
+Run all benchmarks, writing JSON to a file, with::
+
+    python -m pyop2.bench --size 512 --repeat 10 --output results.json
+
+or from Python::
+
+    from pyop2 import bench
+    results = bench.run(["direct", "indirect_inc"], size=512)
+"""
+
+from __future__ import absolute_import, print_function, division
+
+import json
+import sys
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from pyop2 import op2, base, utils
+from pyop2.configuration import configuration
+from pyop2.datatypes import IntType
+from pyop2.mpi import COMM_WORLD, MPI, collective
+from pyop2.version import __version__ as version
+
+__all__ = ['benchmarks', 'run']
+
+_benchmarks = OrderedDict()
+
+
+def benchmark(fn):
+    """Register a benchmark.
+
+    The decorated function takes a :class:`Mesh` and returns a tuple
+    ``(loop, elements, nbytes)`` of a function executing the loop, the
+    number of elements it iterates over and the compulsory memory
+    traffic in bytes."""
+    _benchmarks[fn.__name__] = fn
+    return fn
+
+
+def benchmarks():
+    """The names of the available benchmarks."""
+    return list(_benchmarks)
+
+
+class Mesh(object):
+
+    """A structured mesh of quadrilaterals on the unit square.
+
+    :arg size: The number of cells in each direction.
+    :kwarg layers: The number of layers of the extruded mesh.
+    """
+
+    def __init__(self, size, layers=16):
+        n = size + 1
+        self.size = size
+        self.layers = layers
+        self.nodes = op2.Set(n * n, "nodes")
+        self.cells = op2.Set(size * size, "cells")
+        i, j = np.meshgrid(np.arange(size), np.arange(size), indexing="ij")
+        corner = (i * n + j).reshape(-1)
+        self.cell_node_values = np.stack([corner, corner + 1, corner + n + 1, corner + n],
+                                         axis=1).astype(IntType)
+        self.cell_node = op2.Map(self.cells, self.nodes, 4, self.cell_node_values, "cell_node")
+        x, y = np.meshgrid(np.linspace(0, 1, n), np.linspace(0, 1, n), indexing="ij")
+        self.coords = op2.Dat(self.nodes ** 2,
+                              np.stack([x.reshape(-1), y.reshape(-1)], axis=1),
+                              np.float64, "coords")
+
+    @utils.cached_property
+    def extruded(self):
+        """The mesh extruded into hexahedra, as a tuple ``(cells, nodes,
+        cell_node)``.  Nodes of a column are numbered contiguously."""
+        layers = self.layers
+        cells = op2.ExtrudedSet(self.cells, layers=layers)
+        nodes = op2.ExtrudedSet(op2.Set(self.nodes.size * layers, "extruded_nodes"),
+                                layers=layers)
+        bottom = self.cell_node_values * layers
+        cell_node = op2.Map(cells, nodes, 8, np.hstack([bottom, bottom + 1]),
+                            "extruded_cell_node", np.ones(8, dtype=IntType))
+        return cells, nodes, cell_node
+
+
+def _nbytes(read=(), written=(), subset=None):
+    """The compulsory traffic of reading the ``read`` objects and
+    reading and writing the ``written`` ones.  For a loop over a
+    ``subset``, only its elements of the :class:`~.Dat`\s are
+    accessed, and its indices are read."""
+    def size(obj):
+        if isinstance(obj, base.Map):
+            return obj.values_with_halo.nbytes
+        if subset is not None and isinstance(obj, base.Dat):
+            return subset.indices.size * obj.cdim * obj.dtype.itemsize
+        return obj.nbytes
+    indices = subset.indices.nbytes if subset is not None else 0
+    return sum(size(o) for o in read) + 2 * sum(size(o) for o in written) + indices
+
+
+@benchmark
+def direct(mesh):
+    """Direct loop over nodes, ``y += 2x``."""
+    x = op2.Dat(mesh.nodes, np.ones(mesh.nodes.size), np.float64, "x")
+    y = op2.Dat(mesh.nodes, np.zeros(mesh.nodes.size), np.float64, "y")
+    k = op2.Kernel("void axpy(double *x, double *y) { *y += 2.0 * *x; }", "axpy")
+
+    def loop():
+        op2.par_loop(k, mesh.nodes, x(op2.READ), y(op2.INC))
+    return loop, mesh.nodes.size, _nbytes([x], [y])
+
+
+@benchmark
+def indirect_read(mesh):
+    """Indirect READ of nodal values, averaged onto cells."""
+    u = op2.Dat(mesh.nodes, np.ones(mesh.nodes.size), np.float64, "u")
+    avg = op2.Dat(mesh.cells, None, np.float64, "avg")
+    k = op2.Kernel("""
+void average(double *a, double *u[1]) {
+  *a = 0.25 * (u[0][0] + u[1][0] + u[2][0] + u[3][0]);
+}""", "average")
+
+    def loop():
+        op2.par_loop(k, mesh.cells, avg(op2.WRITE), u(op2.READ, mesh.cell_node))
+    return loop, mesh.cells.size, _nbytes([u, mesh.cell_node], [avg])
+
+
+@benchmark
+def indirect_inc(mesh):
+    """Indirect INC of cell values into nodes."""
+    c = op2.Dat(mesh.cells, np.ones(mesh.cells.size), np.float64, "c")
+    u = op2.Dat(mesh.nodes, np.zeros(mesh.nodes.size), np.float64, "u")
+    k = op2.Kernel("""
+void scatter(double *u[1], double *c) {
+  for ( int i = 0; i < 4; i++ ) u[i][0] += 0.25 * *c;
+}""", "scatter")
+
+    def loop():
+        op2.par_loop(k, mesh.cells, u(op2.INC, mesh.cell_node), c(op2.READ))
+    return loop, mesh.cells.size, _nbytes([c, mesh.cell_node], [u])
+
+
+@benchmark
+def vector_map(mesh):
+    """Vector map READ of vector valued coordinates, computing cell areas."""
+    area = op2.Dat(mesh.cells, None, np.float64, "area")
+    k = op2.Kernel("""
+void area(double *a, double *x[2]) {
+  *a = 0.5 * ((x[0][0] - x[2][0]) * (x[1][1] - x[3][1]) -
+              (x[1][0] - x[3][0]) * (x[0][1] - x[2][1]));
+}""", "area")
+
+    def loop():
+        op2.par_loop(k, mesh.cells, area(op2.WRITE), mesh.coords(op2.READ, mesh.cell_node))
+    return loop, mesh.cells.size, _nbytes([mesh.coords, mesh.cell_node], [area])
+
+
+@benchmark
+def extruded(mesh):
+    """Indirect INC over the columns of an extruded mesh."""
+    cells, nodes, cell_node = mesh.extruded
+    u = op2.Dat(nodes, np.zeros(nodes.size), np.float64, "u")
+    k = op2.Kernel("""
+void count(double *u[1]) {
+  for ( int i = 0; i < 8; i++ ) u[i][0] += 1.0;
+}""", "count")
+
+    def loop():
+        op2.par_loop(k, cells, u(op2.INC, cell_node))
+    return loop, cells.size * (mesh.layers - 1), _nbytes([cell_node], [u])
+
+
+@benchmark
+def mat_assembly(mesh):
+    """Assembly of a 4 x 4 element matrix per cell."""
+    sparsity = op2.Sparsity((mesh.nodes, mesh.nodes), (mesh.cell_node, mesh.cell_node))
+    mat = op2.Mat(sparsity, np.float64, "mat")
+    k = op2.Kernel("""
+void ones(double A[4][4]) {
+  for ( int i = 0; i < 4; i++ )
+    for ( int j = 0; j < 4; j++ )
+      A[i][j] += 1.0;
+}""", "ones")
+
+    def loop():
+        mat.zero()
+        op2.par_loop(k, mesh.cells,
+                     mat(op2.INC, (mesh.cell_node[op2.i[0]], mesh.cell_node[op2.i[1]])))
+        mat.assemble()
+    return loop, mesh.cells.size, _nbytes([mesh.cell_node], [mat])
+
+
+@benchmark
+def global_reduction(mesh):
+    """Direct sum of nodal values into a :class:`~.Global`."""
+    u = op2.Dat(mesh.nodes, np.ones(mesh.nodes.size), np.float64, "u")
+    total = op2.Global(1, 0.0, np.float64, "total")
+    k = op2.Kernel("void sum(double *u, double *t) { *t += *u; }", "sum")
+
+    def loop():
+        op2.par_loop(k, mesh.nodes, u(op2.READ), total(op2.INC))
+    return loop, mesh.nodes.size, _nbytes([u], [total])
+
+
+@benchmark
+def subset(mesh):
+    """Direct loop over a :class:`~.Subset` of every other node."""
+    indices = np.arange(0, mesh.nodes.size, 2, dtype=IntType)
+    nodes = op2.Subset(mesh.nodes, indices)
+    u = op2.Dat(mesh.nodes, np.ones(mesh.nodes.size), np.float64, "u")
+    k = op2.Kernel("void scale(double *u) { *u *= 0.5; }", "scale")
+
+    def loop():
+        op2.par_loop(k, nodes, u(op2.RW))
+    return loop, len(indices), _nbytes(written=[u], subset=nodes)
+
+
+@collective
+def _time(loop, comm):
+    """Wall clock time of ``loop``, including lazy evaluation, on the
+    slowest process."""
+    comm.barrier()
+    start = time.time()
+    loop()
+    base._trace.evaluate_all()
+    return comm.allreduce(time.time() - start, op=MPI.MAX)
+
+
+@collective
+def run(names=None, size=256, repeat=5, layers=16, comm=COMM_WORLD):
+    """Run benchmarks.
+
+    :arg names: The names of the benchmarks to run (see
+        :func:`benchmarks`), defaults to all of them.
+    :kwarg size: The number of cells in each direction of the mesh.
+    :kwarg repeat: The number of timed runs of each loop.
+    :kwarg layers: The number of layers of extruded meshes.
+    :kwarg comm: The communicator to report timings over.
+    :returns: a dict suitable for serialisation to JSON, recording the
+        configuration and, per benchmark, the number of ``elements``
+        (summed over processes), the best ``time`` in seconds,
+        ``elements_per_second``, the compulsory traffic in ``bytes``
+        and ``gigabytes_per_second``."""
+    names = benchmarks() if names is None else list(names)
+    for name in names:
+        if name not in _benchmarks:
+            raise ValueError("Unknown benchmark %r, must be one of %s"
+                             % (name, ", ".join(benchmarks())))
+    mesh = Mesh(size, layers=layers)
+    results = OrderedDict()
+    for name in names:
+        loop, elements, nbytes = _benchmarks[name](mesh)
+        # Code generation and compilation
+        _time(loop, comm)
+        best = min(_time(loop, comm) for _ in range(repeat))
+        elements = comm.allreduce(elements)
+        nbytes = comm.allreduce(nbytes)
+        results[name] = OrderedDict([("elements", elements),
+                                     ("time", best),
+                                     ("elements_per_second", elements / best),
+                                     ("bytes", nbytes),
+                                     ("gigabytes_per_second", nbytes / best / 1e9)])
+    return OrderedDict([("version", version),
+                        ("backend", configuration["backend"]),
+                        ("processes", comm.size),
+                        ("size", size),
+                        ("layers", layers),
+                        ("repeat", repeat),
+                        ("results", results)])
+
+
+def main(argv=None):
+    parser = utils.parser(group=True, description=__doc__)
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help='benchmarks to run (default all of: %s)' % ", ".join(benchmarks()))
+    parser.add_argument('-s', '--size', type=int, default=256,
+                        help='number of cells in each direction of the mesh (default 256)')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='number of timed runs of each loop (default 5)')
+    parser.add_argument('--layers', type=int, default=16,
+                        help='number of layers of extruded meshes (default 16)')
+    parser.add_argument('-o', '--output', default=None,
+                        help='file to write JSON results to (default standard output)')
+    opt = vars(parser.parse_args(argv))
+    op2.init(**dict((k, opt[k]) for k in ('debug', 'log_level') if k in opt))
+    results = run(opt['benchmarks'] or None, size=opt['size'], repeat=opt['repeat'],
+                  layers=opt['layers'])
+    if COMM_WORLD.rank != 0:
+        return
+    if opt['output'] is None:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(opt['output'], 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -34,18 +34,115 @@
 """Provides common base classes for cached objects."""
 
 from __future__ import absolute_import, print_function, division
+import six
 
+from collections import defaultdict, OrderedDict
+from inspect import getmodule
+
+from pyop2.configuration import configuration
 from pyop2.utils import cached_property
 
 
+class LRUCache(OrderedDict):
+
+    """A cache dictionary remembering the order in which its entries were
+    last used, such that the least recently used entries can be evicted
+    once the cache grows beyond the configured limits
+    (``cache_max_entries`` and ``cache_max_bytes``).
+
+    Only entries whose ``_cache_evictable`` attribute is true (the
+    default for objects without one) are evicted and count towards the
+    limits.  Objects compared by identity, such as the
+    :class:`~.DataSet`\s cached on a :class:`~.Set`, must never be
+    evicted, since rebuilding them would produce an object unequal to
+    the one already in use.
+
+    The size of an entry in bytes is taken from its ``_cache_nbytes``
+    attribute, if present."""
+
+    def lookup(self, key):
+        """Return the entry for ``key``, marking it most recently used."""
+        value = self.pop(key)
+        self[key] = value
+        return value
+
+    @property
+    def nbytes(self):
+        """Total size of the entries in bytes."""
+        return sum(_nbytes(v) for v in self.values())
+
+    def evict(self):
+        """Evict least recently used entries until the cache is within
+        the configured limits.
+
+        :returns: the number of evicted entries."""
+        max_entries = configuration['cache_max_entries']
+        max_bytes = configuration['cache_max_bytes']
+        if not (max_entries or max_bytes):
+            return 0
+        # Least recently used first
+        keys = [k for k, v in six.iteritems(self) if _evictable(v)]
+        n = 0
+        # Always keep the most recent entry
+        while len(keys) > 1 and max_entries and len(keys) > max_entries:
+            del self[keys.pop(0)]
+            n += 1
+        if max_bytes:
+            nbytes = sum(_nbytes(self[k]) for k in keys)
+            while len(keys) > 1 and nbytes > max_bytes:
+                nbytes -= _nbytes(self.pop(keys.pop(0)))
+                n += 1
+        return n
+
+
+def _nbytes(obj):
+    return getattr(obj, "_cache_nbytes", 0)
+
+
+def _evictable(obj):
+    return getattr(obj, "_cache_evictable", True)
+
+
+_stats = defaultdict(lambda: [0, 0, 0])
+"""Hits, misses and evictions per cached class."""
+
+
+def _lookup(cache, key):
+    if isinstance(cache, LRUCache):
+        return cache.lookup(key)
+    return cache[key]
+
+
+def _store(cache, key, obj, typ):
+    cache[key] = obj
+    if isinstance(cache, LRUCache):
+        _stats[typ][2] += cache.evict()
+
+
+def cache_stats(typ=object):
+    """Return cache statistics for classes deriving from ``typ``.
+
+    :arg typ: A class of cached object, for example :class:`ObjectCached`
+        or :class:`Cached`.
+    :returns: a dict mapping cached classes to a tuple of ``(hits,
+        misses, evictions)``."""
+    return dict((k, tuple(v)) for k, v in six.iteritems(_stats)
+                if issubclass(k, typ))
+
+
+def _class_name(typ):
+    mod = getmodule(typ)
+    if mod is not None:
+        return "%s.%s" % (mod.__name__, typ.__name__)
+    return typ.__name__
+
+
 def report_cache(typ):
     """Report the size of caches of type ``typ``
 
     :arg typ: A class of cached object.  For example
         :class:`ObjectCached` or :class:`Cached`.
     """
-    from collections import defaultdict
-    from inspect import getmodule
     from gc import get_objects
     typs = defaultdict(lambda: 0)
     n = 0
@@ -55,17 +152,18 @@ def report_cache(typ):
             n += 1
     if n == 0:
         print("\nNo %s objects in caches" % typ.__name__)
-        return
-    print("\n%d %s objects in caches" % (n, typ.__name__))
-    print("Object breakdown")
-    print("================")
-    for k, v in typs.iteritems():
-        mod = getmodule(k)
-        if mod is not None:
-            name = "%s.%s" % (mod.__name__, k.__name__)
-        else:
-            name = k.__name__
-        print('%s: %d' % (name, v))
+    else:
+        print("\n%d %s objects in caches" % (n, typ.__name__))
+        print("Object breakdown")
+        print("================")
+        for k, v in six.iteritems(typs):
+            print('%s: %d' % (_class_name(k), v))
+    stats = cache_stats(typ)
+    if stats:
+        print("Cache statistics (hits, misses, evictions)")
+        print("==========================================")
+        for k, (hits, misses, evictions) in six.iteritems(stats):
+            print('%s: %d, %d, %d' % (_class_name(k), hits, misses, evictions))
 
 
 class ObjectCached(object):
@@ -92,8 +190,14 @@ class ObjectCached(object):
         from :meth:`__init__` if the flag is set. Otherwise the object
         will be re-initialized even if it was returned from cache!
 
+    Objects cached this way are never evicted from a bounded
+    :class:`LRUCache`, unless the derived class sets
+    ``_cache_evictable`` because its instances are only ever compared
+    by value.
     """
 
+    _cache_evictable = False
+
     @classmethod
     def _process_args(cls, *args, **kwargs):
         """Process the arguments to ``__init__`` into a form suitable
@@ -153,10 +257,13 @@ class ObjectCached(object):
         # OK, we have a cache, let's go ahead and try and find our
         # object in it.
         try:
-            return cache[key]
+            obj = _lookup(cache, key)
+            _stats[cls][0] += 1
+            return obj
         except KeyError:
+            _stats[cls][1] += 1
             obj = make_obj()
-            cache[key] = obj
+            _store(cache, key, obj, cls)
             return obj
 
 
@@ -195,19 +302,22 @@ class Cached(object):
         if key is None:
             return make_obj()
         try:
-            return cls._cache_lookup(key)
+            obj = cls._cache_lookup(key)
+            _stats[cls][0] += 1
+            return obj
         except (KeyError, IOError):
+            _stats[cls][1] += 1
             obj = make_obj()
             cls._cache_store(key, obj)
             return obj
 
     @classmethod
     def _cache_lookup(cls, key):
-        return cls._cache[key]
+        return _lookup(cls._cache, key)
 
     @classmethod
     def _cache_store(cls, key, val):
-        cls._cache[key] = val
+        _store(cls._cache, key, val, cls)
 
     @classmethod
     def _process_args(cls, *args, **kwargs):
@@ -0,0 +1,550 @@
+# This file is part of PyOP2
+#
+# PyOP2 is Copyright (c) 2012-2014, Imperial College London and
+# others. Please see the AUTHORS file in the main source directory for
+# a full list of copyright holders.  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * The name of Imperial College London or that of other
+#       contributors may not be used to endorse or promote products
+#       derived from this software without specific prior written
+#       permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTERS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Checkpoint and restart of PyOP2 data.
+
+:func:`save` writes a collection of named objects, together with
+everything they are built on, such that :func:`load` can rebuild them
+in a new run on the same number of processes.  For example::
+
+    from pyop2 import checkpoint
+    request = checkpoint.save("chk", {"u": u, "A": A}, background=True)
+    ...  # continue computing
+    request.wait()
+
+    objects = checkpoint.load("chk")
+    u, A = objects["u"], objects["A"]
+
+:class:`~.Set`\s (with their :class:`~.Halo`\s), :class:`~.DataSet`\s,
+:class:`~.Map`\s, :class:`~.Dat`\s, :class:`~.Global`\s,
+:class:`~.Sparsity` patterns and :class:`~.Mat` values are supported,
+including their mixed, extruded and subset variants.  Objects shared
+between several of those saved are stored once.  Halos and sparsity
+patterns are stored rather than recomputed on restart.
+
+Every process writes one record: a JSON header describing its objects,
+followed by the raw arrays they hold, each aligned to 64 bytes.  The
+records are written to one file per process, ``rank_<N>.ckp`` in the
+checkpoint directory, or one after the other into a single shared file
+``checkpoint.ckp``, preceded by a table of their offsets.  Files are
+written under a temporary name and renamed once complete, so an
+existing checkpoint is only replaced by a complete one.  On restart
+the records are memory mapped (copy on write), such that data are only
+read when touched.
+"""
+
+from __future__ import absolute_import, print_function, division
+
+import json
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import six
+
+from pyop2 import base
+from pyop2.base import _make_object
+from pyop2.datatypes import IntType
+from pyop2.mpi import COMM_WORLD, collective
+from pyop2.utils import align
+from pyop2.version import __version__ as version
+
+__all__ = ['save', 'load', 'CheckpointRequest']
+
+_magic = b"PYOP2CKP"
+_shared_magic = b"PYOP2CKS"
+_alignment = 64
+
+
+class _Writer(object):
+
+    """Flattens an object graph into a list of records, each
+    dependency before the objects that use it, and a list of arrays
+    referenced by index from the records.
+
+    :arg copy: Copy the values of data carriers, such that they may
+        be modified while the arrays are written."""
+
+    def __init__(self, copy=False):
+        self.copy = copy
+        self.records = []
+        self.arrays = []
+        self._ids = {}
+        # Keep the objects alive, their ids must not be reused
+        self._objects = []
+
+    def array(self, values, copy=False):
+        if values is None:
+            return None
+        values = np.ascontiguousarray(values)
+        if copy and self.copy:
+            values = values.copy()
+        self.arrays.append(values)
+        return len(self.arrays) - 1
+
+    def add(self, obj):
+        try:
+            return self._ids[id(obj)]
+        except KeyError:
+            pass
+        record = self.describe(obj)
+        self._ids[id(obj)] = len(self.records)
+        self.records.append(record)
+        self._objects.append(obj)
+        return len(self.records) - 1
+
+    def describe(self, obj):
+        """The record of ``obj``, adding its dependencies first."""
+        # Most derived classes first
+        if isinstance(obj, base.Halo):
+            return {"type": "Halo",
+                    "sends": [(int(r), self.array(a)) for r, a in six.iteritems(obj._sends)],
+                    "receives": [(int(r), self.array(a)) for r, a in six.iteritems(obj._receives)],
+                    "gnn2unn": self.array(obj._global_to_petsc_numbering)}
+        if isinstance(obj, (base.LocalSet, base.GlobalSet)):
+            raise NotImplementedError("Checkpointing of %r is not supported" % obj)
+        if isinstance(obj, base.Subset):
+            return {"type": "Subset", "superset": self.add(obj.superset),
+                    "indices": self.array(obj.indices)}
+        if isinstance(obj, base.ExtrudedSet):
+            return {"type": "ExtrudedSet", "parent": self.add(obj.parent),
+                    "layers": obj.layers}
+        if isinstance(obj, base.MixedSet):
+            return {"type": "MixedSet", "sets": [self.add(s) for s in obj]}
+        if isinstance(obj, base.Set):
+            return {"type": "Set", "sizes": list(obj.sizes), "name": obj.name,
+                    "halo": None if obj.halo is None else self.add(obj.halo)}
+        if isinstance(obj, base.GlobalDataSet):
+            return {"type": "GlobalDataSet", "global": self.add(obj._global)}
+        if isinstance(obj, base.MixedDataSet):
+            return {"type": "MixedDataSet", "dsets": [self.add(d) for d in obj]}
+        if isinstance(obj, base.DataSet):
+            return {"type": "DataSet", "set": self.add(obj.set), "dim": list(obj.dim),
+                    "name": obj.name}
+        if isinstance(obj, base.MixedMap):
+            return {"type": "MixedMap", "maps": [self.add(m) for m in obj]}
+        if isinstance(obj, base.DecoratedMap):
+            return {"type": "DecoratedMap", "map": self.add(obj.map),
+                    "iteration_region": sorted(r.where for r in obj.iteration_region),
+                    "implicit_bcs": sorted(obj.implicit_bcs),
+                    "vector_index": obj.vector_index}
+        if isinstance(obj, base.Map):
+            masks = dict((name, (np.flatnonzero(obj._bottom_mask[name] == -1).tolist(),
+                                 np.flatnonzero(obj._top_mask[name] == -1).tolist()))
+                         for name in obj._bottom_mask)
+            return {"type": "Map", "iterset": self.add(obj.iterset),
+                    "toset": self.add(obj.toset), "arity": obj.arity,
+                    "values": self.array(obj._values if obj._values.size else None),
+                    "name": obj.name,
+                    "offset": self.array(obj.offset),
+                    "parent": None if obj._parent is None else self.add(obj._parent),
+                    "bt_masks": masks or None}
+        if isinstance(obj, base.MixedDat):
+            return {"type": "MixedDat", "dats": [self.add(d) for d in obj]}
+        if isinstance(obj, base.DatView):
+            return {"type": "DatView", "dat": self.add(obj._parent), "index": obj.index}
+        if isinstance(obj, base.Dat):
+            base._trace.evaluate(set([obj]), set())
+            return {"type": "Dat", "dataset": self.add(obj.dataset),
+                    "data": self.array(obj._data, copy=True), "name": obj.name,
+                    "soa": obj.soa, "needs_halo_update": obj.needs_halo_update}
+        if isinstance(obj, base.Global):
+            base._trace.evaluate(set([obj]), set())
+            return {"type": "Global", "dim": list(obj.dim),
+                    "data": self.array(obj._data, copy=True), "name": obj.name,
+                    "comm": obj.comm is not None}
+        if isinstance(obj, base.Sparsity):
+            return self.describe_sparsity(obj)
+        if isinstance(obj, base.Mat):
+            return self.describe_mat(obj)
+        raise NotImplementedError("Checkpointing of %r is not supported" % obj)
+
+    def describe_sparsity(self, sparsity):
+        if any(isinstance(d, base.GlobalDataSet) for d in sparsity.dsets):
+            raise NotImplementedError("Checkpointing of sparsities with Global rows or columns is not supported")
+        dsets = [self.add(d) for d in sparsity.dsets]
+        maps = [(self.add(r), self.add(c)) for r, c in sparsity.maps]
+        # The patterns of the blocks built, keyed as they are looked
+        # up on construction.
+        patterns = []
+        for s in (sparsity if sparsity.nested else [sparsity]):
+            if s._rowptr is None:
+                # Block with Global rows or columns, not built
+                continue
+            patterns.append((base._sparsity_digest(s),
+                             [self.array(getattr(s, "_%s" % name))
+                              for name in base._sparsity_arrays]))
+        return {"type": "Sparsity", "dsets": dsets, "maps": maps,
+                "name": sparsity.name, "nest": sparsity.nested,
+                "block_sparse": sparsity._block_sparse, "patterns": patterns}
+
+    def describe_mat(self, mat):
+        sparsity = self.add(mat.sparsity)
+        mat.assemble()
+        base._trace.evaluate(set([mat]), set())
+        values = []
+        for m in (mat if mat.sparsity.nested else [mat]):
+            values.append([self.array(a) for a in m.handle.getValuesCSR()])
+        return {"type": "Mat", "sparsity": sparsity, "dtype": np.dtype(mat.dtype).str,
+                "name": mat.name, "values": values}
+
+    def encode(self, comm, names):
+        """The header of the record and the offsets of the arrays
+        relative to the end of the header."""
+        layout = []
+        offset = 0
+        for a in self.arrays:
+            offset = align(offset, _alignment)
+            layout.append((offset, a.dtype.str, a.shape))
+            offset += a.nbytes
+        header = json.dumps({"version": version,
+                             "IntType": np.dtype(IntType).str,
+                             "size": comm.size,
+                             "rank": comm.rank,
+                             "names": names,
+                             "records": self.records,
+                             "arrays": layout}).encode("utf-8")
+        start = align(len(_magic) + 8 + len(header), _alignment)
+        return header, start, layout, start + offset
+
+
+def _write_record(f, position, header, start, layout, arrays):
+    """Write one record at byte ``position`` of the open file ``f``."""
+    f.seek(position)
+    f.write(_magic)
+    f.write(struct.pack("<Q", len(header)))
+    f.write(header)
+    for (offset, _, _), a in zip(layout, arrays):
+        if a.nbytes:
+            f.seek(position + start + offset)
+            f.write(a.data)
+
+
+def _read_record(filename, position=0):
+    """Read the record at byte ``position`` of file ``filename``,
+    mapping its arrays into memory."""
+    with open(filename, "rb") as f:
+        f.seek(position)
+        if f.read(len(_magic)) != _magic:
+            raise ValueError("%s is not a PyOP2 checkpoint" % filename)
+        length, = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(length).decode("utf-8"),
+                            object_pairs_hook=OrderedDict)
+    start = position + align(len(_magic) + 8 + length, _alignment)
+    layout = [(offset, np.dtype(dtype), tuple(shape))
+              for offset, dtype, shape in header["arrays"]]
+    end = max([offset + dtype.itemsize * int(np.prod(shape))
+               for offset, dtype, shape in layout] + [0])
+    if end:
+        buf = np.memmap(filename, dtype=np.uint8, mode="c", offset=start, shape=(end, ))
+    arrays = []
+    for offset, dtype, shape in layout:
+        nbytes = dtype.itemsize * int(np.prod(shape))
+        if nbytes:
+            arrays.append(buf[offset:offset + nbytes].view(dtype).reshape(shape))
+        else:
+            arrays.append(np.empty(shape, dtype=dtype))
+    return header, arrays
+
+
+class CheckpointRequest(object):
+
+    """A checkpoint being written, returned by :func:`save`.
+
+    :meth:`wait` must be called collectively, it returns once the
+    checkpoint is complete on all processes."""
+
+    def __init__(self, comm, write, finalise):
+        self.comm = comm
+        self._finalise = finalise
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(write, ))
+        self._thread.start()
+
+    def _run(self, write):
+        try:
+            write()
+        except Exception as e:
+            self._error = e
+
+    @property
+    def done(self):
+        """Has this process finished writing?"""
+        return self._thread is None or not self._thread.is_alive()
+
+    @collective
+    def wait(self):
+        """Wait for the checkpoint to be written by all processes."""
+        if self._thread is None:
+            return
+        self._thread.join()
+        self._thread = None
+        failed = self.comm.allreduce(self._error is not None)
+        if self._error is not None:
+            raise self._error
+        if failed:
+            raise RuntimeError("Writing the checkpoint failed on another process")
+        self._finalise()
+
+
+def _remove_stale(filename, shared, size):
+    """Remove the files of an earlier checkpoint in directory
+    ``filename`` that a checkpoint just written on ``size`` processes
+    does not replace, such that :func:`load` cannot pick them up."""
+    stale = []
+    for f in os.listdir(filename):
+        if f == "checkpoint.ckp":
+            if not shared:
+                stale.append(f)
+        elif f.startswith("rank_") and f.endswith(".ckp"):
+            try:
+                rank = int(f[len("rank_"):-len(".ckp")])
+            except ValueError:
+                continue
+            if shared or rank >= size:
+                stale.append(f)
+    for f in stale:
+        os.remove(os.path.join(filename, f))
+
+
+@collective
+def save(filename, objects, comm=None, shared=False, background=False):
+    """Write a checkpoint of ``objects``.
+
+    :arg filename: The checkpoint directory, created if necessary.
+    :arg objects: A dict of the objects to save, by name.
+    :arg comm: The communicator of the objects (defaults to
+        ``COMM_WORLD``).
+    :arg shared: Write a single file shared by all processes, rather
+        than one file per process.
+    :arg background: Return as soon as the values have been copied,
+        writing them in a background thread such that computation
+        may continue.  Otherwise write the checkpoint before
+        returning.
+    :returns: A :class:`CheckpointRequest`, call its
+        :meth:`~CheckpointRequest.wait` before relying on the
+        checkpoint.
+    """
+    comm = comm or COMM_WORLD
+    writer = _Writer(copy=background)
+    names = OrderedDict((name, writer.add(obj)) for name, obj in six.iteritems(objects))
+    header, start, layout, length = writer.encode(comm, names)
+    arrays = writer.arrays
+    if comm.rank == 0 and not os.path.exists(filename):
+        os.makedirs(filename)
+    if shared:
+        lengths = comm.allgather(length)
+        table = align(len(_shared_magic) + 8 + 16 * comm.size, _alignment)
+        offsets = [table]
+        for n in lengths[:-1]:
+            offsets.append(align(offsets[-1] + n, _alignment))
+        final = os.path.join(filename, "checkpoint.ckp")
+        tmpname = final + ".tmp"
+        if comm.rank == 0:
+            with open(tmpname, "wb") as f:
+                f.write(_shared_magic)
+                f.write(struct.pack("<Q", comm.size))
+                for o, n in zip(offsets, lengths):
+                    f.write(struct.pack("<QQ", o, n))
+        comm.barrier()
+        position = offsets[comm.rank]
+
+        def finalise():
+            comm.barrier()
+            if comm.rank == 0:
+                os.rename(tmpname, final)
+                _remove_stale(filename, shared, comm.size)
+            comm.barrier()
+    else:
+        final = os.path.join(filename, "rank_%d.ckp" % comm.rank)
+        tmpname = final + ".tmp"
+        comm.barrier()
+        position = 0
+        with open(tmpname, "wb"):
+            pass
+
+        def finalise():
+            os.rename(tmpname, final)
+            comm.barrier()
+            if comm.rank == 0:
+                _remove_stale(filename, shared, comm.size)
+            comm.barrier()
+
+    def write():
+        with open(tmpname, "r+b") as f:
+            _write_record(f, position, header, start, layout, arrays)
+
+    request = CheckpointRequest(comm, write, finalise)
+    if not background:
+        request.wait()
+    return request
+
+
+class _Reader(object):
+
+    """Rebuilds the objects of a record, in order."""
+
+    def __init__(self, header, arrays, comm):
+        self.arrays = arrays
+        self.comm = comm
+        self.objects = []
+        for record in header["records"]:
+            self.objects.append(getattr(self, "build_%s" % record["type"])(record))
+
+    def array(self, i):
+        return None if i is None else self.arrays[i]
+
+    def build_Halo(self, r):
+        return _make_object('Halo',
+                            dict((rank, self.array(a)) for rank, a in r["sends"]),
+                            dict((rank, self.array(a)) for rank, a in r["receives"]),
+                            comm=self.comm, gnn2unn=self.array(r["gnn2unn"]))
+
+    def build_Set(self, r):
+        halo = None if r["halo"] is None else self.objects[r["halo"]]
+        return _make_object('Set', r["sizes"], r["name"], halo=halo, comm=self.comm)
+
+    def build_ExtrudedSet(self, r):
+        return _make_object('ExtrudedSet', self.objects[r["parent"]], r["layers"])
+
+    def build_Subset(self, r):
+        return _make_object('Subset', self.objects[r["superset"]], self.array(r["indices"]))
+
+    def build_MixedSet(self, r):
+        return _make_object('MixedSet', [self.objects[i] for i in r["sets"]])
+
+    def build_DataSet(self, r):
+        return _make_object('DataSet', self.objects[r["set"]], tuple(r["dim"]), r["name"])
+
+    def build_GlobalDataSet(self, r):
+        return _make_object('GlobalDataSet', self.objects[r["global"]])
+
+    def build_MixedDataSet(self, r):
+        return _make_object('MixedDataSet', [self.objects[i] for i in r["dsets"]])
+
+    def build_Map(self, r):
+        parent = None if r["parent"] is None else self.objects[r["parent"]]
+        return _make_object('Map', self.objects[r["iterset"]], self.objects[r["toset"]],
+                            r["arity"], self.array(r["values"]), r["name"],
+                            offset=self.array(r["offset"]), parent=parent,
+                            bt_masks=r["bt_masks"])
+
+    def build_DecoratedMap(self, r):
+        regions = [getattr(base, where) for where in r["iteration_region"]]
+        return _make_object('DecoratedMap', self.objects[r["map"]],
+                            iteration_region=regions,
+                            implicit_bcs=r["implicit_bcs"] or None,
+                            vector_index=r["vector_index"])
+
+    def build_MixedMap(self, r):
+        return _make_object('MixedMap', [self.objects[i] for i in r["maps"]])
+
+    def build_Dat(self, r):
+        dat = _make_object('Dat', self.objects[r["dataset"]], self.array(r["data"]),
+                           name=r["name"], soa=r["soa"])
+        dat.needs_halo_update = r["needs_halo_update"]
+        return dat
+
+    def build_DatView(self, r):
+        return _make_object('DatView', self.objects[r["dat"]], r["index"])
+
+    def build_MixedDat(self, r):
+        return _make_object('MixedDat', [self.objects[i] for i in r["dats"]])
+
+    def build_Global(self, r):
+        return _make_object('Global', tuple(r["dim"]), self.array(r["data"]),
+                            name=r["name"], comm=self.comm if r["comm"] else None)
+
+    def build_Sparsity(self, r):
+        keys = []
+        for key, arrays in r["patterns"]:
+            base._sparsity_patterns[key] = [self.array(a) for a in arrays]
+            keys.append(key)
+        try:
+            return _make_object('Sparsity',
+                                tuple(self.objects[i] for i in r["dsets"]),
+                                [(self.objects[i], self.objects[j]) for i, j in r["maps"]],
+                                name=r["name"], nest=r["nest"],
+                                block_sparse=r["block_sparse"])
+        finally:
+            # Not used if the sparsity was cached
+            for key in keys:
+                base._sparsity_patterns.pop(key, None)
+
+    def build_Mat(self, r):
+        mat = _make_object('Mat', self.objects[r["sparsity"]],
+                           np.dtype(r["dtype"]), r["name"])
+        for m, csr in zip(mat if mat.sparsity.nested else [mat], r["values"]):
+            m.handle.setValuesCSR(*[self.array(a) for a in csr])
+            m.handle.assemble()
+        if mat.sparsity.nested:
+            mat.handle.assemble()
+        return mat
+
+
+@collective
+def load(filename, comm=None):
+    """Rebuild the objects of the checkpoint ``filename``, written by
+    :func:`save` on the same number of processes.
+
+    :arg filename: The checkpoint directory.
+    :arg comm: The communicator to build the objects on (defaults to
+        ``COMM_WORLD``).
+    :returns: A dict of the saved objects, by name.
+    """
+    comm = comm or COMM_WORLD
+    shared = os.path.join(filename, "checkpoint.ckp")
+    if os.path.exists(shared):
+        with open(shared, "rb") as f:
+            if f.read(len(_shared_magic)) != _shared_magic:
+                raise ValueError("%s is not a PyOP2 checkpoint" % shared)
+            size, = struct.unpack("<Q", f.read(8))
+            if size != comm.size:
+                raise ValueError("Checkpoint written on %d processes, cannot load on %d"
+                                 % (size, comm.size))
+            f.seek(16 * comm.rank, os.SEEK_CUR)
+            position, _ = struct.unpack("<QQ", f.read(16))
+        header, arrays = _read_record(shared, position)
+    else:
+        header, arrays = _read_record(os.path.join(filename, "rank_%d.ckp" % comm.rank))
+    if header["size"] != comm.size:
+        raise ValueError("Checkpoint written on %d processes, cannot load on %d"
+                         % (header["size"], comm.size))
+    if np.dtype(header["IntType"]) != np.dtype(IntType):
+        raise ValueError("Checkpoint written with integer type %s, not %s"
+                         % (header["IntType"], np.dtype(IntType).str))
+    objects = _Reader(header, arrays, comm).objects
+    return OrderedDict((name, objects[i]) for name, i in six.iteritems(header["names"]))
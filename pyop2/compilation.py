@@ -92,6 +92,55 @@ def sniff_compiler_version(cc):
     return CompilerInfo(compiler, ver)
 
 
+_pool = None
+_building = {}
+"""Results of background builds in flight, keyed by library name."""
+
+
+def _build_pool():
+    """The pool of threads driving background compilations."""
+    global _pool
+    if _pool is None:
+        from multiprocessing.pool import ThreadPool
+        _pool = ThreadPool(max(configuration['compile_workers'], 1))
+    return _pool
+
+
+class PendingLibrary(object):
+
+    """A shared library that is being built in the background.
+
+    :arg soname: The name of the library once built.
+    :arg owner: The rank building the library.
+    :arg result: The asynchronous result of the build (only on ``owner``).
+    :arg comm: The communicator the library is loaded on.
+    """
+
+    def __init__(self, soname, owner, result, comm):
+        self._soname = soname
+        self._owner = owner
+        self._result = result
+        self.comm = comm
+
+    @collective
+    def wait(self):
+        """Wait for the build to complete and return the loaded
+        :class:`ctypes.CDLL`."""
+        error = None
+        if self._result is not None:
+            try:
+                self._result.get()
+            except Exception as e:
+                # Raise on every rank, not just the one building
+                error = str(e)
+            finally:
+                _building.pop(self._soname, None)
+        error = self.comm.bcast(error, root=self._owner)
+        if error is not None:
+            raise CompilationError(error)
+        return ctypes.CDLL(self._soname)
+
+
 class Compiler(object):
 
     compiler_versions = {}
@@ -142,16 +191,9 @@ class Compiler(object):
                 return ["-fno-tree-loop-vectorize"]
         return []
 
-    @collective
-    def get_so(self, src, extension):
-        """Build a shared library and load it
-
-        :arg src: The source string to compile.
-        :arg extension: extension of the source file (c, cpp).
-
-        Returns a :class:`ctypes.CDLL` object of the resulting shared
-        library."""
-
+    def _names(self, src):
+        """Return the cache key (basename) and shared library name for
+        ``src``, checking that all ranks agree on the code."""
         # Determine cache key
         hsh = md5(six.b(src))
         hsh.update(six.b(self._cc))
@@ -163,13 +205,7 @@ class Compiler(object):
         basename = hsh.hexdigest()
 
         cachedir = configuration['cache_dir']
-        pid = os.getpid()
-        cname = os.path.join(cachedir, "%s_p%d.%s" % (basename, pid, extension))
-        oname = os.path.join(cachedir, "%s_p%d.o" % (basename, pid))
         soname = os.path.join(cachedir, "%s.so" % basename)
-        # Link into temporary file, then rename to shared library
-        # atomically (avoiding races).
-        tmpname = os.path.join(cachedir, "%s_p%d.so.tmp" % (basename, pid))
 
         if configuration['check_src_hashes'] or configuration['debug']:
             matching = self.comm.allreduce(basename, op=_check_op)
@@ -185,6 +221,124 @@ class Compiler(object):
                     f.write(src)
                 self.comm.barrier()
                 raise CompilationError("Generated code differs across ranks (see output in %s)" % output)
+        return basename, soname
+
+    def _compile(self, src, extension, basename):
+        """Compile and link ``src`` into the shared library for
+        ``basename`` in the cache directory (not collective)."""
+        cachedir = configuration['cache_dir']
+        pid = os.getpid()
+        cname = os.path.join(cachedir, "%s_p%d.%s" % (basename, pid, extension))
+        oname = os.path.join(cachedir, "%s_p%d.o" % (basename, pid))
+        soname = os.path.join(cachedir, "%s.so" % basename)
+        # Link into temporary file, then rename to shared library
+        # atomically (avoiding races).
+        tmpname = os.path.join(cachedir, "%s_p%d.so.tmp" % (basename, pid))
+
+        if not os.path.exists(cachedir):
+            try:
+                os.makedirs(cachedir)
+            except OSError:
+                # Someone else (another build thread) got there first
+                if not os.path.isdir(cachedir):
+                    raise
+        logfile = os.path.join(cachedir, "%s_p%d.log" % (basename, pid))
+        errfile = os.path.join(cachedir, "%s_p%d.err" % (basename, pid))
+        with progress(INFO, 'Compiling wrapper'):
+            with open(cname, "w") as f:
+                f.write(src)
+            # Compiler also links
+            if self._ld is None:
+                cc = [self._cc] + self._cppargs + \
+                     ['-o', tmpname, cname] + self._ldargs
+                debug('Compilation command: %s', ' '.join(cc))
+                with open(logfile, "w") as log:
+                    with open(errfile, "w") as err:
+                        log.write("Compilation command:\n")
+                        log.write(" ".join(cc))
+                        log.write("\n\n")
+                        try:
+                            if configuration['no_fork_available']:
+                                cc += ["2>", errfile, ">", logfile]
+                                cmd = " ".join(cc)
+                                status = os.system(cmd)
+                                if status != 0:
+                                    raise subprocess.CalledProcessError(status, cmd)
+                            else:
+                                subprocess.check_call(cc, stderr=err,
+                                                      stdout=log)
+                        except subprocess.CalledProcessError as e:
+                            raise CompilationError(
+                                """Command "%s" return error status %d.
+Unable to compile code
+Compile log in %s
+Compile errors in %s""" % (e.cmd, e.returncode, logfile, errfile))
+            else:
+                cc = [self._cc] + self._cppargs + \
+                     ['-c', '-o', oname, cname]
+                ld = self._ld.split() + ['-o', tmpname, oname] + self._ldargs
+                debug('Compilation command: %s', ' '.join(cc))
+                debug('Link command: %s', ' '.join(ld))
+                with open(logfile, "w") as log:
+                    with open(errfile, "w") as err:
+                        log.write("Compilation command:\n")
+                        log.write(" ".join(cc))
+                        log.write("\n\n")
+                        log.write("Link command:\n")
+                        log.write(" ".join(ld))
+                        log.write("\n\n")
+                        try:
+                            if configuration['no_fork_available']:
+                                cc += ["2>", errfile, ">", logfile]
+                                ld += ["2>", errfile, ">", logfile]
+                                cccmd = " ".join(cc)
+                                ldcmd = " ".join(ld)
+                                status = os.system(cccmd)
+                                if status != 0:
+                                    raise subprocess.CalledProcessError(status, cccmd)
+                                status = os.system(ldcmd)
+                                if status != 0:
+                                    raise subprocess.CalledProcessError(status, ldcmd)
+                            else:
+                                subprocess.check_call(cc, stderr=err,
+                                                      stdout=log)
+                                subprocess.check_call(ld, stderr=err,
+                                                      stdout=log)
+                        except subprocess.CalledProcessError as e:
+                            raise CompilationError(
+                                """Command "%s" return error status %d.
+Unable to compile code
+Compile log in %s
+Compile errors in %s""" % (e.cmd, e.returncode, logfile, errfile))
+            # Atomically ensure soname exists
+            os.rename(tmpname, soname)
+
+    @collective
+    def get_so(self, src, extension, background=False):
+        """Build a shared library and load it
+
+        :arg src: The source string to compile.
+        :arg extension: extension of the source file (c, cpp).
+        :kwarg background: If the library is not in the cache, build
+            it asynchronously in the build pool, on a rank chosen by
+            the hash of the code.
+
+        Returns a :class:`ctypes.CDLL` object of the resulting shared
+        library, or a :class:`PendingLibrary` if it is being built in
+        the background."""
+        basename, soname = self._names(src)
+        if background:
+            if self.comm.allreduce(os.path.exists(soname), op=MPI.LAND):
+                return ctypes.CDLL(soname)
+            owner = int(basename, 16) % self.comm.size
+            result = None
+            if self.comm.rank == owner:
+                result = _building.get(soname)
+                if result is None:
+                    result = _build_pool().apply_async(self._compile,
+                                                       (src, extension, basename))
+                    _building[soname] = result
+            return PendingLibrary(soname, owner, result, self.comm)
         try:
             # Are we in the cache?
             return ctypes.CDLL(soname)
@@ -192,78 +346,7 @@ class Compiler(object):
             # No, let's go ahead and build
             if self.comm.rank == 0:
                 # No need to do this on all ranks
-                if not os.path.exists(cachedir):
-                    os.makedirs(cachedir)
-                logfile = os.path.join(cachedir, "%s_p%d.log" % (basename, pid))
-                errfile = os.path.join(cachedir, "%s_p%d.err" % (basename, pid))
-                with progress(INFO, 'Compiling wrapper'):
-                    with open(cname, "w") as f:
-                        f.write(src)
-                    # Compiler also links
-                    if self._ld is None:
-                        cc = [self._cc] + self._cppargs + \
-                             ['-o', tmpname, cname] + self._ldargs
-                        debug('Compilation command: %s', ' '.join(cc))
-                        with open(logfile, "w") as log:
-                            with open(errfile, "w") as err:
-                                log.write("Compilation command:\n")
-                                log.write(" ".join(cc))
-                                log.write("\n\n")
-                                try:
-                                    if configuration['no_fork_available']:
-                                        cc += ["2>", errfile, ">", logfile]
-                                        cmd = " ".join(cc)
-                                        status = os.system(cmd)
-                                        if status != 0:
-                                            raise subprocess.CalledProcessError(status, cmd)
-                                    else:
-                                        subprocess.check_call(cc, stderr=err,
-                                                              stdout=log)
-                                except subprocess.CalledProcessError as e:
-                                    raise CompilationError(
-                                        """Command "%s" return error status %d.
-Unable to compile code
-Compile log in %s
-Compile errors in %s""" % (e.cmd, e.returncode, logfile, errfile))
-                    else:
-                        cc = [self._cc] + self._cppargs + \
-                             ['-c', '-o', oname, cname]
-                        ld = self._ld.split() + ['-o', tmpname, oname] + self._ldargs
-                        debug('Compilation command: %s', ' '.join(cc))
-                        debug('Link command: %s', ' '.join(ld))
-                        with open(logfile, "w") as log:
-                            with open(errfile, "w") as err:
-                                log.write("Compilation command:\n")
-                                log.write(" ".join(cc))
-                                log.write("\n\n")
-                                log.write("Link command:\n")
-                                log.write(" ".join(ld))
-                                log.write("\n\n")
-                                try:
-                                    if configuration['no_fork_available']:
-                                        cc += ["2>", errfile, ">", logfile]
-                                        ld += ["2>", errfile, ">", logfile]
-                                        cccmd = " ".join(cc)
-                                        ldcmd = " ".join(ld)
-                                        status = os.system(cccmd)
-                                        if status != 0:
-                                            raise subprocess.CalledProcessError(status, cccmd)
-                                        status = os.system(ldcmd)
-                                        if status != 0:
-                                            raise subprocess.CalledProcessError(status, ldcmd)
-                                    else:
-                                        subprocess.check_call(cc, stderr=err,
-                                                              stdout=log)
-                                        subprocess.check_call(ld, stderr=err,
-                                                              stdout=log)
-                                except subprocess.CalledProcessError as e:
-                                    raise CompilationError(
-                                        """Command "%s" return error status %d.
-Unable to compile code
-Compile log in %s
-Compile errors in %s""" % (e.cmd, e.returncode, logfile, errfile))
-                    # Atomically ensure soname exists
-                    os.rename(tmpname, soname)
+                self._compile(src, extension, basename)
             # Wait for compilation to complete
             self.comm.barrier()
             # Load resulting library
@@ -351,9 +434,92 @@ class LinuxIntelCompiler(Compiler):
                                                  cpp=cpp, comm=comm)
 
 
+def _index_entry(key):
+    """Path of the index entry for ``key``."""
+    return os.path.join(configuration['cache_dir'], "index", key)
+
+
+@collective
+def load_indexed(key, argtypes=None, restype=None, comm=None):
+    """Return a function pointer from a previously built shared library
+    recorded in the on-disk index, without generating or hashing any code.
+
+    :arg key: The (process independent) key the function was indexed under,
+         see :func:`load`.
+    :arg argtypes: A list of ctypes argument types matching the
+         arguments of the returned function (optional, pass ``None``
+         for ``void``).
+    :arg restype: The return type of the function (optional, pass
+         ``None`` for ``void``).
+    :kwarg comm: Optional communicator the library is loaded on
+        (defaults to COMM_WORLD).
+
+    Returns ``None`` if the key is not in the index on every rank of
+    ``comm``."""
+    comm = comm or COMM_WORLD
+    try:
+        with open(_index_entry(key)) as f:
+            soname, fn_name = f.read().split()
+        found = os.path.exists(soname)
+    except (IOError, OSError, ValueError):
+        found = False
+    # Everyone must agree, otherwise the ranks that miss would
+    # compile (collectively) on their own.
+    if not comm.allreduce(found, op=MPI.LAND):
+        return None
+    fn = getattr(ctypes.CDLL(soname), fn_name)
+    fn.argtypes = argtypes
+    fn.restype = restype
+    return fn
+
+
+def _index(key, soname, fn_name, comm):
+    """Record a built function in the on-disk index."""
+    if comm.rank != 0:
+        return
+    entry = _index_entry(key)
+    dirname = os.path.dirname(entry)
+    tmpname = "%s_p%d.tmp" % (entry, os.getpid())
+    try:
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(tmpname, "w") as f:
+            f.write("%s\n%s\n" % (soname, fn_name))
+        # Atomically publish the entry
+        os.rename(tmpname, entry)
+    except (IOError, OSError):
+        # The index is only an optimisation
+        debug('Unable to write JIT index entry %s', entry)
+
+
+class PendingFunction(object):
+
+    """A function from a shared library that is being built in the
+    background, see :func:`load`."""
+
+    def __init__(self, library, fn_name, argtypes, restype, index_key):
+        self._library = library
+        self._fn_name = fn_name
+        self._argtypes = argtypes
+        self._restype = restype
+        self._index_key = index_key
+
+    @collective
+    def wait(self):
+        """Wait for the build to complete and return the function."""
+        dll = self._library.wait()
+        if self._index_key is not None:
+            _index(self._index_key, dll._name, self._fn_name, self._library.comm)
+        fn = getattr(dll, self._fn_name)
+        fn.argtypes = self._argtypes
+        fn.restype = self._restype
+        return fn
+
+
 @collective
 def load(src, extension, fn_name, cppargs=[], ldargs=[],
-         argtypes=None, restype=None, compiler=None, comm=None):
+         argtypes=None, restype=None, compiler=None, comm=None, index_key=None,
+         background=False):
     """Build a shared library and return a function pointer from it.
 
     :arg src: A string containing the source to build
@@ -369,6 +535,12 @@ def load(src, extension, fn_name, cppargs=[], ldargs=[],
     :arg compiler: The name of the C compiler (intel, ``None`` for default).
     :kwarg comm: Optional communicator to compile the code on (only
         rank 0 compiles code) (defaults to COMM_WORLD).
+    :kwarg index_key: Optional process independent key to record the
+        function under in the on-disk index, see :func:`load_indexed`.
+    :kwarg background: Build the library asynchronously if it is not
+        in the cache.  A :class:`PendingFunction` is returned in that
+        case, whose (collective) :meth:`~PendingFunction.wait` returns
+        the function.
     """
     platform = sys.platform
     cpp = extension == "cpp"
@@ -382,7 +554,11 @@ def load(src, extension, fn_name, cppargs=[], ldargs=[],
     else:
         raise CompilationError("Don't know what compiler to use for platform '%s'" %
                                platform)
-    dll = compiler.get_so(src, extension)
+    dll = compiler.get_so(src, extension, background=background)
+    if isinstance(dll, PendingLibrary):
+        return PendingFunction(dll, fn_name, argtypes, restype, index_key)
+    if index_key is not None:
+        _index(index_key, dll._name, fn_name, compiler.comm)
 
     fn = getattr(dll, fn_name)
     fn.argtypes = argtypes
@@ -401,26 +577,31 @@ def clear_cache(prompt=False):
 
     files = [os.path.join(cachedir, f) for f in os.listdir(cachedir)
              if os.path.isfile(os.path.join(cachedir, f))]
-    nfiles = len(files)
+    # Index entries point at the libraries, drop them too
+    indexdir = os.path.join(cachedir, "index")
+    entries = []
+    if os.path.isdir(indexdir):
+        entries = [os.path.join(indexdir, f) for f in os.listdir(indexdir)]
 
-    if nfiles == 0:
+    if not files and not entries:
         print("No cached libraries to remove")
         return
 
+    what = "%d cached libraries and %d index entries from %s" % (len(files), len(entries), cachedir)
     remove = True
     if prompt:
 
-        user = input("Remove %d cached libraries from %s? [Y/n]: " % (nfiles, cachedir))
+        user = input("Remove %s? [Y/n]: " % what)
 
         while user.lower() not in ['', 'y', 'n']:
             print("Please answer y or n.")
-            user = input("Remove %d cached libraries from %s? [Y/n]: " % (nfiles, cachedir))
+            user = input("Remove %s? [Y/n]: " % what)
 
         if user.lower() == 'n':
             remove = False
 
     if remove:
-        print("Removing %d cached libraries from %s" % (nfiles, cachedir))
-        [os.remove(f) for f in files]
+        print("Removing %s" % what)
+        [os.remove(f) for f in files + entries]
     else:
         print("Not removing cached libraries")
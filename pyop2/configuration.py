@@ -43,6 +43,9 @@ from pyop2.exceptions import ConfigurationError
 class Configuration(dict):
     """PyOP2 configuration parameters
 
+    :param backend: Execution backend for parallel loops (one of
+        `sequential`, `openmp`).  The number of threads used by the
+        `openmp` backend is set with ``OMP_NUM_THREADS``.
     :param compiler: compiler identifier used by COFFEE (one of `gnu`, `intel`).
     :param simd_isa: Instruction set architecture (ISA) COFFEE is optimising
         for (one of `sse`, `avx`).
@@ -66,6 +69,39 @@ class Configuration(dict):
         somewhere for inspection?
     :param dump_gencode_path: Where should the generated code be
         written to?
+    :param compile_workers: How many generated libraries may be
+        compiled concurrently in the background?  Pass `0` (the
+        default) to compile synchronously when a :func:`par_loop` is
+        first executed.
+    :param jit_index: Should PyOP2 keep an on-disk index from parallel
+        loop cache keys to compiled libraries, so that code generation
+        can be skipped in new processes?  (Default no)
+    :param cache_max_entries: Maximum number of entries kept in each
+        object cache, least recently used entries are evicted beyond
+        that.  The same limit applies separately to every class-wide
+        cache (of :class:`Kernel`\s and compiled code) and to the
+        :class:`Sparsity` patterns and colourings cached on each
+        :class:`Set`.  Objects compared by identity, such as
+        :class:`DataSet`\s, are never evicted.  Pass `0` (the default)
+        for unbounded caches.
+    :param cache_max_bytes: Maximum size in bytes of the objects kept in
+        each of those caches, for objects that account for their size
+        (such as :class:`Sparsity`).  Pass `0` (the default) for no limit.
+    :param numba: Should :func:`par_loop`\s with Python function
+        kernels be compiled with Numba, if it is installed?  (Default no)
+    :param halo_neighbourhood: Should halo exchanges use MPI-3
+        neighbourhood collectives rather than persistent point-to-point
+        requests?  (Default no)
+    :param sparsity_cache: Should :class:`Sparsity` patterns be stored
+        in (and loaded from) the cache directory, keyed on the values of
+        their maps?  (Default no)
+    :param profiling: Should PyOP2 collect per :func:`par_loop`
+        performance counters in :data:`pyop2.profiling.profiler`?
+        (Default no)
+    :param column_codegen: Should the wrappers of :func:`par_loop`\s
+        over extruded sets compute the data of each layer from the
+        bottom of its column, such that the loop over the layers may be
+        vectorised?  (Default no)
     :param print_cache_size: Should PyOP2 print the size of caches at
         program exit?
     :param print_summary: Should PyOP2 print a summary of timings at
@@ -78,6 +114,7 @@ class Configuration(dict):
     """
     # name, env variable, type, default, write once
     DEFAULTS = {
+        "backend": ("PYOP2_BACKEND", str, "sequential"),
         "compiler": ("PYOP2_BACKEND_COMPILER", str, "gnu"),
         "simd_isa": ("PYOP2_SIMD_ISA", str, "sse"),
         "debug": ("PYOP2_DEBUG", bool, False),
@@ -94,7 +131,16 @@ class Configuration(dict):
         "cache_dir": ("PYOP2_CACHE_DIR", str,
                       os.path.join(gettempdir(),
                                    "pyop2-cache-uid%s" % os.getuid())),
+        "compile_workers": ("PYOP2_COMPILE_WORKERS", int, 0),
+        "jit_index": ("PYOP2_JIT_INDEX", bool, False),
         "no_fork_available": ("PYOP2_NO_FORK_AVAILABLE", bool, False),
+        "cache_max_entries": ("PYOP2_CACHE_MAX_ENTRIES", int, 0),
+        "cache_max_bytes": ("PYOP2_CACHE_MAX_BYTES", int, 0),
+        "numba": ("PYOP2_NUMBA", bool, False),
+        "halo_neighbourhood": ("PYOP2_HALO_NEIGHBOURHOOD", bool, False),
+        "sparsity_cache": ("PYOP2_SPARSITY_CACHE", bool, False),
+        "profiling": ("PYOP2_PROFILING", bool, False),
+        "column_codegen": ("PYOP2_COLUMN_CODEGEN", bool, False),
         "print_cache_size": ("PYOP2_PRINT_CACHE_SIZE", bool, False),
         "print_summary": ("PYOP2_PRINT_SUMMARY", bool, False),
         "dump_gencode_path": ("PYOP2_DUMP_GENCODE_PATH", str,
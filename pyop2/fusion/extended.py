@@ -382,6 +382,7 @@ class TilingJITModule(sequential.JITModule):
     _cppargs = ['-fpermissive']
     _libraries = []
     _extension = 'cpp'
+    _background = False
 
     _wrapper = """
 extern "C" void %(wrapper_name)s(%(executor_arg)s,
@@ -468,6 +469,11 @@ for (int n = %(tile_start)s; n < %(tile_end)s; n++) {
 
         self._argtypes = argtypes
 
+    def _persistent_key(self, *extra):
+        # The generated code depends on the inspection, which is not
+        # captured by the cache key, never reuse it across processes
+        return None
+
     def compile(self):
         # If we weren't in the cache we /must/ have arguments
         if not hasattr(self, '_args'):
@@ -136,6 +136,10 @@ def fuse(name, loop_chain, **kwargs):
         if any(not l.kernel._ast or l.kernel._attached_info['flatblocks'] for l in loop_chain):
             return loop_chain + remainder
 
+    # Batched kernels have a different calling convention
+    if any(l.kernel._batch for l in loop_chain):
+        return loop_chain + remainder
+
     # Mixed still not supported
     if any(a._is_mixed for a in flatten([l.args for l in loop_chain])):
         return loop_chain + remainder
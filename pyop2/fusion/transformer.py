@@ -44,7 +44,7 @@ from copy import deepcopy as dcopy
 from pyop2.base import READ, RW, WRITE, MIN, MAX, INC, _LazyMatOp, IterationIndex, \
     Subset, Map
 from pyop2.mpi import MPI
-from pyop2.caching import Cached
+from pyop2.caching import Cached, LRUCache
 from pyop2.profiling import timed_region
 from pyop2.utils import flatten, as_tuple, tuplify
 from pyop2.logger import warning
@@ -67,7 +67,7 @@ class Inspector(Cached):
 
     .. note:: For tiling, the Inspector relies on the SLOPE library."""
 
-    _cache = {}
+    _cache = LRUCache()
     _modes = ['soft', 'hard', 'tile', 'only_tile', 'only_omp']
 
     @classmethod
@@ -0,0 +1,238 @@
+# This file is part of PyOP2
+#
+# PyOP2 is Copyright (c) 2012-2014, Imperial College London and
+# others. Please see the AUTHORS file in the main source directory for
+# a full list of copyright holders.  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * The name of Imperial College London or that of other
+#       contributors may not be used to endorse or promote products
+#       derived from this software without specific prior written
+#       permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTERS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Python parallel loops compiled with Numba.
+
+The loop over the iteration set, gathering indirectly accessed data
+into buffers around each call of the kernel and scattering it back
+afterwards, is generated as Python code which Numba compiles together
+with the kernel, a Python function.  No C compiler is required.
+
+Kernels follow the conventions of :mod:`pyop2.pyparloop`, except that,
+as in generated C code, indirect INC arguments are zeroed before the
+kernel is called and added into the :class:`~.Dat` afterwards.  The
+generated code is written to the cache directory, such that Numba's
+on-disk cache keeps the compiled code across runs.
+
+Loops that are not supported (on :class:`~.Mat`\s, :class:`~.MixedDat`\s,
+or using iteration indices), loops with a ``batch_size`` and all loops
+when Numba is not installed are executed by :mod:`pyop2.pyparloop`.
+"""
+
+from __future__ import absolute_import, print_function, division
+
+import inspect
+import marshal
+import os
+from hashlib import md5
+
+import numpy as np
+
+from pyop2 import base, pyparloop
+from pyop2.caching import Cached, LRUCache
+from pyop2.configuration import configuration
+from pyop2.datatypes import IntType
+from pyop2.logger import warning
+from pyop2.utils import cached_property
+
+try:
+    import numba
+except ImportError:
+    numba = None
+    warning("Numba is not available, Python kernels are interpreted")
+
+
+Kernel = pyparloop.Kernel
+
+
+class JITModule(Cached):
+
+    """A Numba compiled loop executing a Python kernel.
+
+    :arg kernel: The :class:`~.pyparloop.Kernel` to execute.
+    :arg itspace: The :class:`~.IterationSpace` to iterate over.
+    :arg \*args: The :class:`~.Arg`\s of the loop.
+    """
+
+    _cache = LRUCache()
+
+    @classmethod
+    def _cache_key(cls, kernel, itspace, *args):
+        key = (kernel._func, isinstance(itspace._iterset, base.Subset))
+        for arg in args:
+            if arg._is_global:
+                key += (("global", arg.access, None, None, None), )
+            elif arg._is_direct:
+                key += (("direct", arg.access, arg.data._data.ndim, None, None), )
+            else:
+                key += (("indirect", arg.access, arg.data._data.ndim,
+                         arg.map.arity, None if arg._is_vec_map else arg.idx), )
+        return key
+
+    def __init__(self, kernel, itspace, *args):
+        if self._initialized:
+            return
+        self._func = kernel._func
+        self._args = self._key[2:]
+        self._subset = self._key[1]
+        self._fun = None
+        self._initialized = True
+
+    @cached_property
+    def code(self):
+        """The Python source of the loop."""
+        params = ["start", "end", "indices"]
+        decls = []
+        gathers = []
+        kernel_args = []
+        scatters = []
+        for i, (kind, access, ndim, arity, idx) in enumerate(self._args):
+            name = "arg%d" % i
+            params.append(name)
+            if kind == "global":
+                kernel_args.append(name)
+                continue
+            if kind == "direct":
+                kernel_args.append("%s[i]" % name if ndim > 1 else "%s[i:i + 1]" % name)
+                continue
+            buf = "buf%d" % i
+            map_ = "map%d" % i
+            params.append(map_)
+            kernel_args.append(buf)
+            size = arity if idx is None else 1
+            if ndim > 1:
+                decls.append("%s = np.empty((%d, %s.shape[1]), dtype=%s.dtype)" % (buf, size, name, name))
+                entry = "%s[j, :]" % buf
+                value = "%s[%s[i, %s], :]" % (name, map_, "j" if idx is None else idx)
+            else:
+                decls.append("%s = np.empty(%d, dtype=%s.dtype)" % (buf, size, name))
+                entry = "%s[j]" % buf
+                value = "%s[%s[i, %s]]" % (name, map_, "j" if idx is None else idx)
+            if access is base.INC:
+                gathers.append("%s[:] = 0" % buf)
+            else:
+                gathers.append("for j in range(%d):\n            %s = %s" % (size, entry, value))
+            if access is not base.READ:
+                op = "+=" if access is base.INC else "="
+                scatters.append("for j in range(%d):\n            %s %s %s" % (size, value, op, entry))
+        lines = ["def loop(%s):" % ", ".join(params)]
+        lines.extend("    " + d for d in decls)
+        lines.append("    for n in range(start, end):")
+        lines.append("        i = indices[n]" if self._subset else "        i = n")
+        lines.extend("        " + g for g in gathers)
+        lines.append("        kernel(%s)" % ", ".join(kernel_args))
+        lines.extend("        " + s for s in scatters)
+        return "\n".join(lines) + "\n"
+
+    def compile(self):
+        """Compile the loop and the kernel with Numba."""
+        cache = _cacheable(self._func)
+        kernel = numba.njit(cache=cache)(self._func)
+        digest = md5(self.code.encode() + marshal.dumps(self._func.__code__)).hexdigest()
+        if cache:
+            # Numba caches functions whose source is in a file
+            filename = os.path.join(configuration["cache_dir"], "numba", "%s.py" % digest)
+            _write(filename, self.code)
+        else:
+            filename = "<pyop2-numba-%s>" % digest
+        namespace = {"__name__": "pyop2_numba_%s" % digest, "np": np, "kernel": kernel}
+        exec(compile(self.code, filename, "exec"), namespace)
+        self._fun = numba.njit(cache=cache)(namespace["loop"])
+
+    def __call__(self, start, end, indices, *arglist):
+        if self._fun is None:
+            self.compile()
+        self._fun(start, end, indices, *arglist)
+
+
+def _cacheable(func):
+    """Can Numba cache compiled code of ``func`` on disk?  Only
+    functions defined in source files, without closures, which are
+    not part of the cache key."""
+    if func.__closure__ is not None:
+        return False
+    try:
+        filename = inspect.getsourcefile(func)
+    except TypeError:
+        return False
+    return filename is not None and os.path.isfile(filename)
+
+
+def _write(filename, code):
+    """Atomically write ``code`` to ``filename`` unless it exists."""
+    if os.path.exists(filename):
+        return
+    dirname = os.path.dirname(filename)
+    if not os.path.exists(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # Someone else got there first
+            pass
+    tmpname = "%s_p%d.tmp" % (filename, os.getpid())
+    with open(tmpname, "w") as f:
+        f.write(code)
+    os.rename(tmpname, filename)
+
+
+class ParLoop(pyparloop.ParLoop):
+
+    @cached_property
+    def _numba_supported(self):
+        if numba is None:
+            return False
+        for arg in self.args:
+            if arg._is_mat or isinstance(arg.data, base.MixedDat):
+                return False
+            if arg._is_dat and arg.data._data.ndim > 2:
+                return False
+            if arg._is_indirect and isinstance(arg.idx, base.IterationIndex):
+                return False
+        return True
+
+    def _compute_elements(self, part):
+        if not self._numba_supported:
+            return super(ParLoop, self)._compute_elements(part)
+        fun = JITModule(self._kernel, self._it_space, *self.args)
+        iterset = self._it_space._iterset
+        if isinstance(iterset, base.Subset):
+            indices = iterset._indices
+        else:
+            indices = np.empty(0, dtype=IntType)
+        arglist = []
+        for arg in self.args:
+            data = arg.data._data
+            arglist.append(data.reshape(1) if data.shape == () else data)
+            if arg._is_indirect:
+                arglist.append(arg.map.values_with_halo)
+        fun(part.offset, part.offset + part.size, indices, *arglist)
@@ -37,17 +37,19 @@ from __future__ import absolute_import, print_function, division
 import atexit
 
 from pyop2.configuration import configuration
+from pyop2.exceptions import ConfigurationError
 from pyop2.logger import debug, info, warning, error, critical, set_log_level
 from pyop2.mpi import MPI, COMM_WORLD, collective
 
-from pyop2.base import i                      # noqa: F401
+from pyop2.base import i, inner_products      # noqa: F401
+from pyop2.base import _trace
 from pyop2.sequential import par_loop, Kernel  # noqa: F401
 from pyop2.sequential import READ, WRITE, RW, INC, MIN, MAX  # noqa: F401
 from pyop2.sequential import ON_BOTTOM, ON_TOP, ON_INTERIOR_FACETS, ALL  # noqa: F401
 from pyop2.sequential import Set, ExtrudedSet, MixedSet, Subset, DataSet, MixedDataSet, LocalSet  # noqa: F401
 from pyop2.sequential import Map, MixedMap, DecoratedMap, Sparsity, Halo  # noqa: F401
 from pyop2.sequential import Global, GlobalDataSet        # noqa: F401
-from pyop2.sequential import Dat, MixedDat, DatView, Mat  # noqa: F401
+from pyop2.sequential import Dat, MixedDat, DatView, Mat, MatrixFree  # noqa: F401
 
 from coffee import coffee_init, O0
 
@@ -56,13 +58,15 @@ __all__ = ['configuration', 'READ', 'WRITE', 'RW', 'INC', 'MIN', 'MAX',
            'i', 'debug', 'info', 'warning', 'error', 'critical', 'initialised',
            'set_log_level', 'MPI', 'init', 'exit', 'Kernel', 'Set', 'ExtrudedSet',
            'LocalSet', 'MixedSet', 'Subset', 'DataSet', 'GlobalDataSet', 'MixedDataSet',
-           'Halo', 'Dat', 'MixedDat', 'Mat', 'Global', 'Map', 'MixedMap',
-           'Sparsity', 'par_loop',
+           'Halo', 'Dat', 'MixedDat', 'Mat', 'MatrixFree', 'Global', 'Map', 'MixedMap',
+           'Sparsity', 'par_loop', 'inner_products',
            'DatView', 'DecoratedMap']
 
 
 _initialised = False
 
+_backends = ('sequential', 'openmp')
+
 
 def initialised():
     """Check whether PyOP2 has been yet initialised but not yet finalised."""
@@ -74,6 +78,9 @@ def init(**kwargs):
     """Initialise PyOP2: select the backend and potentially other configuration
     options.
 
+    :arg backend:   The backend to use for executing parallel loops.
+                    Options: sequential, openmp.  The default is
+                    sequential.
     :arg debug:     The level of debugging output.
     :arg comm:      The MPI communicator to use for parallel communication,
                     defaults to `MPI_COMM_WORLD`
@@ -95,6 +102,12 @@ def init(**kwargs):
        raise an exception.
     """
     global _initialised
+    backend = kwargs.get('backend', configuration['backend'])
+    if backend not in _backends:
+        raise ConfigurationError("Unknown backend %r, must be one of %s"
+                                 % (backend, ', '.join(_backends)))
+    if _initialised and backend != configuration['backend']:
+        raise RuntimeError("Changing the backend is not possible once set.")
     configuration.reconfigure(**kwargs)
 
     set_log_level(configuration['log_level'])
@@ -107,8 +120,10 @@ def init(**kwargs):
 @collective
 def exit():
     """Exit OP2 and clean up"""
+    # Reductions may still be in flight
+    _trace.complete_all()
     if configuration['print_cache_size'] and COMM_WORLD.rank == 0:
-        from caching import report_cache, Cached, ObjectCached
+        from pyop2.caching import report_cache, Cached, ObjectCached
         print('**** PyOP2 cache sizes at exit ****')
         report_cache(typ=ObjectCached)
         report_cache(typ=Cached)
@@ -0,0 +1,303 @@
+# This file is part of PyOP2
+#
+# PyOP2 is Copyright (c) 2012, Imperial College London and
+# others. Please see the AUTHORS file in the main source directory for
+# a full list of copyright holders.  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * The name of Imperial College London or that of other
+#       contributors may not be used to endorse or promote products
+#       derived from this software without specific prior written
+#       permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTERS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""OP2 OpenMP backend.
+
+Code generation and execution are shared with the sequential backend,
+the generated wrapper is annotated with OpenMP pragmas.  Iteration
+sets of indirect loops that write to shared data are coloured such
+that no two elements of the same colour touch the same data, the
+elements of one colour are then executed concurrently."""
+from __future__ import absolute_import, print_function, division
+from six.moves import range
+
+import ctypes
+import numpy as np
+
+from pyop2.datatypes import IntType
+from pyop2 import sequential
+from pyop2.base import READ, Subset
+from pyop2.caching import ObjectCached, LRUCache
+from pyop2.mpi import collective
+from pyop2.profiling import timed_region
+from pyop2.utils import cached_property
+from pyop2.sequential import Kernel, DataSet, MixedDataSet  # noqa: F401
+from pyop2.sequential import Dat, MixedDat, Global, GlobalDataSet  # noqa: F401
+
+import coffee.system
+
+
+def _omp_flag():
+    """The compiler flag enabling OpenMP for the configured compiler."""
+    compiler = coffee.system.compiler
+    if compiler and compiler.get('name') == 'intel':
+        return "-qopenmp"
+    return "-fopenmp"
+
+
+class Plan(ObjectCached):
+
+    """A colouring of an iteration set that allows race-free parallel
+    execution of a :func:`par_loop`.
+
+    Elements are greedily assigned the lowest colour not yet taken by
+    any element sharing an entry of one of the provided maps.  Maps
+    into the same target :class:`Set` are considered together.  Plans
+    are cached on the iteration set, keyed on the conflicting maps.
+
+    :arg iterset: The iteration :class:`Set` (or :class:`Subset`).
+    :arg maps: The :class:`Map`\s through which data is written.
+    """
+
+    def __init__(self, iterset, *maps):
+        if self._initialized:
+            return
+        self._iterset = iterset
+        self._maps = maps
+        self._partitions = {}
+        self._initialized = True
+
+    # Plans are recomputed on demand, no one holds on to them
+    _cache_evictable = True
+
+    @classmethod
+    def _process_args(cls, iterset, *maps, **kwargs):
+        return (iterset, iterset) + maps, kwargs
+
+    @classmethod
+    def _cache_key(cls, iterset, *maps, **kwargs):
+        return (cls, iterset) + maps
+
+    @property
+    def _cache_nbytes(self):
+        """Memory held by the colouring, for cache accounting."""
+        colours = self.__dict__.get('colours')
+        return 0 if colours is None else 2 * colours.nbytes
+
+    @cached_property
+    def colours(self):
+        """The colour of each element of the iteration set."""
+        iterset = self._iterset
+        nelems = iterset.total_size
+        colours = np.zeros(nelems, dtype=IntType)
+        if not self._maps:
+            return colours
+        if isinstance(iterset, Subset):
+            rows = iterset.indices
+        else:
+            rows = slice(0, nelems)
+        # One bit mask per target set, maps into the same set can
+        # touch the same data.  Extruded sets are coloured on their
+        # base maps, one element being an entire column.
+        masks = {}
+        values = []
+        for m in self._maps:
+            if m.toset not in masks:
+                masks[m.toset] = [0] * m.toset.total_size
+            values.append((m.values_with_halo[rows].tolist(), masks[m.toset]))
+        for e in range(nelems):
+            forbidden = 0
+            for vals, mask in values:
+                for v in vals[e]:
+                    if v >= 0:
+                        forbidden |= mask[v]
+            # Lowest bit not set in forbidden
+            c = (~forbidden & (forbidden + 1)).bit_length() - 1
+            colours[e] = c
+            bit = 1 << c
+            for vals, mask in values:
+                for v in vals[e]:
+                    if v >= 0:
+                        mask[v] |= bit
+        return colours
+
+    @cached_property
+    def ncolours(self):
+        """The number of colours used."""
+        if len(self.colours) == 0:
+            return 0
+        return int(self.colours.max()) + 1
+
+    def partition(self, part):
+        """Return the elements of a :class:`~.SetPartition` sorted by
+        colour together with the offsets of each colour.
+
+        :arg part: The partition of the iteration set to execute.
+        :returns: a tuple ``(elements, offsets)`` where the elements of
+            colour ``c`` are ``elements[offsets[c]:offsets[c+1]]``."""
+        key = (part.offset, part.size)
+        try:
+            return self._partitions[key]
+        except KeyError:
+            pass
+        colours = self.colours[part.offset:part.offset + part.size]
+        elements = (np.argsort(colours, kind='mergesort') + part.offset).astype(IntType)
+        counts = np.bincount(colours, minlength=self.ncolours)
+        offsets = np.concatenate(([0], np.cumsum(counts))).astype(IntType)
+        self._partitions[key] = elements, offsets
+        return elements, offsets
+
+
+class Arg(sequential.Arg):
+
+    def c_global_reduction_name(self, count=None):
+        return "%(name)s_l%(count)d[0]" % {'name': self.c_arg_name(), 'count': count}
+
+    def c_addto(self, *args, **kwargs):
+        # Matrix insertion is not thread safe
+        return """
+#pragma omp critical
+{
+%s
+}""" % super(Arg, self).c_addto(*args, **kwargs)
+
+
+class JITModule(sequential.JITModule):
+
+    _wrapper = """
+void %(wrapper_name)s(int start,
+                      int end,
+                      %(IntType)s *colinds,
+                      %(ssinds_arg)s
+                      %(wrapper_args)s
+                      %(layer_arg)s) {
+  %(user_code)s
+  %(wrapper_decs)s;
+  #pragma omp parallel
+  {
+    %(map_decl)s
+    %(vec_decs)s;
+    %(interm_globals_decl)s;
+    %(interm_globals_init)s;
+    #pragma omp for schedule(static)
+    for ( int n = start; n < end; n++ ) {
+      %(IntType)s i = %(index_expr)s;
+      %(vec_inits)s;
+      %(map_init)s;
+      %(extr_loop)s
+      %(map_bcs_m)s;
+      %(buffer_decl)s;
+      %(buffer_gather)s
+      %(kernel_name)s(%(kernel_args)s);
+      %(itset_loop_body)s
+      %(map_bcs_p)s;
+      %(apply_offset)s;
+      %(extr_loop_close)s
+    }
+    %(interm_globals_writeback)s;
+  }
+}
+"""
+
+    _batched_wrapper = """
+void %(wrapper_name)s(int start,
+                      int end,
+                      %(IntType)s *colinds,
+                      %(ssinds_arg)s
+                      %(wrapper_args)s) {
+  %(user_code)s
+  #pragma omp parallel for schedule(static)
+  for ( int n = start; n < end; n += %(batch)d ) {
+    %(batch_decs)s;
+    int nb = end - n < %(batch)d ? end - n : %(batch)d;
+    for ( int b = 0; b < nb; b++ ) {
+      %(IntType)s i = %(index_expr)s;
+      %(batch_gather)s
+    }
+    %(kernel_name)s(nb, %(kernel_args)s);
+    for ( int b = 0; b < nb; b++ ) {
+      %(IntType)s i = %(index_expr)s;
+      %(batch_scatter)s
+    }
+  }
+}
+"""
+
+    # Separate from the sequential cache, the generated code differs
+    _cache = LRUCache()
+
+    @collective
+    def compile(self):
+        flag = _omp_flag()
+        if flag not in self._cppargs:
+            self._cppargs.append(flag)
+            self._libraries.append(flag)
+        return super(JITModule, self).compile()
+
+    def generate_code(self):
+        if not self._code_dict:
+            batch = self._kernel._batch
+            if batch and any(arg._is_global_reduction for arg in self._args):
+                raise NotImplementedError("Batched kernels with global reductions "
+                                          "are not supported by the OpenMP backend")
+            code = super(JITModule, self).generate_code()
+            # The elements of one batch are consecutive in colour order
+            n = "n + b" if batch else "n"
+            if isinstance(self._itspace._iterset, Subset):
+                code['index_expr'] = "ssinds[colinds[%s]]" % n
+            else:
+                code['index_expr'] = "colinds[%s]" % n
+        return self._code_dict
+
+    def set_argtypes(self, iterset, *args):
+        super(JITModule, self).set_argtypes(iterset, *args)
+        self._argtypes.insert(2, ctypes.c_voidp)
+
+
+class ParLoop(sequential.ParLoop):
+
+    @cached_property
+    def _jitmodule(self):
+        return JITModule(self.kernel, self.it_space, *self.args,
+                         direct=self.is_direct, iterate=self.iteration_region,
+                         pass_layer_arg=self._pass_layer_arg,
+                         columns=self._columns)
+
+    @cached_property
+    def _plan(self):
+        maps = []
+        for arg in self.args:
+            if arg._is_indirect and arg.access is not READ:
+                for m in arg.map:
+                    if m not in maps:
+                        maps.append(m)
+        return Plan(self.iterset, *maps)
+
+    @collective
+    def _compute(self, part, fun, *arglist):
+        with timed_region("ParLoop%s" % self.iterset.name):
+            elements, offsets = self._plan.partition(part)
+            for c in range(len(offsets) - 1):
+                if offsets[c + 1] > offsets[c]:
+                    fun(offsets[c], offsets[c + 1], elements.ctypes.data, *arglist)
+            self.log_flops()
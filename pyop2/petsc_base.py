@@ -363,6 +363,65 @@ class Dat(base.Dat):
 
 class MixedDat(base.MixedDat):
 
+    def __init__(self, mdset_or_dats):
+        source = None
+        if isinstance(mdset_or_dats, base.MixedDat):
+            source = mdset_or_dats
+            mdset_or_dats = tuple(d.dataset for d in source)
+        dsets = tuple(d ** 1 if type(d) in (base.Set, base.ExtrudedSet) else d
+                      for d in mdset_or_dats)
+        if not all(type(d) in (DataSet, base.DataSet) for d in dsets):
+            # Built from existing Dats, their storage is kept as is.
+            base.MixedDat.__init__(self, mdset_or_dats)
+            self._vec_array = None
+            return
+        # Allocate the components as views of a single buffer, each
+        # with its halo following its owned entries.
+        dtype = source.dtype if source is not None else np.float64
+        sizes = [d.total_size * d.cdim for d in dsets]
+        offsets = np.concatenate(([0], np.cumsum(sizes))).astype(int)
+        buf = np.zeros(offsets[-1], dtype=dtype)
+        base.MixedDat.__init__(self, [_make_object('Dat', d, buf[o:o + n], dtype=dtype)
+                                      for d, o, n in zip(dsets, offsets, sizes)])
+        if source is not None:
+            for s, d in zip(source, self):
+                s.copy(d)
+        # When no component but the last has halo entries (always the
+        # case in serial), the owned entries are contiguous and in
+        # the PETSc ordering, so a Vec can wrap the buffer directly.
+        if all(d.total_size == d.size for d in dsets[:-1]):
+            self._vec_array = buf[:sum(d.size * d.cdim for d in dsets)]
+        else:
+            self._vec_array = None
+
+    @contextmanager
+    def vec_context(self, readonly=True):
+        """A context manager for a :class:`PETSc.Vec` wrapping the
+        storage of this :class:`MixedDat` without copying it.
+
+        :param readonly: Access the data read-only or read-write.
+                         Read-write access requires a halo update.
+
+        Falls back to :meth:`vecscatter` when the components do not
+        share contiguous storage."""
+        if self._vec_array is None:
+            with self.vecscatter(readonly=readonly) as v:
+                yield v
+            return
+        assert self.dtype == PETSc.ScalarType, \
+            "Can't create Vec with type %s, must be %s" % (self.dtype, PETSc.ScalarType)
+        for d in self:
+            d._force_evaluation(read=True, write=not readonly)
+        if not hasattr(self, '_vec'):
+            size = self.dataset.layout_vec.getSizes()
+            self._vec = PETSc.Vec().createWithArray(self._vec_array, size=size,
+                                                    comm=self.comm)
+        # The data may have changed behind PETSc's back.
+        self._vec.stateIncrease()
+        yield self._vec
+        if not readonly:
+            self.needs_halo_update = True
+
     @contextmanager
     def vecscatter(self, readonly=True):
         """A context manager scattering the arrays of all components of this
@@ -412,7 +471,7 @@ class MixedDat(base.MixedDat):
         """Context manager for a PETSc Vec appropriate for this Dat.
 
         You're allowed to modify the data you get back from this view."""
-        return self.vecscatter(readonly=False)
+        return self.vec_context(readonly=False)
 
     @property
     @collective
@@ -420,7 +479,7 @@ class MixedDat(base.MixedDat):
         """Context manager for a PETSc Vec appropriate for this Dat.
 
         You're not allowed to modify the data you get back from this view."""
-        return self.vecscatter()
+        return self.vec_context()
 
 
 class Global(base.Global):
@@ -594,6 +653,20 @@ class MatBlock(base.Mat):
         return base._LazyMatOp(self, closure, new_state=Mat.INSERT_VALUES,
                                write=True).enqueue()
 
+    def addto_values_batched(self, rows, cols, values):
+        """Add the blocks of values of a batch of elements to the :class:`Mat`."""
+        closure = partial(sparsity.insert_blocks, self.handle,
+                          rows, cols, values, True)
+        return base._LazyMatOp(self, closure, new_state=Mat.ADD_VALUES,
+                               read=True, write=True).enqueue()
+
+    def set_values_batched(self, rows, cols, values):
+        """Set the blocks of values of a batch of elements in the :class:`Mat`."""
+        closure = partial(sparsity.insert_blocks, self.handle,
+                          rows, cols, values, False)
+        return base._LazyMatOp(self, closure, new_state=Mat.INSERT_VALUES,
+                               write=True).enqueue()
+
     def assemble(self):
         raise RuntimeError("Should never call assemble on MatBlock")
 
@@ -899,6 +972,20 @@ class Mat(base.Mat):
         return base._LazyMatOp(self, closure, new_state=Mat.INSERT_VALUES,
                                write=True).enqueue()
 
+    def addto_values_batched(self, rows, cols, values):
+        """Add the blocks of values of a batch of elements to the :class:`Mat`."""
+        closure = partial(sparsity.insert_blocks, self.handle,
+                          rows, cols, values, True)
+        return base._LazyMatOp(self, closure, new_state=Mat.ADD_VALUES,
+                               read=True, write=True).enqueue()
+
+    def set_values_batched(self, rows, cols, values):
+        """Set the blocks of values of a batch of elements in the :class:`Mat`."""
+        closure = partial(sparsity.insert_blocks, self.handle,
+                          rows, cols, values, False)
+        return base._LazyMatOp(self, closure, new_state=Mat.INSERT_VALUES,
+                               write=True).enqueue()
+
     @utils.cached_property
     def blocks(self):
         """2-dimensional array of matrix blocks."""
@@ -1106,3 +1193,88 @@ class _GlobalMatPayload(object):
             return _GlobalMat(self.global_.duplicate())
         else:
             return _GlobalMat()
+
+
+class MatrixFree(object):
+    """A linear operator applied by a :func:`par_loop`, without ever
+    assembling a matrix.
+
+    The operator is exposed as a python :class:`PETSc.Mat` (see
+    :attr:`handle`) whose ``mult`` runs the action kernel directly on
+    :class:`Dat`\s.  It may be given to any PETSc solver or
+    preconditioner that only requires matrix-vector products.  No
+    :class:`Sparsity` is built, so high-order operators cost no more
+    memory than their coefficient fields.
+
+    :arg dsets: a pair of :class:`DataSet`\s giving the row (range)
+        and column (domain) spaces of the operator, or a single
+        :class:`DataSet` used for both.
+    :arg kernel: the :class:`Kernel` computing the local action.  It
+        is called as ``kernel(y, x, *args)`` and must increment ``y``
+        with the local operator applied to ``x``.
+    :arg iterset: the :class:`Set` to iterate over.
+    :arg maps: a pair of :class:`Map`\s from ``iterset`` to the row
+        and column sets, or a single :class:`Map` used for both.  Pass
+        ``None`` for a direct operator.
+    :arg args: further :class:`Arg`\s passed to the kernel after
+        ``x``, typically coefficients accessed ``READ``.
+    :arg iterate: the region of an :class:`ExtrudedSet` to iterate
+        over (optional).
+    :arg name: a name for the operator (optional).
+
+    The parallel loop is built once and enqueued by every product, so
+    the generated code, the halo exchanges of its arguments and any
+    colouring plan are reused for the lifetime of the operator."""
+
+    def __init__(self, dsets, kernel, iterset, maps=None, args=(),
+                 iterate=None, name=None):
+        if not isinstance(dsets, (tuple, list)):
+            dsets = (dsets, dsets)
+        if not isinstance(maps, (tuple, list)):
+            maps = (maps, maps)
+        dsets = tuple(d ** 1 if isinstance(d, base.Set) else d for d in dsets)
+        self.dsets = dsets
+        self.maps = tuple(maps)
+        self.name = name or "matrix_free"
+        self.comm = iterset.comm
+        # Work vectors the action reads from and increments into.
+        self._y, self._x = [_make_object("MixedDat" if isinstance(d, base.MixedDataSet) else "Dat", d)
+                            for d in dsets]
+        yarg = self._y(base.INC, self.maps[0])
+        xarg = self._x(base.READ, self.maps[1])
+        self._loop = _make_object("ParLoop", kernel, iterset, yarg, xarg,
+                                  *args, iterate=iterate)
+
+    @utils.cached_property
+    def handle(self):
+        """The :class:`PETSc.Mat` applying this operator."""
+        sizes = tuple(d.layout_vec.getSizes() for d in self.dsets)
+        A = PETSc.Mat().createPython(sizes, comm=self.comm)
+        A.setPythonContext(_MatrixFreePayload(self))
+        A.setUp()
+        return A
+
+    @collective
+    def mult(self, x, y):
+        """Apply the operator, ``y = A x``.
+
+        :arg x: the :class:`Dat` to apply the operator to.
+        :arg y: the :class:`Dat` to store the result in."""
+        with x.vec_ro as xv, y.vec as yv:
+            self.handle.mult(xv, yv)
+
+
+class _MatrixFreePayload(object):
+
+    def __init__(self, op):
+        self.op = op
+
+    def mult(self, mat, x, y):
+        '''Y = mat x'''
+        op = self.op
+        with op._x.vec as v:
+            x.copy(v)
+        op._y.zero()
+        op._loop.enqueue()
+        with op._y.vec_ro as v:
+            v.copy(y)
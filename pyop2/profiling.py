@@ -33,6 +33,13 @@
 
 from __future__ import absolute_import, print_function, division
 
+import csv
+import json
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import six
 from petsc4py import PETSc
 from decorator import decorator
 
@@ -60,3 +67,149 @@ class timed_function(object):
             with timed_region(self.name):
                 return f(*args, **kwargs)
         return decorator(wrapper, f)
+
+
+class LoopProfile(object):
+
+    """Performance counters of the :func:`~.par_loop`\s executing the
+    same code (sharing a :class:`~.JITModule`).
+
+    Times are wall clock seconds of this process.  Bytes are estimated
+    from the arguments of the loops, see :attr:`.ParLoop.nbytes`.
+
+    :arg name: A descriptive name, the kernel and iteration set names.
+    """
+
+    fields = ("name", "calls", "elements", "core_time", "owned_time",
+              "exec_time", "halo_time", "time", "bytes_read",
+              "bytes_written", "flops", "arithmetic_intensity",
+              "bandwidth", "flop_rate")
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.elements = 0
+        self.core_time = 0.0
+        self.owned_time = 0.0
+        self.exec_time = 0.0
+        self.halo_time = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.flops = 0
+
+    @property
+    def time(self):
+        """Total time, including waiting for halo exchanges."""
+        return self.core_time + self.owned_time + self.exec_time + self.halo_time
+
+    @property
+    def bytes(self):
+        """Bytes moved, read and written."""
+        return self.bytes_read + self.bytes_written
+
+    @property
+    def arithmetic_intensity(self):
+        """Flops per byte moved."""
+        return self.flops / self.bytes if self.bytes else 0.0
+
+    @property
+    def bandwidth(self):
+        """Achieved bandwidth in GB/s."""
+        return self.bytes / self.time / 1e9 if self.time else 0.0
+
+    @property
+    def flop_rate(self):
+        """Achieved flop rate in GFLOP/s."""
+        return self.flops / self.time / 1e9 if self.time else 0.0
+
+    def as_dict(self):
+        """The counters as an ordered dictionary."""
+        return OrderedDict((f, getattr(self, f)) for f in self.fields)
+
+    def __repr__(self):
+        return "LoopProfile(%r)" % self.name
+
+
+class Profiler(object):
+
+    """A registry of :class:`LoopProfile`\s, collected when the
+    ``profiling`` configuration option is set.
+
+    Profiles are process local, write one file per rank when running
+    in parallel."""
+
+    def __init__(self):
+        self._profiles = OrderedDict()
+
+    def profile(self, key, name):
+        """Return the :class:`LoopProfile` for ``key``, creating it if
+        necessary.
+
+        :arg key: The (hashable) key of the code executed.
+        :arg name: The name of a new profile."""
+        try:
+            return self._profiles[key]
+        except KeyError:
+            return self._profiles.setdefault(key, LoopProfile(name))
+
+    def __iter__(self):
+        return iter(six.itervalues(self._profiles))
+
+    def __len__(self):
+        return len(self._profiles)
+
+    def reset(self):
+        """Drop all profiles."""
+        self._profiles.clear()
+
+    def as_dicts(self):
+        """The profiles, as a list of dictionaries, sorted by time spent."""
+        return [p.as_dict() for p in sorted(self, key=lambda p: p.time, reverse=True)]
+
+    def to_json(self, filename=None):
+        """Return the profiles as JSON, optionally written to ``filename``."""
+        data = json.dumps(self.as_dicts(), indent=2)
+        if filename is not None:
+            with open(filename, "w") as f:
+                f.write(data)
+        return data
+
+    def report(self, stream=None):
+        """Print a table of the profiles, sorted by time spent, with
+        the arithmetic intensity and achieved rates of each loop.
+
+        :arg stream: File to print to, defaults to standard output."""
+        template = "%-40s %8s %10s %10s %10s %10s"
+        print(template % ("loop", "calls", "time (s)", "flop/byte",
+                          "GB/s", "GFLOP/s"), file=stream)
+        for p in sorted(self, key=lambda p: p.time, reverse=True):
+            print(template % (p.name[:40], p.calls, "%.4g" % p.time,
+                              "%.3g" % p.arithmetic_intensity,
+                              "%.3g" % p.bandwidth, "%.3g" % p.flop_rate),
+                  file=stream)
+
+    def to_csv(self, filename):
+        """Write the profiles to ``filename`` as CSV."""
+        with open(filename, "w") as f:
+            writer = csv.DictWriter(f, fieldnames=LoopProfile.fields)
+            writer.writeheader()
+            for row in self.as_dicts():
+                writer.writerow(row)
+
+
+profiler = Profiler()
+"""The :class:`Profiler` collecting the profiles of all :func:`~.par_loop`\s."""
+
+
+@contextmanager
+def timed_counter(profile, counter):
+    """Add the time spent in the context to the ``counter`` attribute
+    of ``profile``, unless it is ``None``."""
+    if profile is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        setattr(profile, counter, getattr(profile, counter) + time.time() - start)
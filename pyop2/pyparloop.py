@@ -72,6 +72,18 @@ Example usage::
   #  [ 3.  4.]
   #  [ 5.  6.]
   #  [ 3.  0.]]
+
+Passing ``batch_size`` to :func:`~.par_loop` instead calls the function
+once per chunk of that many elements, with a leading axis over the
+chunk on every argument::
+
+.. code-block:: python
+
+  def fn3(x, y):
+      x[:, 0] += y[:, 0]
+      x[:, 1] += y[:, 0]
+
+  op2.par_loop(fn3, s, d2(op2.INC), d(op2.READ, m[1]), batch_size=1024)
 """
 
 from __future__ import absolute_import, print_function, division
@@ -104,15 +116,45 @@ class Kernel(base.Kernel):
 # Inherit from parloop for type checking and init
 class ParLoop(base.ParLoop):
 
+    def __init__(self, kernel, *args, **kwargs):
+        self._batch_size = kwargs.pop("batch_size", None)
+        if self._batch_size is not None and self._batch_size < 1:
+            raise ValueError("batch_size must be a positive integer")
+        super(ParLoop, self).__init__(kernel, *args, **kwargs)
+
     def _compute(self, part, *arglist):
         if part.set._extruded:
             raise NotImplementedError
-        subset = isinstance(self._it_space._iterset, base.Subset)
 
         for arg in self.args:
             if arg._is_dat and arg.data._is_allocated:
                 for d in arg.data:
                     d._data.setflags(write=True)
+        if self._batch_size:
+            self._compute_batched(part)
+        else:
+            self._compute_elements(part)
+
+        for arg in self.args:
+            if arg._is_dat and arg.data._is_allocated:
+                for d in arg.data:
+                    d._data.setflags(write=False)
+            if arg._is_mat and arg.access is not base.READ:
+                # Queue up assembly of matrix
+                arg.data.assemble()
+                # Now force the evaluation of everything.  Python
+                # parloops are not performance critical, so this is
+                # fine.
+                # We need to do this because the
+                # set_values/addto_values calls are lazily evaluated,
+                # and the parloop is already lazily evaluated so this
+                # lazily spawns lazy computation and getting
+                # everything to execute in the right order is
+                # otherwise madness.
+                arg.data._force_evaluation(read=True, write=False)
+
+    def _compute_elements(self, part):
+        subset = isinstance(self._it_space._iterset, base.Subset)
         # Just walk over the iteration set
         for e in range(part.offset, part.offset + part.size):
             args = []
@@ -166,20 +208,87 @@ class ParLoop(base.ParLoop):
                                             arg.map[1].values_with_halo[idx],
                                             tmp)
 
-        for arg in self.args:
-            if arg._is_dat and arg.data._is_allocated:
-                for d in arg.data:
-                    d._data.setflags(write=False)
-            if arg._is_mat and arg.access is not base.READ:
-                # Queue up assembly of matrix
-                arg.data.assemble()
-                # Now force the evaluation of everything.  Python
-                # parloops are not performance critical, so this is
-                # fine.
-                # We need to do this because the
-                # set_values/addto_values calls are lazily evaluated,
-                # and the parloop is already lazily evaluated so this
-                # lazily spawns lazy computation and getting
-                # everything to execute in the right order is
-                # otherwise madness.
-                arg.data._force_evaluation(read=True, write=False)
+    def _compute_batched(self, part):
+        """Execute the kernel on chunks of ``batch_size`` elements.
+
+        Each argument is passed with a leading axis over the elements
+        of the chunk, followed by the shape it has for a single
+        element.  Direct :class:`~.Dat`\s on non-subset iteration sets
+        are passed as views, indirect ones are gathered and written
+        back, INC arguments are zeroed on entry and accumulated with
+        :func:`numpy.add.at`, such that repeated map entries sum.
+        :class:`~.Global`\s are passed as is."""
+        if isinstance(self._it_space._iterset, base.Subset):
+            indices = self._it_space._iterset._indices
+        else:
+            indices = None
+        stop = part.offset + part.size
+        for start in range(part.offset, stop, self._batch_size):
+            end = min(start + self._batch_size, stop)
+            if indices is None:
+                idx = slice(start, end)
+            else:
+                idx = indices[start:end]
+            args = [self._gather(arg, idx, end - start) for arg in self.args]
+            self._kernel(*args)
+            for arg, tmp in zip(self.args, args):
+                if arg.access is not base.READ:
+                    self._scatter(arg, idx, tmp)
+
+    def _gather(self, arg, idx, n):
+        if arg._is_global:
+            tmp = arg.data._data
+            if tmp.shape == ():
+                tmp = tmp.reshape(1)
+        elif arg._is_direct:
+            data = arg.data._data
+            tmp = data[idx, ...].reshape((n, ) + (data.shape[1:] or (1, )))
+        elif arg._is_indirect:
+            if isinstance(arg.idx, base.IterationIndex):
+                raise NotImplementedError
+            data = arg.data._data
+            values = self._map_values(arg, idx)
+            if arg.access is base.INC:
+                tmp = np.zeros(values.shape + data.shape[1:], dtype=data.dtype)
+            else:
+                tmp = data[values, ...]
+        elif arg._is_mat:
+            if arg.access not in [base.INC, base.WRITE]:
+                raise NotImplementedError
+            if arg._is_mixed_mat:
+                raise ValueError("Mixed Mats must be split before assembly")
+            tmp = np.zeros((n, ) + arg._block_shape[0][0], dtype=arg.data.dtype)
+        if arg.access is base.READ:
+            tmp = tmp.view()
+            tmp.setflags(write=False)
+        return tmp
+
+    def _scatter(self, arg, idx, tmp):
+        if arg._is_global:
+            return
+        elif arg._is_direct:
+            data = arg.data._data
+            if isinstance(idx, slice):
+                # Written in place
+                return
+            data[idx, ...] = tmp.reshape((len(idx), ) + data.shape[1:])
+        elif arg._is_indirect:
+            data = arg.data._data
+            values = self._map_values(arg, idx)
+            if arg.access is base.INC:
+                np.add.at(data, values, tmp)
+            else:
+                data[values, ...] = tmp
+        elif arg._is_mat:
+            rows = arg.map[0].values_with_halo[idx]
+            cols = arg.map[1].values_with_halo[idx]
+            insert = {base.INC: arg.data.addto_values_batched,
+                      base.WRITE: arg.data.set_values_batched}[arg.access]
+            insert(rows, cols, tmp)
+
+    @staticmethod
+    def _map_values(arg, idx):
+        values = arg.map.values_with_halo[idx]
+        if arg._is_vec_map:
+            return values
+        return values[:, arg.idx:arg.idx+1]
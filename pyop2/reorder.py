@@ -0,0 +1,331 @@
+# This file is part of PyOP2
+#
+# PyOP2 is Copyright (c) 2012-2014, Imperial College London and
+# others. Please see the AUTHORS file in the main source directory for
+# a full list of copyright holders.  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * The name of Imperial College London or that of other
+#       contributors may not be used to endorse or promote products
+#       derived from this software without specific prior written
+#       permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTERS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Locality improving renumbering of :class:`~.Set`\s.
+
+PyOP2 iterates over the elements of a :class:`~.Set` in the order in
+which they are numbered, and gathers indirectly through
+:class:`~.Map`\s in whatever order their values reach.  On an
+unstructured mesh numbered arbitrarily, consecutive elements touch data
+far apart in memory.  This module computes permutations that number
+close entities close together and applies them to the objects built on
+a set.  For example, to renumber the vertices of a mesh with reverse
+Cuthill-McKee and the cells to follow them::
+
+    from pyop2 import reorder
+    vperm = reorder.permutation(vertices, cell_vertex)
+    cperm = reorder.follow(cells, cell_vertex, vperm)
+    reorder.renumber({vertices: vperm, cells: cperm},
+                     maps=[cell_vertex], dats=[coords, u],
+                     subsets=[boundary])
+
+A permutation gives, for each new number, the old number of an
+entity.  Entities are only permuted within the core and within the
+remaining owned part of a set, such that the partition of the set into
+core, owned and halo entities is preserved.  Halo entities keep their
+numbers, so renumbering needs no communication: only the
+:class:`~.Halo` sends, which name owned entities, are renumbered.
+
+Renumbering is meant to be applied once, when setting up a problem.
+It modifies the objects passed in place, all the :class:`~.Map`\s,
+:class:`~.Dat`\s and :class:`~.Subset`\s built on a renumbered set
+must be passed together.  Solver objects (PETSc Vecs and Mats) built
+on a set before it is renumbered keep the old numbering.
+"""
+
+from __future__ import absolute_import, print_function, division
+
+import numpy as np
+import six
+from petsc4py import PETSc
+
+from pyop2 import base
+from pyop2.caching import _evictable
+from pyop2.datatypes import IntType
+from pyop2.utils import maybe_setflags
+
+__all__ = ['permutation', 'follow', 'renumber']
+
+
+def _check_set(s):
+    if s._extruded:
+        raise NotImplementedError("Renumbering extruded sets is not supported")
+    if isinstance(s, base.Subset):
+        raise TypeError("Renumber the superset of a Subset, not the Subset")
+
+
+def _split(maps):
+    """The underlying :class:`~.Map`\s of ``maps``, each once."""
+    seen = set()
+    result = []
+    for m in maps:
+        for s in m.split:
+            if id(s._values) not in seen:
+                seen.add(id(s._values))
+                result.append(s)
+    return result
+
+
+def _keep_partition(s, order):
+    """Turn an ordering ``order`` of the owned entities of ``s`` into a
+    permutation of all of them that keeps core entities first, in the
+    relative order given, and leaves halo entities where they are."""
+    order = np.asarray(order)
+    core = order[order < s.core_size]
+    owned = order[order >= s.core_size]
+    halo = np.arange(s.size, s.total_size)
+    return np.concatenate((core, owned, halo)).astype(IntType)
+
+
+def _adjacency(s, maps):
+    """The graph of the owned entities of ``s``, two entities being
+    adjacent when an element of the iteration set of one of ``maps``
+    reaches both, in compressed sparse row format."""
+    n = s.size
+    rows = [np.arange(n, dtype=IntType)]
+    cols = [np.arange(n, dtype=IntType)]
+    for m in maps:
+        if m.toset is not s:
+            raise ValueError("Map %s does not map to %s" % (m.name, s.name))
+        values = m.values_with_halo
+        for i in range(m.arity):
+            for j in range(m.arity):
+                rows.append(values[:, i])
+                cols.append(values[:, j])
+    rows = np.concatenate(rows).astype(np.int64)
+    cols = np.concatenate(cols).astype(np.int64)
+    # Negative values (boundary conditions) and halo entities do not
+    # take part in the ordering.
+    keep = (rows >= 0) & (rows < n) & (cols >= 0) & (cols < n)
+    edges = np.unique(rows[keep] * n + cols[keep])
+    rows, cols = edges // n, edges % n
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=n))))
+    return indptr.astype(PETSc.IntType), cols.astype(PETSc.IntType)
+
+
+def _morton(coordinates):
+    """An ordering of points along a Z-order (Morton) space filling
+    curve.
+
+    :arg coordinates: an array of shape ``(npoints, dim)``."""
+    x = np.asarray(coordinates, dtype=np.float64)
+    x = x.reshape(len(x), -1)
+    if len(x) == 0:
+        return np.arange(0, dtype=IntType)
+    dim = x.shape[1]
+    bits = min(21, 63 // dim)
+    lo = x.min(axis=0)
+    extent = x.max(axis=0) - lo
+    extent[extent == 0] = 1
+    q = ((x - lo) / extent * ((1 << bits) - 1)).astype(np.uint64)
+    keys = np.zeros(len(x), dtype=np.uint64)
+    for b in range(bits):
+        for d in range(dim):
+            bit = (q[:, d] >> np.uint64(b)) & np.uint64(1)
+            keys |= bit << np.uint64(b * dim + d)
+    return np.argsort(keys, kind='mergesort')
+
+
+def permutation(s, maps=(), method="rcm", coordinates=None):
+    """Compute a locality improving permutation of a :class:`~.Set`.
+
+    :arg s: the :class:`~.Set` to renumber.
+    :arg maps: :class:`~.Map`\s into ``s`` defining which entities
+        are neighbours (required for ``"rcm"`` and ``"nd"``).
+    :arg method: the ordering to compute, one of
+
+        - ``"rcm"``: reverse Cuthill-McKee, which reduces the bandwidth
+          of the adjacency graph of the entities;
+        - ``"nd"``: nested dissection, which recursively partitions
+          the graph, such that parts fit in cache;
+        - ``"morton"``: a space filling curve through the entities,
+          which requires ``coordinates``.
+    :arg coordinates: the coordinates of the entities, a
+        :class:`~.Dat` on ``s`` or an array with one row per entity.
+    :returns: an array giving, for each new number, the old number of
+        an entity of ``s``."""
+    _check_set(s)
+    if method == "morton":
+        if coordinates is None:
+            raise ValueError("A Morton ordering requires coordinates")
+        if isinstance(coordinates, base.Dat):
+            coordinates = coordinates.data_ro
+        return _keep_partition(s, _morton(np.asarray(coordinates)[:s.size]))
+    orderings = {"rcm": PETSc.Mat.OrderingType.RCM,
+                 "nd": PETSc.Mat.OrderingType.ND}
+    if method not in orderings:
+        raise ValueError("Unknown ordering %r, must be one of rcm, nd, morton" % method)
+    maps = _split(maps)
+    if not maps:
+        raise ValueError("The %s ordering requires maps into %s" % (method, s.name))
+    indptr, indices = _adjacency(s, maps)
+    graph = PETSc.Mat().createAIJ((s.size, s.size),
+                                  csr=(indptr, indices, np.ones(len(indices), dtype=PETSc.ScalarType)),
+                                  comm=PETSc.COMM_SELF)
+    rperm, _ = graph.getOrdering(orderings[method])
+    order = rperm.getIndices()
+    graph.destroy()
+    return _keep_partition(s, order)
+
+
+def follow(s, m, perm):
+    """Compute a permutation of an iteration :class:`~.Set` that visits
+    its elements in the order of the entities they reach, once those
+    are renumbered.
+
+    :arg s: the iteration :class:`~.Set` to renumber.
+    :arg m: a :class:`~.Map` from ``s``.
+    :arg perm: the permutation of ``m.toset``, as returned by
+        :func:`permutation`.
+    :returns: an array giving, for each new number, the old number of
+        an element of ``s``."""
+    _check_set(s)
+    m, = _split([m])
+    if m.iterset is not s:
+        raise ValueError("Map %s is not from %s" % (m.name, s.name))
+    inverse = _inverse(perm)
+    values = m.values[:s.size]
+    key = np.where(values >= 0, inverse[np.maximum(values, 0)], len(perm)).min(axis=1)
+    return _keep_partition(s, np.argsort(key, kind='mergesort'))
+
+
+def _inverse(perm):
+    inverse = np.empty_like(perm)
+    inverse[perm] = np.arange(len(perm), dtype=perm.dtype)
+    return inverse
+
+
+_numbered = ("lgmap", "unblocked_lgmap", "layout_vec", "vecscatters", "dm")
+"""The cached properties of a :class:`~.DataSet` built from the
+numbering of its set."""
+
+
+def _forget(s, maps, subsets):
+    """Drop objects cached on ``s``, or its :class:`~.DataSet`\s, that
+    were built from ``maps`` or over ``subsets``, such as colourings
+    and sparsities, and the PETSc objects of the DataSets built from
+    the old numbering.
+
+    Subsets look up their cache on their superset, so ``s`` holds the
+    objects cached on ``subsets`` too."""
+    dsets = [d for d in list(s._cache.values()) if isinstance(d, base.DataSet)]
+    caches = [s._cache] + [d._cache for d in dsets]
+
+    values = set(id(m._values) for m in maps)
+    subsets = set(id(x) for x in subsets)
+
+    def mentions(key):
+        if isinstance(key, (tuple, list)):
+            return any(mentions(k) for k in key)
+        if isinstance(key, base.MixedMap):
+            return mentions(key.split)
+        if isinstance(key, base.Subset):
+            return id(key) in subsets
+        # Decorated maps share the values of the map they decorate
+        return isinstance(key, base.Map) and id(key._values) in values
+    for cache in caches:
+        # DataSets on the subsets must stay the same objects
+        for key in [k for k, v in six.iteritems(cache) if mentions(k) and _evictable(v)]:
+            del cache[key]
+    # The DataSets are kept, such that s ** dim is unchanged
+    for d in dsets:
+        for name in _numbered:
+            d.__dict__.pop(name, None)
+
+
+def renumber(perms, maps=(), dats=(), subsets=()):
+    """Apply permutations of :class:`~.Set`\s, in place, to the objects
+    built on them.
+
+    :arg perms: a dict mapping each :class:`~.Set` to renumber to its
+        permutation, as returned by :func:`permutation` or
+        :func:`follow`.
+    :arg maps: the :class:`~.Map`\s from or to the renumbered sets.
+    :arg dats: the :class:`~.Dat`\s on the renumbered sets.
+    :arg subsets: the :class:`~.Subset`\s of the renumbered sets.
+
+    The :class:`~.Halo` of each renumbered set is updated as well."""
+    perms = dict((s, np.asarray(p, dtype=IntType)) for s, p in six.iteritems(perms))
+    inverses = {}
+    for s, p in six.iteritems(perms):
+        _check_set(s)
+        if len(p) != s.total_size or \
+           not (np.sort(p[:s.core_size]) == np.arange(s.core_size)).all() or \
+           not (np.sort(p[s.core_size:s.size]) == np.arange(s.core_size, s.size)).all() or \
+           not (p[s.size:] == np.arange(s.size, s.total_size)).all():
+            raise ValueError("Not a permutation of %s preserving its core, owned and halo parts"
+                             % s.name)
+        inverses[s] = _inverse(p)
+
+    maps = _split(maps)
+    dats = [d for dat in dats for d in dat.split]
+    # Outstanding computation must see the old numbering, including
+    # loops writing to objects not renumbered here
+    base._trace.evaluate_all()
+
+    for m in maps:
+        values = m._values
+        if m.toset in inverses:
+            inverse = inverses[m.toset]
+            values[...] = np.where(values >= 0, inverse[np.maximum(values, 0)], values)
+        if m.iterset in perms:
+            values[...] = values[perms[m.iterset]]
+        m._cache.clear()
+
+    for d in dats:
+        s = d.dataset.set
+        if s in perms and d._is_allocated:
+            # Par_loops leave the data of their arguments read-only
+            maybe_setflags(d._data, write=True)
+            d._data[...] = d._data[perms[s]]
+        if hasattr(d, '_halo_exchanges'):
+            for exchange in d._halo_exchanges.values():
+                exchange.free()
+            d._halo_exchanges.clear()
+
+    for subset in subsets:
+        s = subset.superset
+        if s in inverses:
+            subset._indices[...] = np.sort(inverses[s][subset._indices])
+
+    for s, inverse in six.iteritems(inverses):
+        halo = s.halo
+        if halo is not None:
+            for rank, sends in six.iteritems(halo._sends):
+                halo._sends[rank] = inverse[sends].astype(sends.dtype)
+            numbering = halo._global_to_petsc_numbering
+            if numbering is not None:
+                halo._global_to_petsc_numbering = np.asarray(numbering)[perms[s]]
+            halo._patterns.clear()
+        _forget(s, maps, subsets)
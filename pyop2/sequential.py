@@ -40,6 +40,8 @@ from textwrap import dedent
 from copy import deepcopy as dcopy
 from collections import OrderedDict
 
+import numpy as np
+
 from pyop2.datatypes import IntType, as_cstr, as_ctypes
 from pyop2 import base
 from pyop2 import compilation
@@ -52,7 +54,7 @@ from pyop2.base import Set, ExtrudedSet, MixedSet, Subset, LocalSet  # noqa: F40
 from pyop2.base import DatView                           # noqa: F401
 from pyop2.petsc_base import DataSet, MixedDataSet       # noqa: F401
 from pyop2.petsc_base import Global, GlobalDataSet       # noqa: F401
-from pyop2.petsc_base import Dat, MixedDat, Mat          # noqa: F401
+from pyop2.petsc_base import Dat, MixedDat, Mat, MatrixFree  # noqa: F401
 from pyop2.configuration import configuration
 from pyop2.exceptions import *  # noqa: F401
 from pyop2.mpi import collective
@@ -365,6 +367,37 @@ class Arg(base.Arg):
                     vec_idx += 1
         return '\n'.join(val)+'\n'
 
+    def c_column_name(self):
+        return self.c_arg_name() + "_col"
+
+    def c_column_init(self, is_facet=False):
+        """Declare pointers to the data at the bottom of the column,
+        one per entry of the map."""
+        val = []
+        for i, m in enumerate(self.map):
+            val += [self.c_ind_data(idx, i) for idx in range(m.arity)]
+            if is_facet:
+                val += [self.c_ind_data(idx, i, offset=m.offset[idx])
+                        for idx in range(m.arity)]
+        return "%(type)s *const %(name)s[%(n)d] = { %(val)s }" % \
+            {'type': self.ctype,
+             'name': self.c_column_name(),
+             'n': len(val),
+             'val': ', '.join(val)}
+
+    def c_column_vec(self, is_facet=False):
+        """Declare the pointers passed to the kernel for layer ``j_0``,
+        an affine function of the layer rather than a running sum."""
+        offsets = []
+        for m, d in zip(self.map, self.data):
+            offsets += [o * d.cdim for o in m.offset] * (2 if is_facet else 1)
+        return "%(type)s *%(vec_name)s[%(n)d] = { %(val)s }" % \
+            {'type': self.ctype,
+             'vec_name': self.c_vec_name(),
+             'n': len(offsets),
+             'val': ', '.join("%s[%d] + j_0 * %d" % (self.c_column_name(), k, o)
+                              for k, o in enumerate(offsets))}
+
     # New globals generation which avoids false sharing.
     def c_intermediate_globals_decl(self, count):
         return "%(type)s %(name)s_l%(count)s[1][%(dim)s]" % \
@@ -563,6 +596,57 @@ for ( int i = 0; i < %(dim)s; i++ ) %(combine)s;
                             "mxofs": " + %d" % (mxofs[0] * dim) if mxofs else ""}
                            for o in range(dim)])
 
+    def c_batch_name(self):
+        return "batch_%s" % self.c_arg_name()
+
+    def c_batch_extent(self):
+        """The number of entries of this argument per element."""
+        arity = self.map.arity if self._is_vec_map else 1
+        return arity * self.data.cdim
+
+    def c_batch_decl(self, batch):
+        compiler = coffee.system.compiler
+        isa = coffee.system.isa
+        align = compiler['align'](isa["alignment"]) if compiler and batch % isa["dp_reg"] == 0 else ""
+        return "%(typ)s %(name)s[%(extent)d][%(batch)d] %(align)s" % \
+            {"typ": self.data.ctype,
+             "name": self.c_batch_name(),
+             "extent": self.c_batch_extent(),
+             "batch": batch,
+             "align": align}
+
+    def c_batch_loop(self, stmt):
+        """Wrap ``stmt``, which moves entry ``k * dim + c`` of element
+        ``b`` of the batch, in loops over the entries of this argument."""
+        dim = self.data.cdim
+        arity = self.map.arity if self._is_vec_map else 1
+        if self._is_direct:
+            data = "%s[i * %d + c]" % (self.c_arg_name(0), dim)
+        else:
+            data = "%(name)s[%(map)s[i * %(arity)d + %(k)s] * %(dim)d + c]" % \
+                {"name": self.c_arg_name(0),
+                 "map": self.c_map_name(0, 0),
+                 "arity": self.map.arity,
+                 "k": "k" if self._is_vec_map else self.idx,
+                 "dim": dim}
+        buf = "%s[k * %d + c][b]" % (self.c_batch_name(), dim)
+        return """for ( int k = 0; k < %(arity)d; k++ )
+  for ( int c = 0; c < %(dim)d; c++ )
+    %(stmt)s;""" % {"arity": arity,
+                    "dim": dim,
+                    "stmt": stmt % {"buf": buf, "data": data}}
+
+    def c_batch_gather(self):
+        if self.access in [WRITE, INC]:
+            return self.c_batch_loop("%(buf)s = 0")
+        return self.c_batch_loop("%(buf)s = %(data)s")
+
+    def c_batch_scatter(self):
+        if self.access is READ:
+            return ""
+        op = "+=" if self.access is INC else "="
+        return self.c_batch_loop("%%(data)s %s %%(buf)s" % op)
+
 
 class JITModule(base.JITModule):
 
@@ -591,12 +675,35 @@ void %(wrapper_name)s(int start,
     %(extr_loop_close)s
   }
 }
+"""
+
+    _batched_wrapper = """
+void %(wrapper_name)s(int start,
+                      int end,
+                      %(ssinds_arg)s
+                      %(wrapper_args)s) {
+  %(user_code)s
+  %(batch_decs)s;
+  for ( int n = start; n < end; n += %(batch)d ) {
+    int nb = end - n < %(batch)d ? end - n : %(batch)d;
+    for ( int b = 0; b < nb; b++ ) {
+      %(IntType)s i = %(index_expr)s;
+      %(batch_gather)s
+    }
+    %(kernel_name)s(nb, %(kernel_args)s);
+    for ( int b = 0; b < nb; b++ ) {
+      %(IntType)s i = %(index_expr)s;
+      %(batch_scatter)s
+    }
+  }
+}
 """
 
     _cppargs = []
     _libraries = []
     _system_headers = []
     _extension = 'c'
+    _background = True
 
     def __init__(self, kernel, itspace, *args, **kwargs):
         """
@@ -626,10 +733,14 @@ void %(wrapper_name)s(int start,
         self._direct = kwargs.get('direct', False)
         self._iteration_region = kwargs.get('iterate', ALL)
         self._pass_layer_arg = kwargs.get('pass_layer_arg', False)
+        self._columns = kwargs.get('columns', None)
         # Copy the class variables, so we don't overwrite them
         self._cppargs = dcopy(type(self)._cppargs)
+        if self._columns == "simd":
+            self._cppargs.append(_omp_simd_flag())
         self._libraries = dcopy(type(self)._libraries)
         self._system_headers = dcopy(type(self)._system_headers)
+        self._background = type(self)._background and configuration['compile_workers'] > 0
         self.set_argtypes(itspace.iterset, *args)
         if not kwargs.get('delay', False):
             self.compile()
@@ -639,6 +750,12 @@ void %(wrapper_name)s(int start,
     def __call__(self, *args):
         return self._fun(*args)
 
+    @collective
+    def wait(self):
+        """Wait for a compilation started in the background to finish."""
+        if isinstance(self._fun, compilation.PendingFunction):
+            self._fun = self._fun.wait()
+
     @property
     def _wrapper_name(self):
         return 'wrap_%s' % self._kernel.name
@@ -650,6 +767,24 @@ void %(wrapper_name)s(int start,
             raise RuntimeError("JITModule has no args associated with it, should never happen")
 
         compiler = coffee.system.compiler
+        index_key = self._persistent_key(self._pass_layer_arg,
+                                         compiler and compiler.get('name'),
+                                         coffee.system.isa.get('inst_set'),
+                                         configuration['compiler'],
+                                         configuration['cflags'],
+                                         configuration['ldflags'],
+                                         self._cppargs, self._libraries,
+                                         self._system_headers,
+                                         get_petsc_dir())
+        if index_key is not None:
+            self._fun = compilation.load_indexed(index_key,
+                                                 argtypes=self._argtypes,
+                                                 restype=None,
+                                                 comm=self.comm)
+            if self._fun is not None:
+                self._clear_args()
+                return self._fun
+
         externc_open = '' if not self._kernel._cpp else 'extern "C" {'
         externc_close = '' if not self._kernel._cpp else '}'
         headers = "\n".join([compiler.get('vect_header', "")])
@@ -661,13 +796,23 @@ void %(wrapper_name)s(int start,
             #undef OP2_STRIDE
             """ % {'code': self._kernel.code(),
                    'header': headers}
+        elif self._kernel._batch:
+            kernel_code = """
+            #define OP2_BATCH %(batch)d
+            %(header)s
+            %(code)s
+            #undef OP2_BATCH
+            """ % {'code': self._kernel.code(),
+                   'header': headers,
+                   'batch': self._kernel._batch}
         else:
             kernel_code = """
             %(header)s
             %(code)s
             """ % {'code': self._kernel.code(),
                    'header': headers}
-        code_to_compile = strip(dedent(self._wrapper) % self.generate_code())
+        wrapper = self._batched_wrapper if self._kernel._batch else self._wrapper
+        code_to_compile = strip(dedent(wrapper) % self.generate_code())
 
         code_to_compile = """
         #include <petsc.h>
@@ -713,22 +858,34 @@ void %(wrapper_name)s(int start,
                                      argtypes=self._argtypes,
                                      restype=None,
                                      compiler=compiler.get('name'),
-                                     comm=self.comm)
+                                     comm=self.comm,
+                                     index_key=index_key,
+                                     background=self._background)
+        self._clear_args()
+        return self._fun
+
+    def _clear_args(self):
         # Blow away everything we don't need any more
         del self._args
         del self._kernel
         del self._itspace
         del self._direct
-        return self._fun
 
     def generate_code(self):
+        if not self._code_dict and self._kernel._batch:
+            self._code_dict = batched_wrapper_snippets(self._itspace, self._args,
+                                                       self._kernel._batch,
+                                                       kernel_name=self._kernel._name,
+                                                       user_code=self._kernel._user_code,
+                                                       wrapper_name=self._wrapper_name)
         if not self._code_dict:
             self._code_dict = wrapper_snippets(self._itspace, self._args,
                                                kernel_name=self._kernel._name,
                                                user_code=self._kernel._user_code,
                                                wrapper_name=self._wrapper_name,
                                                iteration_region=self._iteration_region,
-                                               pass_layer_arg=self._pass_layer_arg)
+                                               pass_layer_arg=self._pass_layer_arg,
+                                               columns=self._columns)
         return self._code_dict
 
     def set_argtypes(self, iterset, *args):
@@ -798,11 +955,26 @@ class ParLoop(petsc_base.ParLoop):
                 arglist.append(iterset.layers - 1)
         return arglist
 
+    @cached_property
+    def _columns(self):
+        return column_mode(self.iterset, self.args, self.iteration_region)
+
     @cached_property
     def _jitmodule(self):
         return JITModule(self.kernel, self.it_space, *self.args,
                          direct=self.is_direct, iterate=self.iteration_region,
-                         pass_layer_arg=self._pass_layer_arg)
+                         pass_layer_arg=self._pass_layer_arg,
+                         columns=self._columns)
+
+    def _prefetch(self):
+        # Building the JITModule starts its compilation
+        self._jitmodule
+
+    @collective
+    def compute(self):
+        # The code may still be compiling in the background
+        self._jitmodule.wait()
+        super(ParLoop, self).compute()
 
     @collective
     def _compute(self, part, fun, *arglist):
@@ -811,9 +983,82 @@ class ParLoop(petsc_base.ParLoop):
             self.log_flops()
 
 
+def _column_dofs_distinct(m, is_facet=False):
+    """Do different layers of each column of the extruded
+    :class:`Map` ``m`` reach distinct values?
+
+    Values are those of the bottom layer plus the layer times the
+    offset.  Entries with different offsets are conservatively assumed
+    to collide.  The result is cached on the map."""
+    key = ("column_dofs_distinct", is_facet)
+    try:
+        return m._cache[key]
+    except KeyError:
+        pass
+    values = m.values_with_halo
+    offset = m.offset
+    if is_facet:
+        values = np.hstack((values, values + offset))
+        offset = np.concatenate((offset, offset))
+    distinct = bool((offset > 0).all())
+    for k in range(len(offset) if distinct else 0):
+        for j in range(k + 1, len(offset)):
+            if offset[k] != offset[j]:
+                distinct = False
+                break
+            d = values[:, k].astype(np.int64) - values[:, j]
+            if ((d != 0) & (d % offset[k] == 0) &
+                    (abs(d) // offset[k] < m.iterset.layers)).any():
+                distinct = False
+                break
+        if not distinct:
+            break
+    m._cache[key] = distinct
+    return distinct
+
+
+def column_mode(iterset, args, iteration_region=ALL):
+    """How the wrapper should iterate over the layers of each column
+    of an extruded iteration set, see :func:`wrapper_snippets`.
+
+    :returns: ``None`` if column code generation is disabled or not
+        supported for the arguments (:class:`Mat`\s, iteration space
+        arguments and maps without offsets are not), ``"simd"`` if
+        different layers write to different data, such that the
+        layers may be executed concurrently, ``"serial"`` otherwise.
+    """
+    if not configuration["column_codegen"] or not iterset._extruded:
+        return None
+    if all(a.map is None for a in args):
+        return None
+    for arg in args:
+        if arg._is_mat or arg._uses_itspace or arg._is_dat_view:
+            return None
+        if arg._is_vec_map and any(m.offset is None for m in arg.map):
+            return None
+    is_facet = iteration_region == ON_INTERIOR_FACETS
+    for arg in args:
+        if arg.access is READ:
+            continue
+        # Globals and column data are shared by all layers
+        if not arg._is_vec_map:
+            return "serial"
+        if not all(_column_dofs_distinct(m, is_facet) for m in arg.map):
+            return "serial"
+    return "simd"
+
+
+def _omp_simd_flag():
+    """The compiler flag enabling OpenMP SIMD pragmas."""
+    compiler = coffee.system.compiler
+    if compiler and compiler.get('name') == 'intel':
+        return "-qopenmp-simd"
+    return "-fopenmp-simd"
+
+
 def wrapper_snippets(itspace, args,
                      kernel_name=None, wrapper_name=None, user_code=None,
-                     iteration_region=ALL, pass_layer_arg=False):
+                     iteration_region=ALL, pass_layer_arg=False, columns=None):
     """Generates code snippets for the wrapper,
     ready to be into a template.
 
@@ -825,6 +1070,12 @@ def wrapper_snippets(itspace, args,
     :param wrapper_name: Wrapper function name (forwarded)
     :param iteration_region: Iteration region, this is specified when
                              creating a :class:`ParLoop`.
+    :param columns: For extruded sets, the result of :func:`column_mode`.
+        If set, pointers to the bottom of the column are computed once
+        per column and the data of each layer are addressed relative to
+        them, rather than by incrementing the pointers layer by layer.
+        The layers are then independent iterations, for ``"simd"``
+        they are marked for vectorisation.
 
     :return: dict containing the code snippets
     """
@@ -902,6 +1153,14 @@ def wrapper_snippets(itspace, args,
                                      for arg in args if arg._is_vec_map])
         _extr_loop = '\n' + extrusion_loop()
         _extr_loop_close = '}\n'
+        if columns:
+            vec_args = [arg for arg in args if arg._is_vec_map]
+            _vec_decs = ""
+            _vec_inits = ';\n'.join([arg.c_column_init(is_facet=is_facet) for arg in vec_args])
+            _apply_offset = ""
+            _extr_loop = '\n'.join(['', '#pragma omp simd' if columns == "simd" else '',
+                                    extrusion_loop()] +
+                                   [arg.c_column_vec(is_facet=is_facet) + ';' for arg in vec_args])
 
     # Build kernel invocation. Let X be a parameter of the kernel representing a
     # tensor accessed in an iteration space. Let BUFFER be an array of the same
@@ -1039,6 +1298,66 @@ def wrapper_snippets(itspace, args,
                                           for i, j, shape, offsets in itspace])}
 
 
+def batched_wrapper_snippets(itspace, args, batch,
+                             kernel_name=None, wrapper_name=None, user_code=None):
+    """Generates code snippets for a wrapper calling a batched kernel,
+    ready to be inserted into a template.
+
+    The wrapper gathers the data of up to ``batch`` consecutive
+    elements into scratch arrays laid out structure of arrays, such
+    that entry ``k`` of element ``b`` of the batch is ``x[k][b]``, and
+    calls the kernel once per batch as ``kernel(nb, x, y, ...)``,
+    ``nb`` being the number of elements in the batch.  Global
+    arguments are passed unchanged.  Dat arguments that are written
+    or incremented start zeroed and are scattered back after the call.
+
+    :param itspace: :class:`IterationSpace` object of the :class:`ParLoop`.
+    :param args: :class:`Arg`s of the :class:`ParLoop`
+    :param batch: The maximum number of elements per batch.
+    :param kernel_name: Kernel function name (forwarded)
+    :param user_code: Code to insert into the wrapper (forwarded)
+    :param wrapper_name: Wrapper function name (forwarded)
+
+    :return: dict containing the code snippets
+    """
+    assert kernel_name is not None
+    if wrapper_name is None:
+        wrapper_name = "wrap_" + kernel_name
+    if user_code is None:
+        user_code = ""
+    if itspace._extruded:
+        raise NotImplementedError("Batched kernels over extruded sets are not supported")
+    for arg in args:
+        if arg._is_mat or arg._uses_itspace or arg._is_mixed or arg._is_dat_view:
+            raise NotImplementedError("Batched kernels only support (vector) map and direct "
+                                      "access to Dats and Globals, not %s" % arg)
+
+    _ssinds_arg = ""
+    _index_expr = "(%s)(n + b)" % as_cstr(IntType)
+    if isinstance(itspace._iterset, Subset):
+        _ssinds_arg = "%s* ssinds," % as_cstr(IntType)
+        _index_expr = "ssinds[n + b]"
+
+    indent = lambda t, i: ('\n' + '  ' * i).join(t.split('\n'))
+
+    dat_args = [arg for arg in args if arg._is_dat]
+    _kernel_args = ', '.join([arg.c_batch_name() if arg._is_dat else arg.c_kernel_arg(count)
+                              for count, arg in enumerate(args)])
+    _batch_scatter = [arg.c_batch_scatter() for arg in dat_args]
+    return {'kernel_name': kernel_name,
+            'wrapper_name': wrapper_name,
+            'ssinds_arg': _ssinds_arg,
+            'index_expr': _index_expr,
+            'wrapper_args': ', '.join([arg.c_wrapper_arg() for arg in args]),
+            'user_code': user_code,
+            'batch': batch,
+            'batch_decs': indent(';\n'.join([arg.c_batch_decl(batch) for arg in dat_args]), 1),
+            'batch_gather': indent('\n'.join([arg.c_batch_gather() for arg in dat_args]), 3),
+            'batch_scatter': indent('\n'.join(s for s in _batch_scatter if s), 3),
+            'kernel_args': _kernel_args,
+            'IntType': as_cstr(IntType)}
+
+
 def generate_cell_wrapper(itspace, args, forward_args=(), kernel_name=None, wrapper_name=None):
     """Generates wrapper for a single cell. No iteration loop, but cellwise data is extracted.
     Cell is expected as an argument to the wrapper. For extruded, the numbering of the cells
@@ -34,6 +34,8 @@
 from libcpp.vector cimport vector
 from vecset cimport vecset
 from cython.operator cimport dereference as deref, preincrement as inc
+from cython.parallel cimport prange, parallel
+from libc.stdlib cimport malloc, free
 from cpython cimport bool
 import numpy as np
 cimport numpy as np
@@ -44,11 +46,15 @@ from pyop2.datatypes import IntType
 
 np.import_array()
 
+cdef extern from "<algorithm>" namespace "std" nogil:
+    void sort[Iter](Iter first, Iter last)
+
 cdef extern from "petsc.h":
     ctypedef long PetscInt
     ctypedef double PetscScalar
     ctypedef enum PetscInsertMode "InsertMode":
         PETSC_INSERT_VALUES "INSERT_VALUES"
+        PETSC_ADD_VALUES "ADD_VALUES"
     int PetscCalloc1(size_t, void*)
     int PetscMalloc1(size_t, void*)
     int PetscFree(void*)
@@ -66,52 +72,6 @@ cdef object set_writeable(map):
 cdef void restore_writeable(map, flag):
      map.values_with_halo.setflags(write=flag)
 
-@cython.boundscheck(False)
-@cython.wraparound(False)
-cdef inline void add_entries(rset, rmap, cset, cmap,
-                             PetscInt row_offset,
-                             vector[vecset[PetscInt]]& diag,
-                             vector[vecset[PetscInt]]& odiag,
-                             bint should_block):
-    cdef:
-        PetscInt nrows, ncols, i, j, k, l, nent, e
-        PetscInt rarity, carity, row, col, rdim, cdim
-        PetscInt[:, ::1] rmap_vals, cmap_vals
-
-    nent = rmap.iterset.exec_size
-
-    if should_block:
-        rdim = cdim = 1
-    else:
-        rdim = rset.cdim
-        cdim = cset.cdim
-
-    rmap_vals = rmap.values_with_halo
-    cmap_vals = cmap.values_with_halo
-
-    nrows = rset.size * rdim
-    ncols = cset.size * cdim
-
-    rarity = rmap.arity
-    carity = cmap.arity
-
-    for e in range(nent):
-        for i in range(rarity):
-            row = rdim * rmap_vals[e, i]
-            if row >= nrows:
-                # Not a process local row
-                continue
-            row += row_offset
-            for j in range(rdim):
-                for k in range(carity):
-                    for l in range(cdim):
-                        col = cdim * cmap_vals[e, k] + l
-                        if col < ncols:
-                            diag[row + j].insert(col)
-                        else:
-                            odiag[row + j].insert(col)
-
-
 @cython.boundscheck(False)
 @cython.wraparound(False)
 cdef inline void add_entries_extruded(rset, rmap, cset, cmap,
@@ -190,54 +150,240 @@ cdef inline void add_entries_extruded(rset, rmap, cset, cmap,
                             row += rdim * roffset[i]
 
 
+cdef struct column_block:
+    # Values, arity and dimension of a column map
+    PetscInt *values
+    PetscInt arity
+    PetscInt dim
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef object invert_map(map, PetscInt nnodes):
+    """Return the elements adjacent to each of the first ``nnodes``
+    nodes of a map, as a tuple ``(ptr, elements)`` in CSR format: the
+    elements of node ``n`` are ``elements[ptr[n]:ptr[n+1]]``.  Built
+    with a counting sort, in time linear in the size of the map."""
+    cdef:
+        PetscInt[:, ::1] values = map.values_with_halo
+        PetscInt nent = map.iterset.exec_size
+        PetscInt arity = map.arity
+        PetscInt e, i, v
+        PetscInt[::1] ptr, pos, elements
+
+    ptr_ = np.zeros(nnodes + 1, dtype=IntType)
+    ptr = ptr_
+    with nogil:
+        for e in range(nent):
+            for i in range(arity):
+                v = values[e, i]
+                if v >= 0 and v < nnodes:
+                    ptr[v + 1] += 1
+    np.cumsum(ptr_, out=ptr_)
+    elements_ = np.empty(ptr_[nnodes], dtype=IntType)
+    elements = elements_
+    pos_ = ptr_[:-1].copy()
+    pos = pos_
+    with nogil:
+        for e in range(nent):
+            for i in range(arity):
+                v = values[e, i]
+                if v >= 0 and v < nnodes:
+                    elements[pos[v]] = e
+                    pos[v] += 1
+    return ptr_, elements_
+
+
 @cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline PetscInt node_columns(PetscInt n,
+                                  vector[PetscInt*]& ptrs,
+                                  vector[PetscInt*]& elements,
+                                  vector[column_block]& blocks,
+                                  vector[PetscInt]& offsets,
+                                  PetscInt *buf) nogil:
+    """Gather the columns adjacent to row node ``n`` into ``buf``,
+    sorted and without duplicates, returning their number.  Columns
+    of block ``c`` are numbered from ``offsets[c]``."""
+    cdef:
+        PetscInt p, a, e, c, k, l, i, m
+        PetscInt cnt = 0
+        PetscInt nblocks = offsets.size() - 1
+        column_block *blk
+
+    for p in range(<PetscInt>ptrs.size()):
+        for a in range(ptrs[p][n], ptrs[p][n + 1]):
+            e = elements[p][a]
+            for c in range(nblocks):
+                blk = &blocks[p * nblocks + c]
+                for k in range(blk.arity):
+                    for l in range(blk.dim):
+                        buf[cnt] = offsets[c] + blk.dim * blk.values[e * blk.arity + k] + l
+                        cnt += 1
+    if cnt == 0:
+        return 0
+    sort(buf, buf + cnt)
+    m = 1
+    for i in range(1, cnt):
+        if buf[i] != buf[m - 1]:
+            buf[m] = buf[i]
+            m += 1
+    return m
+
+
+cdef inline bint contains(PetscInt *buf, PetscInt n, PetscInt value) nogil:
+    """Binary search for ``value`` in the sorted ``buf`` of length ``n``."""
+    cdef PetscInt lo = 0, hi = n, mid
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if buf[mid] < value:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo < n and buf[lo] == value
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
 @cython.cdivision(True)
-def build_sparsity(object sparsity, bint parallel, bool block=True):
-    """Build a sparsity pattern defined by a list of pairs of maps
+cdef object build_csr(sparsity, rset, cset, maps, PetscInt nrows,
+                      bint parallel, bint should_block, bint make_rowptr):
+    """Build a sparsity pattern on non-extruded maps.
+
+    The elements adjacent to each row are found by inverting the row
+    maps.  A first pass counts the distinct diagonal and off-diagonal
+    columns of each row, a second pass (only for CSR patterns) fills
+    in the column indices.  Rows are processed independently, in
+    parallel with OpenMP, each thread only needing a buffer for the
+    columns of one row.  Memory is therefore that of the inverted
+    maps and the pattern itself."""
+    cdef:
+        vector[PetscInt*] ptrs, elements
+        vector[column_block] blocks
+        vector[PetscInt] offsets, owned
+        column_block blk
+        PetscInt r, c, n, j, i, m, q, R, row_offset, rdim, cdim, nnodes, maxcols
+        PetscInt d, o, extra
+        PetscInt *buf
+        PetscInt[::1] nnz_v, onnz_v, rowptr_v, colidx_v
+        bint alloc_diag
 
-    :arg sparsity: the Sparsity object to build a pattern for
-    :arg parallel: Are we running in parallel?
-    :arg block: Should we build a block sparsity
+    nnz = np.zeros(nrows, dtype=IntType)
+    onnz = np.zeros(nrows, dtype=IntType)
+    nnz_v = nnz
+    onnz_v = onnz
+    # Columns of all blocks, including halo columns, are numbered
+    # contiguously such that duplicates are found in one sort.
+    offsets.push_back(0)
+    for c in range(len(cset)):
+        cdim = 1 if should_block else cset[c].cdim
+        owned.push_back(cset[c].size * cdim)
+        offsets.push_back(offsets[c] + cset[c].total_size * cdim)
+    # Hold on to the arrays we keep pointers into
+    arrays = []
+    row_offset = 0
+    for r in range(len(rset)):
+        rdim = 1 if should_block else rset[r].cdim
+        nnodes = rset[r].size
+        ptrs.clear()
+        elements.clear()
+        blocks.clear()
+        ncandidates = np.zeros(nnodes, dtype=IntType)
+        for rmaps, cmaps in maps:
+            # Memoryviews require writeable buffers
+            rmap = tuple(rmaps)[r]
+            rflag = set_writeable(rmap)
+            ptr, els = invert_map(rmap, nnodes)
+            restore_writeable(rmap, rflag)
+            arrays.extend([ptr, els])
+            ptrs.push_back(<PetscInt*>np.PyArray_DATA(ptr))
+            elements.push_back(<PetscInt*>np.PyArray_DATA(els))
+            width = 0
+            for c, cmap in enumerate(cmaps):
+                values = np.ascontiguousarray(cmap.values_with_halo, dtype=IntType)
+                arrays.append(values)
+                blk.values = <PetscInt*>np.PyArray_DATA(values)
+                blk.arity = cmap.arity
+                blk.dim = 1 if should_block else cset[c].cdim
+                blocks.push_back(blk)
+                width += blk.arity * blk.dim
+            ncandidates += np.diff(ptr) * width
+        # Room for the diagonal
+        maxcols = (ncandidates.max() if nnodes else 0) + 1
+        # Always allocate space for the diagonal
+        alloc_diag = sparsity._has_diagonal and r < len(cset)
+
+        with nogil, parallel():
+            buf = <PetscInt*>malloc(maxcols * sizeof(PetscInt))
+            for n in prange(nnodes, schedule='guided'):
+                m = node_columns(n, ptrs, elements, blocks, offsets, buf)
+                d = 0
+                o = 0
+                c = 0
+                for q in range(m):
+                    while buf[q] >= offsets[c + 1]:
+                        c = c + 1
+                    if buf[q] - offsets[c] < owned[c]:
+                        d = d + 1
+                    else:
+                        o = o + 1
+                for j in range(rdim):
+                    i = rdim * n + j
+                    extra = 0
+                    if alloc_diag and i < owned[r] and not contains(buf, m, offsets[r] + i):
+                        extra = 1
+                    nnz_v[row_offset + i] = d + extra
+                    onnz_v[row_offset + i] = o
+            free(buf)
+        # Increment only by owned rows
+        row_offset += nnodes * rdim
+
+    if not parallel:
+        onnz[:] = 0
+    if not make_rowptr:
+        # Can't build these, so create dummy arrays
+        rowptr = np.empty(0, dtype=IntType).reshape(-1)
+        colidx = np.empty(0, dtype=IntType).reshape(-1)
+        return nnz, onnz, nnz.sum(), onnz.sum(), rowptr, colidx
+
+    # A single block, whose row and column numbers coincide, and
+    # without off-diagonal columns.  The inverted maps of the last
+    # (only) row block are still set up.
+    rowptr = np.zeros(nrows + 1, dtype=IntType)
+    np.cumsum(nnz, out=rowptr[1:])
+    colidx = np.empty(rowptr[nrows], dtype=IntType)
+    rowptr_v = rowptr
+    colidx_v = colidx
+    with nogil, parallel():
+        buf = <PetscInt*>malloc(maxcols * sizeof(PetscInt))
+        for n in prange(nnodes, schedule='guided'):
+            m = node_columns(n, ptrs, elements, blocks, offsets, buf)
+            for j in range(rdim):
+                R = rdim * n + j
+                i = rowptr_v[R]
+                for q in range(m):
+                    colidx_v[i + q] = buf[q]
+                if nnz_v[R] > m:
+                    colidx_v[i + m] = R
+                    sort(&colidx_v[i], &colidx_v[i] + m + 1)
+        free(buf)
+    return nnz, onnz, nnz.sum(), 0, rowptr, colidx
 
-    The sparsity pattern is built from the outer products of the pairs
-    of maps.  This code works for both the serial and (MPI-) parallel
-    case, as well as for MixedMaps"""
+
+@cython.boundscheck(False)
+@cython.cdivision(True)
+cdef object build_sets(sparsity, rset, cset, maps, PetscInt nrows,
+                       bint parallel, bint should_block, bint make_rowptr):
+    """Build a sparsity pattern on extruded maps, accumulating the
+    columns of each row in a set."""
     cdef:
         vector[vector[vecset[PetscInt]]] diag, odiag
         vecset[PetscInt].const_iterator it
-        PetscInt nrows, ncols, i, cur_nrows, rarity
+        PetscInt ncols, i, cur_nrows, rarity
         PetscInt row_offset, row, val
         int c
-        bint should_block = False
-        bint make_rowptr = False
         bint alloc_diag
 
-    rset, cset = sparsity.dsets
-
-    if block and len(rset) == 1 and len(cset) == 1 and rset.cdim == cset.cdim:
-        should_block = True
-
-    if not (parallel or len(rset) > 1 or len(cset) > 1):
-        make_rowptr = True
-
-    if should_block:
-        nrows = sum(s.size for s in rset)
-    else:
-        nrows = sum(s.cdim * s.size for s in rset)
-
-    maps = sparsity.maps
-    extruded = maps[0][0].iterset._extruded
-
-    if nrows == 0:
-        # We don't own any rows, return something appropriate.
-        dummy = np.empty(0, dtype=IntType).reshape(-1)
-        sparsity._d_nz = 0
-        sparsity._o_nz = 0
-        sparsity._d_nnz = dummy
-        sparsity._o_nnz = dummy
-        sparsity._rowptr = dummy
-        sparsity._colidx = dummy
-
     # Exposition:
     # When building a monolithic sparsity for a mixed space, we build
     # the contributions from each column set separately and then sum
@@ -283,18 +429,11 @@ def build_sparsity(object sparsity, bint parallel, bool block=True):
                             diag[c][row_offset + i].insert(i)
                         if parallel:
                             odiag[c][row_offset + i].reserve(6*rarity)
-                if extruded:
-                    add_entries_extruded(rset[r], rmap,
-                                         cset[c], cmap,
-                                         row_offset,
-                                         diag[c], odiag[c],
-                                         should_block)
-                else:
-                    add_entries(rset[r], rmap,
-                                cset[c], cmap,
-                                row_offset,
-                                diag[c], odiag[c],
-                                should_block)
+                add_entries_extruded(rset[r], rmap,
+                                     cset[c], cmap,
+                                     row_offset,
+                                     diag[c], odiag[c],
+                                     should_block)
                 restore_writeable(cmap, cflag)
             # Increment only by owned rows
             row_offset += rset[r].size * rdim
@@ -339,6 +478,56 @@ def build_sparsity(object sparsity, bint parallel, bool block=True):
                 colidx[i] = deref(it)
                 inc(it)
                 i += 1
+    return nnz, onnz, nz, onz, rowptr, colidx
+
+
+def build_sparsity(object sparsity, bint parallel, bool block=True):
+    """Build a sparsity pattern defined by a list of pairs of maps
+
+    :arg sparsity: the Sparsity object to build a pattern for
+    :arg parallel: Are we running in parallel?
+    :arg block: Should we build a block sparsity
+
+    The sparsity pattern is built from the outer products of the pairs
+    of maps.  This code works for both the serial and (MPI-) parallel
+    case, as well as for MixedMaps"""
+    cdef:
+        PetscInt nrows
+        bint should_block = False
+        bint make_rowptr = False
+
+    rset, cset = sparsity.dsets
+
+    if block and len(rset) == 1 and len(cset) == 1 and rset.cdim == cset.cdim:
+        should_block = True
+
+    if not (parallel or len(rset) > 1 or len(cset) > 1):
+        make_rowptr = True
+
+    if should_block:
+        nrows = sum(s.size for s in rset)
+    else:
+        nrows = sum(s.cdim * s.size for s in rset)
+
+    maps = sparsity.maps
+    extruded = maps[0][0].iterset._extruded
+
+    if nrows == 0:
+        # We don't own any rows, return something appropriate.
+        dummy = np.empty(0, dtype=IntType).reshape(-1)
+        sparsity._d_nz = 0
+        sparsity._o_nz = 0
+        sparsity._d_nnz = dummy
+        sparsity._o_nnz = dummy
+        sparsity._rowptr = dummy
+        sparsity._colidx = dummy
+
+    if extruded:
+        build = build_sets
+    else:
+        build = build_csr
+    nnz, onnz, nz, onz, rowptr, colidx = build(sparsity, rset, cset, maps, nrows,
+                                               parallel, should_block, make_rowptr)
 
     sparsity._d_nz = nz
     sparsity._o_nz = onz
@@ -348,6 +537,45 @@ def build_sparsity(object sparsity, bint parallel, bool block=True):
     sparsity._colidx = colidx
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def insert_blocks(PETSc.Mat mat not None, rows, cols, values, bint add):
+    """Insert element blocks of values into a PETSc matrix
+
+    :arg mat: the PETSc Mat
+    :arg rows: a ``(nelements, rarity)`` array of local block row indices
+    :arg cols: a ``(nelements, carity)`` array of local block column indices
+    :arg values: the values of each element block, with
+        ``nelements * rarity * rbs * carity * cbs`` entries
+    :arg add: add the values, rather than setting them?"""
+    cdef:
+        PetscInt[:, ::1] rvals = np.ascontiguousarray(rows, dtype=IntType).reshape(len(rows), -1)
+        PetscInt[:, ::1] cvals = np.ascontiguousarray(cols, dtype=IntType).reshape(len(cols), -1)
+        PetscScalar[:, ::1] vals
+        PetscInt e, nent, rarity, carity
+        PetscInsertMode mode = PETSC_ADD_VALUES if add else PETSC_INSERT_VALUES
+        int ierr = 0
+
+    nent = rvals.shape[0]
+    if cvals.shape[0] != nent:
+        raise ValueError("Need as many column as row blocks")
+    if nent == 0:
+        return
+    vals = np.ascontiguousarray(values, dtype=PETSc.ScalarType).reshape(nent, -1)
+    rarity = rvals.shape[1]
+    carity = cvals.shape[1]
+    rbs, cbs = mat.getBlockSizes()
+    if vals.shape[1] != rarity * rbs * carity * cbs:
+        raise ValueError("Expected %d values per element, not %d" %
+                         (rarity * rbs * carity * cbs, vals.shape[1]))
+    for e in range(nent):
+        ierr = MatSetValuesBlockedLocal(mat.mat, rarity, &rvals[e, 0],
+                                        carity, &cvals[e, 0],
+                                        &vals[e, 0], mode)
+        if ierr:
+            raise RuntimeError("MatSetValuesBlockedLocal failed with error %d" % ierr)
+
+
 def fill_with_zeros(PETSc.Mat mat not None, dims, maps, set_diag=True):
     """Fill a PETSc matrix with zeros in all slots we might end up inserting into
 
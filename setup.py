@@ -64,6 +64,13 @@ Set the environment variable PETSC_DIR to your local PETSc base
 directory or install PETSc from PyPI: pip install petsc""")
 
 
+# The sparsity builder is threaded with OpenMP, where the compiler
+# supports it.  Without it the loops simply run serially.
+if sys.platform == 'darwin':
+    openmp_flags = []
+else:
+    openmp_flags = ['-fopenmp']
+
 cmdclass = versioneer.get_cmdclass()
 _sdist = cmdclass['sdist']
 
@@ -159,7 +166,9 @@ setup(name='PyOP2',
       ext_modules=[Extension('pyop2.sparsity', sparsity_sources,
                              include_dirs=['pyop2'] + includes, language="c++",
                              libraries=["petsc"],
+                             extra_compile_args=openmp_flags,
                              extra_link_args=["-L%s/lib" % d for d in petsc_dirs] +
-                             ["-Wl,-rpath,%s/lib" % d for d in petsc_dirs]),
+                             ["-Wl,-rpath,%s/lib" % d for d in petsc_dirs] +
+                             openmp_flags),
                    Extension('pyop2.computeind', computeind_sources,
                              include_dirs=numpy_includes)])
@@ -0,0 +1,125 @@
+# This file is part of PyOP2
+#
+# PyOP2 is Copyright (c) 2012, Imperial College London and
+# others. Please see the AUTHORS file in the main source directory for
+# a full list of copyright holders.  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * The name of Imperial College London or that of other
+#       contributors may not be used to endorse or promote products
+#       derived from this software without specific prior written
+#       permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTERS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import absolute_import, print_function, division
+from six.moves import range
+
+import pytest
+import numpy as np
+import random
+
+from pyop2 import op2
+
+
+nelems = 4096
+
+
+@pytest.fixture(params=[(nelems, nelems, nelems, nelems),
+                        (0, nelems, nelems, nelems),
+                        (nelems // 2, nelems, nelems, nelems)])
+def iterset(request):
+    return op2.Set(request.param, "iterset")
+
+
+@pytest.fixture
+def indset():
+    return op2.Set(nelems, "indset")
+
+
+@pytest.fixture
+def x(indset):
+    return op2.Dat(indset, list(range(nelems)), np.uint32, "x")
+
+
+@pytest.fixture
+def mapd():
+    mapd = list(range(nelems))
+    random.shuffle(mapd, lambda: 0.02041724)
+    return mapd
+
+
+@pytest.fixture
+def iterset2indset(iterset, indset, mapd):
+    u_map = np.array(mapd, dtype=np.uint32)
+    return op2.Map(iterset, indset, 1, u_map, "iterset2indset")
+
+
+@pytest.fixture
+def iterset2indset2(iterset, indset, mapd):
+    u_map = np.array([mapd, mapd], dtype=np.uint32)
+    return op2.Map(iterset, indset, 2, u_map, "iterset2indset2")
+
+
+class TestBatchedKernels:
+
+    """
+    Kernels called once per batch of elements.
+    """
+
+    def test_indirect_rw(self, iterset, x, iterset2indset):
+        """A batch size not dividing the set size leaves a partial batch."""
+        kernel = op2.Kernel("""
+        void inc(int nb, unsigned int x[][OP2_BATCH]) {
+          for (int b = 0; b < nb; b++) x[0][b] += 1;
+        }""", "inc", batch=7)
+        op2.par_loop(kernel, iterset, x(op2.RW, iterset2indset[0]))
+        assert sum(x.data) == nelems * (nelems + 1) // 2
+
+    def test_vector_map_inc(self, iterset, indset, iterset2indset2):
+        """Entry k of a vector map argument is row k of its batch."""
+        y = op2.Dat(indset, np.zeros(nelems, dtype=np.uint32), np.uint32)
+        kernel = op2.Kernel("""
+        void inc(int nb, unsigned int y[][OP2_BATCH]) {
+          for (int b = 0; b < nb; b++) { y[0][b] += 1; y[1][b] += 2; }
+        }""", "inc", batch=8)
+        op2.par_loop(kernel, iterset, y(op2.INC, iterset2indset2))
+        assert (y.data == 3).all()
+
+    def test_direct_and_global(self, iterset, x, iterset2indset):
+        """Direct Dats are batched, Globals are passed as is."""
+        d = op2.Dat(iterset, np.zeros(nelems, dtype=np.uint32), np.uint32)
+        g = op2.Global(1, 2, np.uint32)
+        kernel = op2.Kernel("""
+        void scale(int nb, unsigned int d[][OP2_BATCH],
+                   unsigned int x[][OP2_BATCH], unsigned int *g) {
+          for (int b = 0; b < nb; b++) d[0][b] = (*g) * x[0][b];
+        }""", "scale", batch=16)
+        op2.par_loop(kernel, iterset, d(op2.WRITE), x(op2.READ, iterset2indset[0]),
+                     g(op2.READ))
+        expected = 2 * x.data_ro[iterset2indset.values[:, 0]]
+        assert (d.data_ro == expected).all()
+
+
+if __name__ == '__main__':
+    import os
+    pytest.main(os.path.abspath(__file__))
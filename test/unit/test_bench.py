@@ -0,0 +1,82 @@
+# This file is part of PyOP2
+#
+# PyOP2 is Copyright (c) 2012-2014, Imperial College London and
+# others. Please see the AUTHORS file in the main source directory for
+# a full list of copyright holders.  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * The name of Imperial College London or that of other
+#       contributors may not be used to endorse or promote products
+#       derived from this software without specific prior written
+#       permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTERS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Benchmark suite unit tests.
+"""
+
+from __future__ import absolute_import, print_function, division
+
+import json
+import pytest
+import numpy as np
+
+from pyop2 import bench
+from pyop2.datatypes import IntType
+
+
+class TestBench:
+
+    """
+    Benchmark suite tests
+    """
+
+    def test_run_all(self):
+        results = bench.run(size=4, repeat=1, layers=3)
+        assert list(results["results"]) == bench.benchmarks()
+        for r in results["results"].values():
+            assert r["elements"] > 0
+            assert r["time"] > 0
+            assert r["bytes"] > 0
+        assert json.loads(json.dumps(results))["size"] == 4
+
+    def test_elements(self):
+        results = bench.run(["direct", "extruded", "subset"], size=4, repeat=1, layers=3)["results"]
+        assert results["direct"]["elements"] == 25
+        assert results["extruded"]["elements"] == 16 * 2
+        assert results["subset"]["elements"] == 13
+
+    def test_subset_bytes(self):
+        results = bench.run(["subset"], size=4, repeat=1)["results"]
+        # Read and write of every touched double, and a read of each index
+        assert results["subset"]["bytes"] == 13 * (2 * 8 + np.dtype(IntType).itemsize)
+
+    def test_unknown(self):
+        with pytest.raises(ValueError):
+            bench.run(["nonexistent"], size=4, repeat=1)
+
+    def test_main(self, tmpdir):
+        output = str(tmpdir.join("bench.json"))
+        bench.main(["direct", "--size", "4", "--repeat", "1", "--output", output])
+        with open(output) as f:
+            assert list(json.load(f)["results"]) == ["direct"]
@@ -37,7 +37,9 @@ from six.moves import range
 import pytest
 import numpy
 import random
-from pyop2 import op2, base
+from pyop2 import op2, base, sequential, compilation, caching
+from pyop2.configuration import configuration
+from pyop2.exceptions import CompilationError
 
 from coffee.base import *
 
@@ -561,6 +563,77 @@ void kernel_swap(unsigned int* x[2])
         assert len(self.cache) == 2
 
 
+class TestJITIndex:
+
+    """
+    On-disk JITModule index tests.
+    """
+
+    cache = base.JITModule._cache
+
+    @pytest.fixture
+    def jit_index(cls, request, tmpdir):
+        old = dict((k, configuration[k]) for k in ['jit_index', 'cache_dir'])
+        configuration.unsafe_reconfigure(jit_index=True, cache_dir=str(tmpdir))
+        request.addfinalizer(lambda: configuration.unsafe_reconfigure(**old))
+
+    @pytest.fixture
+    def a(cls, diterset):
+        return op2.Dat(diterset, numpy.zeros(nelems), numpy.uint32, "a")
+
+    def test_index_written(self, jit_index, tmpdir, iterset, a):
+        self.cache.clear()
+        op2.par_loop(op2.Kernel("void k(unsigned int *x) { *x = 1; }", "k"),
+                     iterset, a(op2.WRITE))
+        base._trace.evaluate(set([a]), set())
+        assert len(tmpdir.join("index").listdir()) == 1
+
+    def test_index_skips_code_generation(self, jit_index, monkeypatch, iterset, a):
+        kernel = "void k(unsigned int *x) { *x = 2; }"
+        self.cache.clear()
+        op2.par_loop(op2.Kernel(kernel, "k"), iterset, a(op2.WRITE))
+        base._trace.evaluate(set([a]), set())
+
+        def fail(self):
+            raise AssertionError("Code generated despite index hit")
+        monkeypatch.setattr(sequential.JITModule, "generate_code", fail)
+        self.cache.clear()
+        a.data[:] = 0
+        op2.par_loop(op2.Kernel(kernel, "k"), iterset, a(op2.WRITE))
+        assert all(a.data == 2)
+
+
+class TestBackgroundCompilation:
+
+    """
+    Background compilation tests.
+    """
+
+    @pytest.fixture
+    def workers(cls, request, tmpdir):
+        old = dict((k, configuration[k]) for k in ['compile_workers', 'cache_dir'])
+        configuration.unsafe_reconfigure(compile_workers=2, cache_dir=str(tmpdir))
+        request.addfinalizer(lambda: configuration.unsafe_reconfigure(**old))
+
+    def test_background_compilation(self, skip_greedy, workers, iterset, diterset):
+        dats = [op2.Dat(diterset, numpy.zeros(nelems), numpy.uint32) for _ in range(3)]
+        loops = [op2.par_loop(op2.Kernel("void k%d(unsigned int *x) { *x = %d; }" % (i, i),
+                                         "k%d" % i),
+                              iterset, d(op2.WRITE))
+                 for i, d in enumerate(dats)]
+        base._trace.evaluate_all()
+        for i, (d, l) in enumerate(zip(dats, loops)):
+            assert not isinstance(l._jitmodule._fun, compilation.PendingFunction)
+            assert all(d.data_ro == i)
+
+    def test_background_compilation_error(self, skip_greedy, workers, iterset, diterset):
+        d = op2.Dat(diterset, numpy.zeros(nelems), numpy.uint32)
+        op2.par_loop(op2.Kernel("void k(unsigned int *x) { *x = ; }", "k"),
+                     iterset, d(op2.WRITE))
+        with pytest.raises(CompilationError):
+            base._trace.evaluate_all()
+
+
 class TestKernelCache:
 
     """
@@ -602,6 +675,60 @@ class TestKernelCache:
         k2 = op2.Kernel("void l(void *x) {}", 'l')
         assert k1 is not k2 and len(self.cache) == 2
 
+    def test_kernel_non_ascii_code(self):
+        """Kernels whose code is not ASCII should be cached."""
+        self.cache.clear()
+        code = u"void k(void *x) { /* \u00e9t\u00e9 \u2013 \u03b1 */ }"
+        assert op2.Kernel(code, 'k') is op2.Kernel(code, 'k')
+
+
+class TestCacheEviction:
+
+    """
+    Bounded cache tests.
+    """
+
+    @pytest.fixture
+    def max_entries(cls, request):
+        old = configuration['cache_max_entries']
+        configuration.unsafe_reconfigure(cache_max_entries=2)
+        request.addfinalizer(lambda: configuration.unsafe_reconfigure(cache_max_entries=old))
+
+    def test_kernel_cache_lru(self, max_entries):
+        cache = base.Kernel._cache
+        cache.clear()
+        k1 = op2.Kernel("void k1(void *x) {}", "k1")
+        op2.Kernel("void k2(void *x) {}", "k2")
+        # Touch k1, such that k2 is least recently used
+        assert op2.Kernel("void k1(void *x) {}", "k1") is k1
+        op2.Kernel("void k3(void *x) {}", "k3")
+        assert len(cache) == 2
+        assert k1.cache_key in cache
+
+    def test_object_cache_keeps_identity(self, max_entries, iterset):
+        dsets = [op2.DataSet(iterset, i) for i in range(1, 5)]
+        assert len(iterset._cache) == 4
+        assert all(op2.DataSet(iterset, i) is d for i, d in enumerate(dsets, 1))
+        x = op2.Dat(dsets[0])
+        op2.DataSet(iterset, 5)
+        assert x.dataset == op2.DataSet(iterset, 1)
+
+    def test_object_cache_bounded(self, max_entries, iterset):
+        dset = op2.DataSet(iterset, 1)
+        maps = [op2.Map(iterset, iterset, 1, list(range(nelems)))
+                for _ in range(4)]
+        sparsities = [op2.Sparsity(dset, m) for m in maps]
+        assert sum(isinstance(v, op2.Sparsity) for v in iterset._cache.values()) == 2
+        assert op2.Sparsity(dset, maps[-1]) is sparsities[-1]
+        assert op2.Sparsity(dset, maps[0]) is not sparsities[0]
+        assert op2.DataSet(iterset, 1) is dset
+
+    def test_cache_stats(self, iterset):
+        hits, misses, evictions = caching.cache_stats().get(base.LocalSet, (0, 0, 0))
+        op2.LocalSet(iterset)
+        op2.LocalSet(iterset)
+        assert caching.cache_stats()[base.LocalSet] == (hits + 1, misses + 1, evictions)
+
 
 class TestSparsityCache:
 
@@ -668,6 +795,46 @@ class TestSparsityCache:
         assert sp1 is sp2
 
 
+class TestSparsityDiskCache:
+
+    """
+    On-disk Sparsity pattern cache tests.
+    """
+
+    @pytest.fixture
+    def sparsity_cache(cls, request, tmpdir):
+        old = dict((k, configuration[k]) for k in ['sparsity_cache', 'cache_dir'])
+        configuration.unsafe_reconfigure(sparsity_cache=True, cache_dir=str(tmpdir))
+        request.addfinalizer(lambda: configuration.unsafe_reconfigure(**old))
+
+    def sparsity(self, values):
+        s = op2.Set(5)
+        return op2.Sparsity(s ** 1, op2.Map(s, s, 2, values))
+
+    def test_pattern_written(self, sparsity_cache, tmpdir):
+        self.sparsity([0, 1, 1, 2, 2, 3, 3, 4, 4, 0])
+        assert len(tmpdir.join("sparsity").listdir()) == 1
+
+    def test_pattern_loaded(self, sparsity_cache, monkeypatch):
+        values = [0, 1, 1, 2, 2, 3, 3, 4, 4, 0]
+        expected = self.sparsity(values)
+
+        def fail(*args, **kwargs):
+            raise AssertionError("Sparsity built despite cache hit")
+        monkeypatch.setattr(base, "build_sparsity", fail)
+        sp = self.sparsity(values)
+        assert sp is not expected
+        assert sp.nz == expected.nz
+        assert all(sp._rowptr == expected._rowptr)
+        assert all(sp._colidx == expected._colidx)
+        assert all(sp.nnz == expected.nnz)
+
+    def test_different_values_miss(self, sparsity_cache, tmpdir):
+        self.sparsity([0, 1, 1, 2, 2, 3, 3, 4, 4, 0])
+        self.sparsity([0, 2, 1, 3, 2, 4, 3, 0, 4, 1])
+        assert len(tmpdir.join("sparsity").listdir()) == 2
+
+
 if __name__ == '__main__':
     import os
     pytest.main(os.path.abspath(__file__))
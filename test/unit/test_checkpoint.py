@@ -0,0 +1,148 @@
+# This file is part of PyOP2
+#
+# PyOP2 is Copyright (c) 2012, Imperial College London and
+# others. Please see the AUTHORS file in the main source directory for
+# a full list of copyright holders.  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * The name of Imperial College London or that of other
+#       contributors may not be used to endorse or promote products
+#       derived from this software without specific prior written
+#       permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTERS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import absolute_import, print_function, division
+
+import os
+import pytest
+import numpy as np
+
+from pyop2 import op2, checkpoint
+
+nelems = 8
+
+
+@pytest.fixture
+def iterset():
+    return op2.Set(nelems, "iterset")
+
+
+@pytest.fixture
+def nodes():
+    return op2.Set(nelems + 1, "nodes")
+
+
+@pytest.fixture
+def edge2node(iterset, nodes):
+    values = np.array([(i, i + 1) for i in range(nelems)], dtype=np.int32)
+    return op2.Map(iterset, nodes, 2, values, "edge2node")
+
+
+@pytest.fixture
+def u(nodes):
+    return op2.Dat(nodes ** 2, np.arange(2 * (nelems + 1), dtype=np.float64), name="u")
+
+
+@pytest.fixture
+def mat(edge2node, nodes):
+    sparsity = op2.Sparsity(nodes, edge2node, "sparsity")
+    mat = op2.Mat(sparsity, np.float64, "mat")
+    kernel = op2.Kernel("""void k(double A[2][2]) {
+      for ( int i = 0; i < 2; ++i ) for ( int j = 0; j < 2; ++j ) A[i][j] += i + j + 1;
+    }""", "k")
+    op2.par_loop(kernel, edge2node.iterset,
+                 mat(op2.INC, (edge2node[op2.i[0]], edge2node[op2.i[1]])))
+    mat.assemble()
+    return mat
+
+
+class TestCheckpoint:
+
+    @pytest.mark.parametrize("shared", [False, True])
+    def test_dat_and_map(self, tmpdir, shared, u, edge2node):
+        filename = str(tmpdir.join("chk"))
+        checkpoint.save(filename, {"u": u, "map": edge2node}, shared=shared)
+        objects = checkpoint.load(filename)
+        assert list(objects) == ["u", "map"]
+        u2, m2 = objects["u"], objects["map"]
+        assert u2.name == "u" and u2.dim == (2, )
+        assert (u2.data_ro == u.data_ro).all()
+        assert (m2.values == edge2node.values).all()
+        # Shared objects are rebuilt once
+        assert m2.toset is u2.dataset.set
+        assert m2.toset.size == nelems + 1
+
+    def test_background(self, tmpdir, u):
+        filename = str(tmpdir.join("chk"))
+        expected = u.data_ro.copy()
+        request = checkpoint.save(filename, {"u": u}, background=True)
+        # Values were copied, modifying them does not change the checkpoint
+        u.data[:] = -1
+        request.wait()
+        assert request.done
+        assert (checkpoint.load(filename)["u"].data_ro == expected).all()
+
+    def test_overwrite(self, tmpdir, u):
+        filename = str(tmpdir.join("chk"))
+        checkpoint.save(filename, {"u": u})
+        u.data[:] = 1
+        checkpoint.save(filename, {"u": u})
+        assert (checkpoint.load(filename)["u"].data_ro == 1).all()
+
+    @pytest.mark.parametrize("shared", [False, True])
+    def test_switch_layout(self, tmpdir, shared, u):
+        filename = str(tmpdir.join("chk"))
+        checkpoint.save(filename, {"u": u}, shared=shared)
+        u.data[:] = 1
+        checkpoint.save(filename, {"u": u}, shared=not shared)
+        assert (checkpoint.load(filename)["u"].data_ro == 1).all()
+        assert ("checkpoint.ckp" in os.listdir(filename)) is not shared
+
+    def test_global_and_mixed(self, tmpdir, u, iterset):
+        filename = str(tmpdir.join("chk"))
+        g = op2.Global(2, [1.0, 2.0], name="g")
+        d = op2.Dat(op2.ExtrudedSet(iterset, 3), np.arange(nelems, dtype=np.float64))
+        checkpoint.save(filename, {"g": g, "m": op2.MixedDat([u, d])})
+        objects = checkpoint.load(filename)
+        assert (objects["g"].data_ro == [1.0, 2.0]).all()
+        m = objects["m"]
+        assert (m[0].data_ro == u.data_ro).all()
+        assert m[1].dataset.set.layers == 3
+        assert (m[1].data_ro == d.data_ro).all()
+
+    def test_mat(self, tmpdir, mat):
+        filename = str(tmpdir.join("chk"))
+        checkpoint.save(filename, {"mat": mat})
+        mat2 = checkpoint.load(filename)["mat"]
+        assert mat2.sparsity.nz == mat.sparsity.nz
+        assert (mat2.sparsity.nnz == mat.sparsity.nnz).all()
+        assert np.allclose(mat2.values, mat.values)
+
+    def test_not_a_checkpoint(self, tmpdir):
+        tmpdir.join("rank_0.ckp").write("garbage")
+        with pytest.raises(ValueError):
+            checkpoint.load(str(tmpdir))
+
+
+if __name__ == '__main__':
+    pytest.main(os.path.abspath(__file__))
@@ -132,6 +132,17 @@ class TestDat:
         mdat2.load(output)
         assert all(all(d.data_ro == d_.data_ro) for d, d_ in zip(mdat, mdat2))
 
+    def test_mixed_dat_save_and_load_sizes(self, tmpdir, d1):
+        """MixedDats with components of different sizes should round
+        trip through save and load."""
+        output = tmpdir.join('output').strpath
+        d2 = op2.Dat(op2.Set(3) ** 2, np.arange(6, dtype=np.float64))
+        op2.MixedDat([d1, d2]).save(output)
+        mdat = op2.MixedDat([op2.Dat(d1.dataset), op2.Dat(d2.dataset)])
+        mdat.load(output)
+        assert (mdat[0].data_ro == d1.data_ro).all()
+        assert (mdat[1].data_ro == d2.data_ro).all()
+
 
 if __name__ == '__main__':
     import os
@@ -39,6 +39,7 @@ import random
 from numpy.testing import assert_allclose
 
 from pyop2 import op2
+from pyop2.configuration import configuration
 from pyop2.computeind import compute_ind_extr
 
 from coffee.base import *
@@ -523,6 +524,69 @@ void comp_vol(double A[1], double *x[], double *y[])
         assert_allclose(sum(xtr_b.data), 6.0, eps)
 
 
+class TestColumnCodegen:
+
+    """
+    Extruded loops generated column by column
+    """
+
+    @pytest.fixture(autouse=True)
+    def columns(cls, request):
+        old = configuration['column_codegen']
+        configuration.unsafe_reconfigure(column_codegen=True)
+        request.addfinalizer(lambda: configuration.unsafe_reconfigure(column_codegen=old))
+
+    def test_independent_layers(self, elements, dat_coords, coords_map, field_map, dat_f):
+        kernel = op2.Kernel("void k(double *x[], double *y[]) { y[0][0] = x[0][0]; }", "k")
+        loop = op2.par_loop(kernel, elements,
+                            dat_coords(op2.READ, coords_map),
+                            dat_f(op2.WRITE, field_map))
+        assert loop._columns == "simd"
+
+    def test_shared_layers(self, elements, dat_coords, coords_map, dat_c):
+        kernel = op2.Kernel("void k(double *x[], double *y[]) { y[0][0] += x[0][0]; }", "k")
+        loop = op2.par_loop(kernel, elements,
+                            dat_coords(op2.READ, coords_map),
+                            dat_c(op2.INC, coords_map))
+        assert loop._columns == "serial"
+
+    def compare(self, kernel, elements, written, args, **kwargs):
+        """Execute the loop with and without column code generation and
+        compare the results written to the first argument."""
+        expected = op2.Dat(written.dataset, written.data_ro, dtype=written.dtype)
+        access, path = args[0]
+        op2.par_loop(kernel, elements, written(access, path),
+                     *[d(a, m) for d, a, m in args[1:]], **kwargs)
+        configuration.unsafe_reconfigure(column_codegen=False)
+        op2.par_loop(kernel, elements, expected(access, path),
+                     *[d(a, m) for d, a, m in args[1:]], **kwargs)
+        configuration.unsafe_reconfigure(column_codegen=True)
+        assert_allclose(written.data_ro, expected.data_ro)
+
+    def test_read_coord_neighbours_write_to_field(self, elements, dat_coords,
+                                                  coords_map, field_map, dat_f):
+        kernel = op2.Kernel("""void k(double* y[], double* x[]) {
+          double sum = 0.0;
+          for (int i=0; i<6; i++) sum += x[i][0] + x[i][1];
+          y[0][0] = sum;
+        }""", "k")
+        self.compare(kernel, elements, dat_f,
+                     [(op2.WRITE, field_map), (dat_coords, op2.READ, coords_map)])
+
+    def test_indirect_coords_inc(self, elements, dat_coords, coords_map, dat_c):
+        kernel = op2.Kernel("""void k(double* y[], double* x[]) {
+          for (int i=0; i<6; i++) { y[i][0] += x[i][0]; y[i][1] += 1; }
+        }""", "k")
+        self.compare(kernel, elements, dat_c,
+                     [(op2.INC, coords_map), (dat_coords, op2.READ, coords_map)])
+
+    def test_layer_arg(self, elements, field_map, dat_f):
+        kernel = op2.Kernel("void k(double* x[], int layer) { x[0][0] = layer; }", "k")
+        self.compare(kernel, elements, dat_f, [(op2.WRITE, field_map)],
+                     pass_layer_arg=True)
+        assert sorted(set(dat_f.data_ro)) == list(range(wedges))
+
+
 if __name__ == '__main__':
     import os
     pytest.main(os.path.abspath(__file__))
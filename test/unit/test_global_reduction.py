@@ -37,7 +37,7 @@ import pytest
 import numpy
 from numpy.testing import assert_allclose
 
-from pyop2 import op2
+from pyop2 import op2, base
 
 nelems = 4096
 
@@ -464,3 +464,32 @@ void kernel_max(double* x, double* g)
         g.zero()
         loop()
         assert_allclose(g.data, set.size)
+
+    def test_combined_reductions(self, k1_inc_to_global, k1_min_to_global, set, d1):
+        g = op2.Global(1, 0, dtype=numpy.uint32)
+        h = op2.Global(1, nelems + 1, dtype=numpy.uint32)
+        op2.par_loop(k1_inc_to_global, set, d1(op2.READ), g(op2.INC))
+        op2.par_loop(k1_min_to_global, set, d1(op2.READ), h(op2.MIN))
+        op2.par_loop(k1_inc_to_global, set, d1(op2.READ), g(op2.INC))
+        base._trace.evaluate_all()
+        assert g.data == 2 * d1.data.sum()
+        assert h.data == min(d1.data.min(), nelems + 1)
+
+    def test_inner_products(self):
+        s = op2.Set(2)
+        t = op2.Set(1)
+        x = op2.Dat(s, [3, 4], numpy.float64)
+        y = op2.Dat(s, [4, 5], numpy.float64)
+        m = op2.MixedDat([op2.Dat(s, [1, 2], numpy.float64),
+                          op2.Dat(t, [3], numpy.float64)])
+        assert_allclose(op2.inner_products([(x, y), (x, x), (m, m), (y, x)]),
+                        [32, 25, 14, 32])
+
+    def test_reduction_left_in_flight(self, k1_inc_to_global, set, d1):
+        g = op2.Global(1, 0, dtype=numpy.uint32)
+        op2.par_loop(k1_inc_to_global, set, d1(op2.READ), g(op2.INC))
+        # Forces the loop, but not the reduction
+        base._trace.evaluate(None, [d1])
+        assert any(g in b.globals for b in base._trace._inflight)
+        assert g.data == d1.data.sum()
+        assert not base._trace._inflight
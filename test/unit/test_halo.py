@@ -0,0 +1,116 @@
+# This file is part of PyOP2
+#
+# PyOP2 is Copyright (c) 2012, Imperial College London and
+# others. Please see the AUTHORS file in the main source directory for
+# a full list of copyright holders.  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * The name of Imperial College London or that of other
+#       contributors may not be used to endorse or promote products
+#       derived from this software without specific prior written
+#       permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTERS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Halo exchange unit tests.
+"""
+
+from __future__ import absolute_import, print_function, division
+
+import pytest
+import numpy as np
+
+from pyop2 import op2, base
+
+
+class TestHaloPattern:
+
+    """The packed layout of halo exchanges."""
+
+    def test_packed_by_rank(self):
+        pattern = base._HaloPattern(None, {3: np.array([4, 5]), 1: np.array([0])},
+                                    {2: np.array([7, 8, 9])})
+        assert pattern.destinations == [1, 3]
+        assert pattern.sources == [2]
+        assert list(pattern.send_indices) == [0, 4, 5]
+        assert list(pattern.send_offsets) == [0, 1, 3]
+        assert list(pattern.recv_indices) == [7, 8, 9]
+        assert list(pattern.recv_offsets) == [0, 3]
+
+    def test_no_neighbours(self):
+        pattern = base._HaloPattern(None, {}, {})
+        assert len(pattern.send_indices) == 0
+        assert list(pattern.recv_offsets) == [0]
+
+    def test_shared_receives(self):
+        pattern = base._HaloPattern(None, {}, {1: np.array([0, 1]), 2: np.array([1])})
+        assert not pattern.unique_receives
+        pattern = base._HaloPattern(None, {}, {1: np.array([0]), 2: np.array([1])})
+        assert pattern.unique_receives
+
+
+class TestHaloBatching:
+
+    """Grouping of Dats into batched exchanges."""
+
+    @pytest.fixture
+    def halo(cls):
+        return base.Halo({}, {})
+
+    def test_group_by_halo(self, halo):
+        s1 = op2.Set(4, halo=halo)
+        s2 = op2.Set(4, halo=base.Halo({}, {}))
+        s3 = op2.Set(4)
+        d1, d2 = op2.Dat(s1), op2.Dat(s1 ** 2)
+        d3, d4 = op2.Dat(s2), op2.Dat(s3)
+        groups = base._halo_groups([d1, op2.MixedDat([d2, d3]), d4, d1])
+        assert groups == [(halo, (d1, d2)), (s2.halo, (d3, ))]
+
+    def test_exchange(self, halo):
+        s = op2.Set(4, halo=halo)
+        d1, d2 = op2.Dat(s, range(4), dtype=np.float64), op2.Dat(s ** 2, dtype=np.int32)
+        base._halo_exchange_begin([d1, d2])
+        base._halo_exchange_end([d1, d2])
+        assert list(d1.data_ro) == list(range(4))
+        assert len(d1._halo_exchanges) == 1
+        assert not d2._halo_exchanges
+
+    def test_exchange_reused(self, halo):
+        s = op2.Set(4, halo=halo)
+        d = op2.Dat(s, dtype=np.float64)
+        for _ in range(3):
+            tmp = op2.Dat(s, dtype=np.float64)
+            base._halo_exchange_begin([d, tmp])
+            base._halo_exchange_end([d, tmp])
+        base._halo_exchange_begin([d, tmp], reverse=True)
+        base._halo_exchange_end([d, tmp], reverse=True)
+        assert len(d._halo_exchanges) == 2
+
+    def test_exchange_freed(self, halo):
+        s = op2.Set(4, halo=halo)
+        d = op2.Dat(s, dtype=np.float64)
+        base._halo_exchange_begin([d])
+        base._halo_exchange_end([d])
+        exchange, = d._halo_exchanges.values()
+        exchange.free()
+        assert exchange.requests == []
@@ -109,6 +109,19 @@ class TestHDF5:
         assert d.soa
         assert d.data.shape == (5, 2) and d.data.sum() == 9 * 10 / 2
 
+    def test_dat_hdf5_indices(self, h5file):
+        "Creating a dat from a selection of rows of h5file should work"
+        d = op2.Dat.fromhdf5(op2.Set(3) ** 2, h5file, 'dat', indices=[4, 0, 1])
+        assert (d.data_ro == np.arange(10).reshape(5, 2)[[4, 0, 1]]).all()
+
+    def test_dat_hdf5_mmap(self, h5file, dset):
+        "A memory mapped dat should not write back to h5file"
+        h5file.flush()
+        d = op2.Dat.fromhdf5(dset, h5file, 'dat', mmap=True)
+        assert d.data_ro.sum() == 9 * 10 / 2
+        d.data[0] = 100
+        assert h5file['dat'][0, 0] == 0
+
     def test_map_hdf5(self, iterset, toset, h5file):
         "Should be able to create Map from hdf5 file."
         m = op2.Map.fromhdf5(iterset, toset, h5file, name="map")
@@ -117,3 +130,9 @@ class TestHDF5:
         assert m.arity == 2
         assert m.values.sum() == sum((1, 2, 2, 3))
         assert m.name == 'map'
+
+    def test_map_hdf5_indices(self, toset, h5file):
+        "Should be able to create a Map from a selection of rows."
+        m = op2.Map.fromhdf5(op2.Set(1), toset, h5file, name="map", indices=[1])
+        assert m.arity == 2
+        assert m.values.tolist() == [[2, 3]]
@@ -159,6 +159,43 @@ sum(unsigned int* sum, unsigned int* x)
         assert sum(y.data) == nelems
         assert not base._trace.in_queue(pl_copy)
 
+    def test_levels(self, skip_greedy, iterset):
+        """Independent computations are scheduled in the same level."""
+        base._trace.clear()
+        x = op2.Dat(iterset, numpy.zeros(nelems), numpy.uint32, "x")
+        y = op2.Dat(iterset, numpy.zeros(nelems), numpy.uint32, "y")
+        z = op2.Dat(iterset, numpy.zeros(nelems), numpy.uint32, "z")
+        k = op2.Kernel("void k(unsigned int *x) { *x = 1; }", "k")
+        k2 = op2.Kernel("void k2(unsigned int *x, unsigned int *y) { *x = *y; }", "k2")
+
+        pl_x = op2.par_loop(k, iterset, x(op2.WRITE))
+        pl_y = op2.par_loop(k, iterset, y(op2.WRITE))
+        pl_z = op2.par_loop(k2, iterset, z(op2.WRITE), x(op2.READ))
+        pl_x2 = op2.par_loop(k, iterset, x(op2.WRITE))
+
+        levels = base._trace.levels()
+        assert set(levels[0]) == set([pl_x, pl_y])
+        assert levels[1] == [pl_z]
+        assert levels[2] == [pl_x2]
+
+        # Reading y does not touch the chain on x
+        assert sum(y.data_ro) == nelems
+        assert base._trace._trace == [pl_x, pl_z, pl_x2]
+        assert sum(z.data_ro) == nelems
+        assert base._trace._trace == [pl_x2]
+        base._trace.evaluate_all()
+
+    def test_reenqueue(self, skip_greedy, iterset):
+        """A computation enqueued twice runs twice, in order."""
+        g = op2.Global(1, 1, numpy.uint32, "g")
+        k = op2.Kernel("void k(unsigned int *g) { *g += 1; }", "k")
+        g.zero()
+        op2.par_loop(k, iterset, g(op2.INC))
+        g.zero()
+        op2.par_loop(k, iterset, g(op2.INC))
+        op2.par_loop(k, iterset, g(op2.INC))
+        assert g.data[0] == 2 * nelems
+
 
 if __name__ == '__main__':
     import os
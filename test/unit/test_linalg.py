@@ -36,7 +36,7 @@ from __future__ import absolute_import, print_function, division
 import pytest
 import numpy as np
 
-from pyop2 import op2
+from pyop2 import op2, base
 
 nelems = 8
 
@@ -344,3 +344,54 @@ class TestLinAlgScalar:
         ret = md1.inner(md)
 
         assert abs(ret - 32) < 1e-12
+
+
+class TestLinAlgFusion:
+
+    """
+    Tests of deferred, fused evaluation of linear algebra expressions.
+    """
+
+    def test_compound_expression_deferred(self, x, y):
+        x._data = 2 * y.data
+        z = 2.0 * x + y - x / 2.0
+        assert z._deferred_expression is not None
+        assert not z._is_allocated
+        assert np.allclose(z.data_ro, 4 * y.data_ro)
+        assert z._deferred_expression is None
+
+    def test_compound_expression_single_loop(self, x, y, monkeypatch):
+        x._data = 2 * y.data
+        loops = []
+        append = base.ExecutionTrace.append
+
+        def record(self, computation):
+            loops.append(computation)
+            append(self, computation)
+        monkeypatch.setattr(base.ExecutionTrace, "append", record)
+        z = (x + y) * (x - y) + 1.0
+        assert np.allclose(z.data_ro, 3 * y.data_ro ** 2 + 1)
+        assert len(loops) == 1
+
+    def test_leaf_written_after_expression(self, x, y):
+        x._data = 2 * y.data
+        expected = 3 * y.data_ro
+        z = x + y
+        x.data[:] = 0
+        assert np.allclose(z.data_ro, expected)
+
+    def test_iop_on_deferred(self, x, y):
+        x._data = 2 * y.data
+        z = x - y
+        z *= 2.0
+        z += y
+        assert z._deferred_expression is not None
+        assert np.allclose(z.data_ro, 3 * y.data_ro)
+
+    def test_itype_intermediates_truncated(self, yi):
+        z = yi / 2.0 * 2.0
+        assert np.allclose(z.data_ro, (yi.data_ro // 2) * 2)
+
+    def test_inner_of_expression(self, x, y):
+        x._data = 2 * y.data
+        assert abs((x - y).inner(y) - np.dot(y.data_ro, y.data_ro)) < 1e-12
@@ -875,6 +875,17 @@ class TestMatrixStateChanges:
         assert np.allclose(mat[0, 1].values, 0)
         assert np.allclose(mat[1, 0].values, 0)
 
+    def test_batched_insertion(self, mat):
+        mat[0, 0].addto_values_batched([[0, 1], [1, 2]], [[0, 1], [1, 2]],
+                                       np.ones((2, 2, 2)))
+        mat._force_evaluation()
+        assert mat[0, 0].assembly_state is op2.Mat.ADD_VALUES
+        mat[1, 1].set_values_batched([[0], [3]], [[0], [3]], [[[2]], [[5]]])
+        mat.assemble()
+
+        assert np.allclose(mat[0, 0].values, [[1, 1, 0], [1, 2, 1], [0, 1, 1]])
+        assert np.allclose(mat[1, 1].values, np.diag([2, 0, 0, 5]))
+
     def test_assembly_flushed_between_insert_and_add(self, mat):
         import types
         flush_counter = [0]
@@ -903,6 +914,57 @@ class TestMatrixStateChanges:
         assert flush_counter[0] == 1
 
 
+class TestMatrixFree:
+    """
+    Matrix-free operator tests
+    """
+
+    @pytest.fixture
+    def action(self):
+        kernel_code = """
+void action(double **y, double **x, double *g)
+{
+  for ( int i = 0; i < 3; i++ )
+    for ( int j = 0; j < 3; j++ )
+      y[i][0] += (*g) * x[j][0];
+}
+"""
+        return op2.Kernel(kernel_code, "action")
+
+    def test_mult_matches_assembled(self, nodes, elements, elem_node,
+                                    kernel_inc, action):
+        """The action of a matrix-free operator matches the assembled
+        matrix."""
+        g = op2.Global(1, 2.0, valuetype)
+        x = op2.Dat(nodes, np.arange(1, NUM_NODES + 1), valuetype)
+        y = op2.Dat(nodes, dtype=valuetype)
+        mat = op2.Mat(op2.Sparsity(nodes, elem_node), valuetype)
+        op2.par_loop(kernel_inc, elements,
+                     mat(op2.INC, (elem_node[op2.i[0]], elem_node[op2.i[1]])),
+                     g(op2.READ))
+        mat.assemble()
+        op = op2.MatrixFree(nodes, action, elements, elem_node,
+                            args=(g(op2.READ),))
+        op.mult(x, y)
+        assert_allclose(y.data_ro, mat.values.dot(x.data_ro), 1e-14)
+
+    def test_mult_reuses_par_loop(self, nodes, elements, elem_node,
+                                  action):
+        """Repeated products enqueue the same par_loop."""
+        g = op2.Global(1, 1.0, valuetype)
+        x = op2.Dat(nodes, np.ones(NUM_NODES), valuetype)
+        y = op2.Dat(nodes, dtype=valuetype)
+        op = op2.MatrixFree(nodes, action, elements, elem_node,
+                            args=(g(op2.READ),))
+        loop = op._loop
+        op.mult(x, y)
+        first = y.data_ro.copy()
+        op.mult(x, y)
+        assert op._loop is loop
+        assert_allclose(y.data_ro, first, 1e-14)
+        assert op.handle.getSize() == (NUM_NODES, NUM_NODES)
+
+
 class TestMixedMatrices:
     """
     Matrix tests for mixed spaces
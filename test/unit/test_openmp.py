@@ -0,0 +1,155 @@
+# This file is part of PyOP2
+#
+# PyOP2 is Copyright (c) 2012, Imperial College London and
+# others. Please see the AUTHORS file in the main source directory for
+# a full list of copyright holders.  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * The name of Imperial College London or that of other
+#       contributors may not be used to endorse or promote products
+#       derived from this software without specific prior written
+#       permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTERS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+from __future__ import absolute_import, print_function, division
+
+import pytest
+import numpy as np
+
+from pyop2 import op2, openmp
+from pyop2.base import SetPartition
+from pyop2.configuration import configuration
+
+
+nelems = 1024
+
+
+@pytest.fixture
+def backend(request):
+    old = configuration['backend']
+    configuration.unsafe_reconfigure(backend='openmp')
+    request.addfinalizer(lambda: configuration.unsafe_reconfigure(backend=old))
+
+
+@pytest.fixture
+def nodes():
+    return op2.Set(nelems, "nodes")
+
+
+@pytest.fixture
+def edges():
+    return op2.Set(nelems - 1, "edges")
+
+
+@pytest.fixture
+def edge2node(edges, nodes):
+    return op2.Map(edges, nodes, 2,
+                   np.array([(i, i + 1) for i in range(nelems - 1)], dtype=np.int32),
+                   "edge2node")
+
+
+class TestPlan:
+
+    """
+    Colouring plan tests
+    """
+
+    def test_plan_cached(self, edges, edge2node):
+        assert openmp.Plan(edges, edge2node) is openmp.Plan(edges, edge2node)
+
+    def test_plan_direct_one_colour(self, edges):
+        plan = openmp.Plan(edges)
+        assert plan.ncolours == 1
+        elements, offsets = plan.partition(SetPartition(edges, 0, edges.size))
+        assert (elements == np.arange(edges.size)).all()
+        assert list(offsets) == [0, edges.size]
+
+    def test_plan_colours_conflict_free(self, edges, edge2node):
+        plan = openmp.Plan(edges, edge2node)
+        assert plan.ncolours == 2
+        for c in range(plan.ncolours):
+            touched = edge2node.values[plan.colours == c].ravel()
+            assert len(touched) == len(np.unique(touched))
+
+    def test_plan_partition(self, edges, edge2node):
+        plan = openmp.Plan(edges, edge2node)
+        part = SetPartition(edges, 10, 100)
+        elements, offsets = plan.partition(part)
+        assert sorted(elements) == list(range(10, 110))
+        for c in range(plan.ncolours):
+            assert (plan.colours[elements[offsets[c]:offsets[c + 1]]] == c).all()
+
+
+class TestOpenMPLoop:
+
+    """
+    Parallel loops executed with the OpenMP backend
+    """
+
+    def test_parloop_type(self, backend, edges, edge2node, nodes):
+        d = op2.Dat(nodes, dtype=np.float64)
+        k = op2.Kernel("void k(double *x) { x[0] += 1.0; }", "k")
+        arg = d(op2.INC, edge2node[0])
+        assert isinstance(arg, openmp.Arg)
+        assert isinstance(op2.par_loop(k, edges, arg), openmp.ParLoop)
+
+    def test_direct_write(self, backend, nodes):
+        d = op2.Dat(nodes, dtype=np.float64)
+        k = op2.Kernel("void k(double *x) { x[0] = 42.0; }", "k")
+        op2.par_loop(k, nodes, d(op2.WRITE))
+        assert (d.data_ro == 42.0).all()
+
+    def test_indirect_inc(self, backend, edges, nodes, edge2node):
+        d = op2.Dat(nodes, dtype=np.float64)
+        k = op2.Kernel("void k(double **x) { x[0][0] += 1.0; x[1][0] += 1.0; }", "k")
+        op2.par_loop(k, edges, d(op2.INC, edge2node))
+        expected = np.full(nelems, 2.0)
+        expected[0] = expected[-1] = 1.0
+        assert (d.data_ro == expected).all()
+
+    def test_global_inc(self, backend, nodes):
+        d = op2.Dat(nodes, np.arange(nelems, dtype=np.float64))
+        g = op2.Global(1, 0.0, np.float64)
+        k = op2.Kernel("void k(double *x, double *g) { g[0] += x[0]; }", "k")
+        op2.par_loop(k, nodes, d(op2.READ), g(op2.INC))
+        assert g.data[0] == nelems * (nelems - 1) // 2
+
+    def test_global_max(self, backend, nodes):
+        d = op2.Dat(nodes, np.arange(nelems, dtype=np.float64))
+        g = op2.Global(1, 0.0, np.float64)
+        k = op2.Kernel("void k(double *x, double *g) { if (x[0] > g[0]) g[0] = x[0]; }", "k")
+        op2.par_loop(k, nodes, d(op2.READ), g(op2.MAX))
+        assert g.data[0] == nelems - 1
+
+    def test_subset_inc(self, backend, edges, nodes, edge2node):
+        d = op2.Dat(nodes, dtype=np.float64)
+        ss = op2.Subset(edges, np.arange(0, nelems - 1, 2))
+        k = op2.Kernel("void k(double **x) { x[0][0] += 1.0; x[1][0] += 1.0; }", "k")
+        op2.par_loop(k, ss, d(op2.INC, edge2node))
+        assert (d.data_ro == 1.0).all()
+
+
+if __name__ == '__main__':
+    import os
+    pytest.main(os.path.abspath(__file__))
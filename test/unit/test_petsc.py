@@ -62,3 +62,32 @@ class TestPETSc:
 
         with d.vec_ro as v:
             assert np.allclose(v.norm(), 2.0)
+
+    def test_mixed_vec_wraps_storage(self):
+        s = op2.Set(3)
+        m = op2.MixedDat(op2.MixedSet([s, s]) ** 1)
+        m[0].data[:] = 1
+        m[1].data[:] = 2
+
+        with m.vec as v:
+            assert np.allclose(v.array_r, [1, 1, 1, 2, 2, 2])
+            v.array[:] = np.arange(6)
+
+        # Writes through the Vec are seen by the components without
+        # a reverse scatter.
+        assert np.allclose(m[0].data_ro, [0, 1, 2])
+        assert np.allclose(m[1].data_ro, [3, 4, 5])
+
+    def test_mixed_vec_norm_changes(self):
+        s = op2.Set(1)
+        m = op2.MixedDat([s, s])
+
+        m[0].data[:] = 1
+
+        with m.vec_ro as v:
+            assert np.allclose(v.norm(), 1.0)
+
+        m[1].data[:] = 1
+
+        with m.vec_ro as v:
+            assert np.allclose(v.norm(), np.sqrt(2))
@@ -0,0 +1,170 @@
+# This file is part of PyOP2
+#
+# PyOP2 is Copyright (c) 2012, Imperial College London and
+# others. Please see the AUTHORS file in the main source directory for
+# a full list of copyright holders.  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * The name of Imperial College London or that of other
+#       contributors may not be used to endorse or promote products
+#       derived from this software without specific prior written
+#       permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTERS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import absolute_import, print_function, division
+from six.moves import range
+
+import csv
+import json
+import pytest
+import numpy as np
+import random
+import six
+
+from pyop2 import op2
+from pyop2.configuration import configuration
+from pyop2.datatypes import IntType
+from pyop2.profiling import profiler
+
+
+nelems = 4096
+
+
+@pytest.fixture(params=[(nelems, nelems, nelems, nelems),
+                        (0, nelems, nelems, nelems),
+                        (nelems // 2, nelems, nelems, nelems)])
+def iterset(request):
+    return op2.Set(request.param, "iterset")
+
+
+@pytest.fixture
+def indset():
+    return op2.Set(nelems, "indset")
+
+
+@pytest.fixture
+def x(indset):
+    return op2.Dat(indset, list(range(nelems)), np.uint32, "x")
+
+
+@pytest.fixture
+def mapd():
+    mapd = list(range(nelems))
+    random.shuffle(mapd, lambda: 0.02041724)
+    return mapd
+
+
+@pytest.fixture
+def iterset2indset(iterset, indset, mapd):
+    u_map = np.array(mapd, dtype=np.uint32)
+    return op2.Map(iterset, indset, 1, u_map, "iterset2indset")
+
+
+@pytest.fixture
+def iterset2indset2(iterset, indset, mapd):
+    u_map = np.array([mapd, mapd], dtype=np.uint32)
+    return op2.Map(iterset, indset, 2, u_map, "iterset2indset2")
+
+
+class TestProfiling:
+
+    """
+    Per par_loop performance counters
+    """
+
+    @pytest.fixture
+    def profiling(cls, request):
+        old = configuration['profiling']
+        configuration.unsafe_reconfigure(profiling=True)
+        profiler.reset()
+
+        def restore():
+            configuration.unsafe_reconfigure(profiling=old)
+            profiler.reset()
+        request.addfinalizer(restore)
+
+    @pytest.fixture
+    def kernel(cls):
+        return op2.Kernel("void k(unsigned int *x) { *x += 1; }", "k")
+
+    def test_not_collected_by_default(self, iterset, x, iterset2indset, kernel):
+        profiler.reset()
+        op2.par_loop(kernel, iterset, x(op2.RW, iterset2indset))
+        x.data
+        assert len(profiler) == 0
+
+    def test_counters(self, profiling, iterset, x, iterset2indset, kernel):
+        for _ in range(2):
+            op2.par_loop(kernel, iterset, x(op2.RW, iterset2indset))
+        x.data
+        assert len(profiler) == 1
+        profile, = profiler
+        assert profile.name == "k on iterset"
+        assert profile.calls == 2
+        assert profile.elements == 2 * nelems
+        # Value read and written back, plus the map entry
+        itemsize = np.dtype(IntType).itemsize
+        assert profile.bytes == 2 * nelems * (2 * x.dtype.itemsize + itemsize)
+        assert profile.time >= 0
+
+    def test_data_movement(self, iterset, x, iterset2indset2):
+        y = op2.Dat(iterset ** 2, dtype=np.float64)
+        k = op2.Kernel("""void k(unsigned int **x, double *y) {
+          *x[0] += y[0]; *x[1] += y[1];
+        }""", "k")
+        loop = op2.par_loop(k, iterset, x(op2.INC, iterset2indset2), y(op2.READ))
+        itemsize = np.dtype(IntType).itemsize
+        values = 2 * x.dtype.itemsize
+        assert loop.nbytes_read == nelems * (values + 2 * itemsize + 2 * 8)
+        assert loop.nbytes_written == nelems * values
+        assert loop.nbytes == loop.nbytes_read + loop.nbytes_written
+        assert loop.arithmetic_intensity == loop.num_flops / loop.nbytes
+        x.data
+
+    def test_report(self, profiling, iterset, x, iterset2indset, kernel):
+        op2.par_loop(kernel, iterset, x(op2.RW, iterset2indset))
+        x.data
+        profile, = profiler
+        assert profile.bytes == profile.bytes_read + profile.bytes_written
+        assert profile.bytes_written == nelems * x.dtype.itemsize
+        stream = six.StringIO()
+        profiler.report(stream)
+        assert "k on iterset" in stream.getvalue()
+
+    def test_export(self, profiling, tmpdir, iterset, x, iterset2indset, kernel):
+        op2.par_loop(kernel, iterset, x(op2.RW, iterset2indset))
+        x.data
+        exported = json.loads(profiler.to_json())
+        assert [p["name"] for p in exported] == ["k on iterset"]
+        assert exported[0]["elements"] == nelems
+        fname = str(tmpdir.join("profile.csv"))
+        profiler.to_csv(fname)
+        with open(fname) as f:
+            rows = list(csv.DictReader(f))
+        assert len(rows) == 1
+        assert int(rows[0]["calls"]) == 1
+
+
+if __name__ == '__main__':
+    import os
+    pytest.main(os.path.abspath(__file__))
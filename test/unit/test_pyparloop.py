@@ -37,6 +37,15 @@ import pytest
 import numpy as np
 
 from pyop2 import op2
+from pyop2.configuration import configuration
+
+
+@pytest.fixture
+def numba(request):
+    pytest.importorskip("numba")
+    old = configuration['numba']
+    configuration.unsafe_reconfigure(numba=True)
+    request.addfinalizer(lambda: configuration.unsafe_reconfigure(numba=old))
 
 
 @pytest.fixture
@@ -202,6 +211,171 @@ class TestPyParLoop:
         assert (mat.values == expected).all()
 
 
+class TestBatchedPyParLoop:
+
+    """
+    Batched Python par_loop tests
+    """
+    def test_direct(self, s1, d1):
+        d1.data[:] = range(4)
+
+        def fn(a):
+            a[:, 0] *= 2.0
+
+        op2.par_loop(fn, s1, d1(op2.RW), batch_size=3)
+        assert np.allclose(d1.data, [0, 2, 4, 6])
+
+    def test_chunks(self, s1, d1):
+
+        def fn(a):
+            a[:, 0] = len(a)
+
+        op2.par_loop(fn, s1, d1(op2.WRITE), batch_size=3)
+        assert np.allclose(d1.data, [3, 3, 3, 1])
+
+    def test_invalid_batch_size(self, s1, d1):
+
+        def fn(a):
+            pass
+
+        with pytest.raises(ValueError):
+            op2.par_loop(fn, s1, d1(op2.WRITE), batch_size=0)
+
+    def test_direct_read_indirect(self, s1, d1, d2, m12):
+        d2.data[:] = range(4)
+
+        def fn(a, b):
+            a[:, 0] = b[:, 0]
+
+        op2.par_loop(fn, s1, d1(op2.WRITE), d2(op2.READ, m12), batch_size=3)
+        assert np.allclose(d1.data, d2.data[m12.values].reshape(-1))
+
+    def test_indirect_inc_vector_map(self, s1, d1, d2, m2):
+        d1.data[:] = range(4)
+        d2.data[:] = 1.0
+
+        def fn(a, b):
+            a[:, :] += b
+
+        op2.par_loop(fn, s1, d2(op2.INC, m2), d1(op2.READ), batch_size=3)
+        # Every node is shared by two elements
+        assert np.allclose(d2.data, [4, 2, 4, 6])
+
+    def test_direct_subset(self, s1, d1):
+        subset = op2.Subset(s1, [1, 3])
+        d1.data[:] = 1.0
+
+        def fn(a):
+            a[:, 0] = 0.0
+
+        op2.par_loop(fn, subset, d1(op2.WRITE), batch_size=1)
+
+        expect = np.ones_like(d1.data)
+        expect[subset.indices] = 0.0
+        assert np.allclose(d1.data, expect)
+
+    def test_global_inc(self, s1, d1):
+        d1.data[:] = range(4)
+        g = op2.Global(1, 0.0)
+
+        def fn(a, b):
+            a[0] += b.sum()
+
+        op2.par_loop(fn, s1, g(op2.INC), d1(op2.READ), batch_size=3)
+        assert g.data[0] == 6.0
+
+    def test_cant_write_to_read(self, s1, d1):
+
+        def fn(a):
+            a[:, 0] = 1.0
+
+        with pytest.raises((RuntimeError, ValueError)):
+            op2.par_loop(fn, s1, d1(op2.READ), batch_size=2)
+            assert np.allclose(d1.data, 0.0)
+
+    def test_matrix_addto(self, s1, m2, mat):
+
+        def fn(a):
+            a[:, :, :] = 1.0
+
+        expected = np.array([[2., 1., 0., 1.],
+                             [1., 2., 1., 0.],
+                             [0., 1., 2., 1.],
+                             [1., 0., 1., 2.]])
+
+        op2.par_loop(fn, s1, mat(op2.INC, (m2[op2.i[0]], m2[op2.i[0]])), batch_size=3)
+
+        assert (mat.values == expected).all()
+
+
+class TestNumbaPyParLoop:
+
+    """
+    Numba compiled Python par_loop tests
+    """
+    def test_direct(self, numba, s1, d1):
+        d1.data[:] = range(4)
+
+        def fn(a):
+            a[0] = 2.0 * a[0]
+
+        op2.par_loop(fn, s1, d1(op2.RW))
+        assert np.allclose(d1.data, [0, 2, 4, 6])
+
+    def test_indirect_read(self, numba, s1, d1, d2, m12):
+        d2.data[:] = range(4)
+
+        def fn(a, b):
+            a[0] = b[0]
+
+        op2.par_loop(fn, s1, d1(op2.WRITE), d2(op2.READ, m12))
+        assert np.allclose(d1.data, d2.data[m12.values].reshape(-1))
+
+    def test_indirect_inc_vector_map(self, numba, s1, d1, d2, m2):
+        d1.data[:] = range(4)
+        d2.data[:] = 1.0
+
+        def fn(a, b):
+            a[0] += b[0]
+            a[1] += b[0]
+
+        op2.par_loop(fn, s1, d2(op2.INC, m2), d1(op2.READ))
+        assert np.allclose(d2.data, [4, 2, 4, 6])
+
+    def test_indirect_read_direct_subset(self, numba, s1, d1, d2, m12):
+        subset = op2.Subset(s1, [1, 3])
+        d1.data[:] = range(4)
+        d2.data[:] = 10.0
+
+        def fn(a, b):
+            a[0] = b[0]
+
+        op2.par_loop(fn, subset, d2(op2.WRITE, m12), d1(op2.READ))
+
+        expect = np.empty_like(d2.data)
+        expect[:] = 10.0
+        expect[m12.values[subset.indices]] = d1.data[subset.indices]
+        assert np.allclose(d2.data, expect)
+
+    def test_global_inc(self, numba, s1, d1):
+        d1.data[:] = range(4)
+        g = op2.Global(1, 0.0)
+
+        def fn(a, b):
+            a[0] += b[0]
+
+        op2.par_loop(fn, s1, g(op2.INC), d1(op2.READ))
+        assert g.data[0] == 6.0
+
+    def test_matrix_falls_back(self, numba, s1, m2, mat):
+
+        def fn(a):
+            a[:, :] = 1.0
+
+        op2.par_loop(fn, s1, mat(op2.INC, (m2[op2.i[0]], m2[op2.i[0]])))
+        assert mat.values.sum() == 16.0
+
+
 if __name__ == '__main__':
     import os
     pytest.main(os.path.abspath(__file__))
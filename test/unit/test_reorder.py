@@ -0,0 +1,155 @@
+# This file is part of PyOP2
+#
+# PyOP2 is Copyright (c) 2012-2014, Imperial College London and
+# others. Please see the AUTHORS file in the main source directory for
+# a full list of copyright holders.  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * The name of Imperial College London or that of other
+#       contributors may not be used to endorse or promote products
+#       derived from this software without specific prior written
+#       permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTERS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+from __future__ import absolute_import, print_function, division
+
+import pytest
+import numpy as np
+
+from pyop2 import op2, openmp, reorder
+
+nelems = 32
+
+
+@pytest.fixture
+def iterset():
+    return op2.Set(nelems, "iterset")
+
+
+@pytest.fixture
+def nodes():
+    return op2.Set(nelems + 1, "nodes")
+
+
+@pytest.fixture
+def numbering():
+    # A line of edges with randomly numbered nodes
+    return np.random.RandomState(0).permutation(nelems + 1)
+
+
+@pytest.fixture
+def edge2node(iterset, nodes, numbering):
+    values = np.array([(numbering[i], numbering[i + 1]) for i in range(nelems)],
+                      dtype=np.int32)
+    return op2.Map(iterset, nodes, 2, values, "edge2node")
+
+
+@pytest.fixture
+def x(nodes, numbering):
+    # The position of each node along the line
+    values = np.empty(nelems + 1)
+    values[numbering] = np.arange(nelems + 1)
+    return op2.Dat(nodes, values, np.float64, "x")
+
+
+@pytest.fixture
+def length():
+    return op2.Kernel("""void length(double *l, double **x) {
+      l[0] = x[1][0] - x[0][0];
+    }""", "length")
+
+
+class TestReorder:
+
+    @pytest.mark.parametrize("method", ["rcm", "nd"])
+    def test_permutation(self, nodes, edge2node, method):
+        perm = reorder.permutation(nodes, edge2node, method=method)
+        assert sorted(perm) == list(range(nodes.total_size))
+
+    def test_rcm_reduces_bandwidth(self, nodes, iterset, edge2node):
+        perm = reorder.permutation(nodes, edge2node)
+        reorder.renumber({nodes: perm}, maps=[edge2node])
+        values = edge2node.values
+        assert abs(values[:, 0] - values[:, 1]).max() == 1
+
+    def test_morton(self, nodes, x):
+        perm = reorder.permutation(nodes, method="morton", coordinates=x)
+        assert (np.diff(x.data_ro[perm]) > 0).all()
+
+    def test_follow(self, nodes, iterset, edge2node):
+        perm = reorder.permutation(nodes, edge2node)
+        eperm = reorder.follow(iterset, edge2node, perm)
+        reorder.renumber({nodes: perm, iterset: eperm}, maps=[edge2node])
+        first = edge2node.values.min(axis=1)
+        assert (np.diff(first) >= 0).all()
+
+    def test_renumber_preserves_results(self, nodes, iterset, edge2node, x, length):
+        lengths = op2.Dat(iterset, dtype=np.float64)
+        boundary = op2.Subset(nodes, [int(np.argmin(x.data_ro))])
+        perm = reorder.permutation(nodes, edge2node)
+        eperm = reorder.follow(iterset, edge2node, perm)
+        reorder.renumber({nodes: perm, iterset: eperm}, maps=[edge2node],
+                         dats=[x, lengths], subsets=[boundary])
+        op2.par_loop(length, iterset, lengths(op2.WRITE), x(op2.READ, edge2node))
+        assert np.allclose(lengths.data_ro, 1.0)
+        assert x.data_ro[boundary.indices[0]] == 0.0
+
+    def test_renumber_after_par_loop(self, nodes, iterset, edge2node, x, length):
+        lengths = op2.Dat(iterset, dtype=np.float64)
+        op2.par_loop(length, iterset, lengths(op2.WRITE), x(op2.READ, edge2node))
+        perm = reorder.permutation(nodes, edge2node)
+        eperm = reorder.follow(iterset, edge2node, perm)
+        reorder.renumber({nodes: perm, iterset: eperm}, maps=[edge2node],
+                         dats=[x, lengths])
+        assert np.allclose(lengths.data_ro, 1.0)
+        op2.par_loop(length, iterset, lengths(op2.WRITE), x(op2.READ, edge2node))
+        assert np.allclose(lengths.data_ro, 1.0)
+
+    def test_renumber_evaluates_pending_loops(self, nodes, iterset, edge2node, x, length):
+        lengths = op2.Dat(iterset, dtype=np.float64)
+        # Neither the result of this loop nor x is renumbered
+        op2.par_loop(length, iterset, lengths(op2.WRITE), x(op2.READ, edge2node))
+        reorder.renumber({nodes: reorder.permutation(nodes, edge2node)},
+                         maps=[edge2node])
+        assert np.allclose(lengths.data_ro, 1.0)
+
+    def test_renumber_forgets_numbering(self, nodes, edge2node):
+        dset = nodes ** 1
+        dset.lgmap
+        reorder.renumber({nodes: reorder.permutation(nodes, edge2node)},
+                         maps=[edge2node])
+        assert "lgmap" not in dset.__dict__
+        assert nodes ** 1 is dset
+
+    def test_renumber_forgets_subset_plans(self, nodes, edge2node):
+        boundary = op2.Subset(nodes, [0, 1])
+        plan = openmp.Plan(boundary)
+        reorder.renumber({nodes: reorder.permutation(nodes, edge2node)},
+                         maps=[edge2node], subsets=[boundary])
+        assert openmp.Plan(boundary) is not plan
+
+    def test_renumber_rejects_mixing_partitions(self):
+        s = op2.Set((2, 3, 3, 3))
+        with pytest.raises(ValueError):
+            reorder.renumber({s: [2, 1, 0]})